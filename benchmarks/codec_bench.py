@@ -0,0 +1,157 @@
+"""
+Benchmark of the JSON codec (nyuki.utils.codec) and of the bus event
+encodings (nyuki.bus.encoding), on typical payloads.
+Backends that are not installed (orjson, msgpack) are skipped.
+
+    python benchmarks/codec_bench.py [--number N] [--repeat N]
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import timeit
+from datetime import datetime, timezone
+from unittest.mock import patch
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from nyuki.bus import encoding  # noqa: E402
+from nyuki.utils.serialize import serialize_object  # noqa: E402
+
+
+def import_codec(orjson):
+    """
+    Import a fresh codec module, with or without orjson.
+    """
+    modules = {} if orjson else {'orjson': None}
+    with patch.dict(sys.modules, modules):
+        spec = importlib.util.find_spec('nyuki.utils.codec')
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    return module
+
+
+def bus_event():
+    return {
+        'uid': str(uuid4()),
+        'type': 'alert',
+        'date': datetime.now(timezone.utc),
+        'site': {'id': 'site-42', 'name': 'Main building', 'floor': 3},
+        'values': [12.5, 13.0, 12.75, 14.25],
+        'tags': ['fire', 'level-2'],
+        'acknowledged': False,
+    }
+
+
+def workflow_report(tasks=40):
+    now = datetime.now(timezone.utc)
+    return {
+        'id': 'template', 'version': 3, 'title': 'Evacuation B2',
+        'tags': ['evacuation'], 'draft': False,
+        'exec': {
+            'id': str(uuid4()), 'start': now, 'end': None,
+            'state': 'pending', 'requester': 'nyuki://pumba',
+            'track': [str(uuid4())],
+        },
+        'graph': {
+            str(index): [str(index + 1)] if index + 1 < tasks else []
+            for index in range(tasks)
+        },
+        'tasks': [
+            {
+                'id': str(index), 'name': 'send_message',
+                'config': {
+                    'template': 'Evacuate the building {{site.name}}',
+                    'recipients': ['user-{}'.format(i) for i in range(10)],
+                },
+                'exec': {
+                    'id': str(uuid4()), 'start': now, 'end': now,
+                    'state': 'done',
+                    'inputs': bus_event(), 'outputs': bus_event(),
+                    'reporting': {'sent': 10, 'failed': 0},
+                },
+            }
+            for index in range(tasks)
+        ],
+    }
+
+
+def stdlib_dumps(obj):
+    # Encoding used before the codec
+    return json.dumps(obj, default=serialize_object).encode()
+
+
+def timing(func, number, repeat):
+    """
+    Best time of `repeat` runs, per call, in microseconds.
+    """
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    return best / number * 1e6
+
+
+def bench_json(payloads, number, repeat):
+    codecs = [('json + serialize_object', stdlib_dumps, json.loads)]
+    std = import_codec(orjson=False)
+    codecs.append(('codec, json', std.json_encode, std.json_loads))
+    fast = import_codec(orjson=True)
+    if fast.JSON_BACKEND == 'orjson':
+        codecs.append(('codec, orjson', fast.json_encode, fast.json_loads))
+
+    print('JSON codec{:>28}{:>11}'.format('encode', 'decode'))
+    for name, data in payloads:
+        print('  {} ({} B)'.format(name, len(std.json_encode(data))))
+        for codec, dumps, loads in codecs:
+            raw = dumps(data)
+            print('    {:<26}{:>8.1f} us{:>8.1f} us'.format(
+                codec,
+                timing(lambda: dumps(data), number, repeat),
+                timing(lambda: loads(raw), number, repeat),
+            ))
+
+
+def bench_encoding(payloads, number, repeat):
+    formats = [
+        ('json', {'encoding': encoding.JSON}),
+        ('json + zlib', {'encoding': encoding.JSON, 'compress': 0}),
+    ]
+    if encoding.msgpack is not None:
+        formats.extend([
+            ('msgpack', {'encoding': encoding.MSGPACK}),
+            ('msgpack + zlib', {'encoding': encoding.MSGPACK, 'compress': 0}),
+        ])
+
+    print('Bus events{:>28}{:>11}{:>11}'.format('encode', 'decode', 'size'))
+    for name, data in payloads:
+        print('  {}'.format(name))
+        for fmt, kwargs in formats:
+            raw = encoding.encode_event(data, **kwargs)
+            print('    {:<26}{:>8.1f} us{:>8.1f} us{:>9} B'.format(
+                fmt,
+                timing(lambda: encoding.encode_event(data, **kwargs),
+                       number, repeat),
+                timing(lambda: encoding.decode_event(raw), number, repeat),
+                len(raw),
+            ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--number', type=int, default=200,
+                        help='calls per run')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs, the best one is kept')
+    args = parser.parse_args()
+
+    payloads = [
+        ('bus event', bus_event()),
+        ('workflow report', workflow_report()),
+    ]
+    bench_json(payloads, args.number, args.repeat)
+    print()
+    bench_encoding(payloads, args.number, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Benchmark of the dispatch of the wildcard subscriptions (nyuki.bus.topics),
+against the list of compiled regexes the bus used before.
+
+    python benchmarks/topics_bench.py [--number N] [--repeat N]
+"""
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from nyuki.bus.topics import TopicTree  # noqa: E402
+
+
+def regex_topic(pattern):
+    # Translation of the MQTT patterns used before the topic tree
+    return re.compile(r'^{}$'.format(
+        pattern.replace('+', r'[^\/]+').replace('#', '.+')
+    ))
+
+
+def patterns(count):
+    """
+    `count` wildcard patterns, alternately with '+' and '#'.
+    """
+    return [
+        'sites/{}/+/alerts'.format(index) if index % 2 else
+        'devices/{}/#'.format(index)
+        for index in range(count)
+    ]
+
+
+def regex_match(regexes, topic):
+    return [
+        callbacks
+        for regex, callbacks in regexes
+        if regex.match(topic)
+    ]
+
+
+def timing(func, number, repeat):
+    """
+    Best time of `repeat` runs, per call, in microseconds.
+    """
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    return best / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--number', type=int, default=1000,
+                        help='calls per run')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs, the best one is kept')
+    args = parser.parse_args()
+
+    print('Matching topic{:>23}{:>14}'.format('regex list', 'topic tree'))
+    for count in (10, 1000, 10000):
+        regexes = []
+        tree = TopicTree()
+        for pattern in patterns(count):
+            regexes.append((regex_topic(pattern), {pattern}))
+            tree.add(pattern, pattern)
+        # One matching pattern, the last one (odd index, a '+' pattern)
+        topic = 'sites/{}/b2/alerts'.format(count - 1)
+        assert regex_match(regexes, topic) == tree.match(topic)
+        number = max(args.number * 10 // count, 10)
+        print('  {:>5} patterns{:>18.2f} us{:>11.2f} us'.format(
+            count,
+            timing(lambda: regex_match(regexes, topic), number, args.repeat),
+            timing(lambda: tree.match(topic), args.number, args.repeat),
+        ))
+
+
+if __name__ == '__main__':
+    main()
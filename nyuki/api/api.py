@@ -7,7 +7,7 @@ import logging
 
 from nyuki.bus import reporting
 from nyuki.services import Service
-from nyuki.utils import serialize_object
+from nyuki.utils import json_encode
 
 
 log = logging.getLogger(__name__)
@@ -56,7 +56,7 @@ class Response(web.Response):
 
         # Check json
         if isinstance(body, dict) or isinstance(body, list):
-            body = json.dumps(body, default=serialize_object).encode(self.ENCODING)
+            body = json_encode(body)
             if not self._get_content_type(kwargs):
                 kwargs['content_type'] = 'application/json'
         # Check body
@@ -71,6 +71,67 @@ class Response(web.Response):
         return kwargs.get('content_type') or kwargs.get('headers', {}).get('Content-Type')
 
 
+class StreamResponse(web.StreamResponse):
+
+    """
+    JSON response written in chunks while its items are serialized one by
+    one, for listings too large to be held in memory.
+    The items come from an async iterable (e.g. a motor cursor) and make up
+    the body as a list, or as the `key` field of the `head` dict.
+    """
+
+    ENCODING = 'utf-8'
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, items, head=None, key=None, **kwargs):
+        super().__init__(**kwargs)
+        self.content_type = 'application/json'
+        self.charset = self.ENCODING
+        self.enable_chunked_encoding()
+        self._items = items
+        self._head = head
+        self._key = key
+
+    async def _stream(self, items):
+        if self._key is None:
+            chunk = bytearray(b'[')
+        else:
+            # Open the dict and its list, keeping the head fields
+            chunk = bytearray(json_encode(self._head or {})[:-1])
+            if self._head:
+                chunk += b','
+            chunk += json_encode(self._key) + b':['
+
+        first = True
+        async for item in items:
+            if first is False:
+                chunk += b','
+            first = False
+            chunk += json_encode(item)
+            if len(chunk) >= self.CHUNK_SIZE:
+                self.write(chunk)
+                # Wait for the client to read, to keep the memory bounded
+                await self.drain()
+                chunk = bytearray()
+
+        chunk += b']' if self._key is None else b']}'
+        self.write(chunk)
+
+    async def write_eof(self, data=b''):
+        """
+        Write the items once the headers are sent.
+        """
+        items, self._items = self._items, None
+        if items is not None:
+            try:
+                await self._stream(items)
+            except Exception as exc:
+                # Too late to change the status, the connection is dropped
+                log.error('Could not stream response: %s', exc)
+                raise
+        await super().write_eof(data)
+
+
 async def mw_capability(app, capa_handler):
     """
     Transform the request data to be passed through a capability and
@@ -126,7 +187,7 @@ async def mw_capability(app, capa_handler):
             reporting.exception(exc)
             raise
 
-        if capa_resp and isinstance(capa_resp, Response):
+        if capa_resp and isinstance(capa_resp, (Response, StreamResponse)):
             return capa_resp
         return Response()
 
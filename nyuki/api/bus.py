@@ -9,6 +9,19 @@ from .api import Response, resource
 @resource('/bus/replay', versions=['v1'])
 class ApiBusReplay:
 
+    async def get(self, request):
+        """
+        Return the progress of the current or last replay
+        """
+        try:
+            self.nyuki._services.get('bus')
+        except KeyError:
+            return Response(status=404)
+        stats = self.nyuki.bus.replay_stats
+        if stats is None:
+            return Response(status=404)
+        return Response(stats)
+
     async def post(self, request):
         body = await request.json()
 
@@ -42,7 +55,27 @@ class ApiBusReplay:
                     'error': 'unknown event status type {}'.format(es)
                 })
 
-        await self.nyuki.bus.replay(since, status)
+        # Optional events/sec cap and concurrency
+        options = {}
+        for key, cast in (('rate', float), ('concurrency', int)):
+            if body.get(key) is None:
+                continue
+            try:
+                value = cast(body[key])
+            except (TypeError, ValueError):
+                value = 0
+            if value <= 0:
+                return Response(status=400, body={
+                    'error': "'{}' must be a positive number".format(key)
+                })
+            options[key] = value
+
+        # Follow the progress using GET /v1/bus/replay
+        replay = asyncio.ensure_future(
+            self.nyuki.bus.replay(since, status, **options)
+        )
+        replay.add_done_callback(self.nyuki.bus.replay_done)
+        return Response(status=202)
 
 
 @resource('/bus/topics', versions=['v1'])
@@ -56,9 +89,39 @@ class ApiBusTopics:
         return Response(self.nyuki.bus.topics)
 
 
+@resource('/bus/callbacks', versions=['v1'])
+class ApiBusCallbacks:
+
+    async def get(self, request):
+        """
+        Return the metrics of the callback worker pools, if enabled
+        """
+        try:
+            self.nyuki._services.get('bus')
+        except KeyError:
+            return Response(status=404)
+        stats = self.nyuki.bus.callback_stats
+        if stats is None:
+            return Response(status=404)
+        return Response(stats)
+
+
 @resource('/bus/publish', versions=['v1'])
 class ApiBusPublish:
 
+    async def get(self, request):
+        """
+        Return the metrics of the publication queue, if enabled
+        """
+        try:
+            self.nyuki._services.get('bus')
+        except KeyError:
+            return Response(status=404)
+        stats = self.nyuki.bus.publish_stats
+        if stats is None:
+            return Response(status=404)
+        return Response(stats)
+
     async def post(self, request):
         try:
             self.nyuki._services.get('bus')
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class CallbackPool(object):
+
+    """
+    Opt-in worker pool of a bus callback, running at most `concurrency` calls
+    at once with at most `queue_size` events waiting. Putting an event in a
+    full queue blocks the caller, so that the bus stops reading messages
+    (backpressure).
+    If `ordered` is True, the events of a topic are always handled by the
+    same worker, one at a time and in their arrival order.
+    In-process publications use `put_soon()` instead, which never blocks.
+    """
+
+    def __init__(self, callback, concurrency=10, queue_size=1000,
+                 ordered=False, loop=None):
+        self._callback = callback
+        self._loop = loop or asyncio.get_event_loop()
+        self.concurrency = concurrency
+        self.ordered = ordered
+        if ordered is True:
+            # One queue per worker, sharing the whole queue size
+            size = max(queue_size // concurrency, 1)
+            self._queues = [
+                asyncio.Queue(maxsize=size, loop=self._loop)
+                for _ in range(concurrency)
+            ]
+        else:
+            self._queues = [asyncio.Queue(maxsize=queue_size, loop=self._loop)]
+        self._size = sum(queue.maxsize for queue in self._queues)
+        self._workers = []
+        # Puts waiting for a free slot, by queue, see put_soon()
+        self._deferred = {id(queue): set() for queue in self._queues}
+
+        # Metrics
+        self._in_flight = 0
+        self._processed = 0
+        self._errors = 0
+        self._blocked = 0
+        self._dropped = 0
+
+    def __repr__(self):
+        return '<CallbackPool {} concurrency={} size={} ordered={}>'.format(
+            getattr(self._callback, '__qualname__', self._callback),
+            self.concurrency, self._size, self.ordered,
+        )
+
+    @property
+    def stats(self):
+        return {
+            'depth': sum(queue.qsize() for queue in self._queues),
+            'size': self._size,
+            'concurrency': self.concurrency,
+            'ordered': self.ordered,
+            'in_flight': self._in_flight,
+            'processed': self._processed,
+            'errors': self._errors,
+            'blocked': self._blocked,
+            'dropped': self._dropped,
+        }
+
+    def start(self):
+        if self._workers:
+            return
+        for index in range(self.concurrency):
+            queue = self._queues[index % len(self._queues)]
+            self._workers.append(asyncio.ensure_future(
+                self._work(queue), loop=self._loop
+            ))
+
+    def stop(self):
+        """
+        Cancel the running calls and drop the waiting events.
+        """
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+        for queue in self._queues:
+            while not queue.empty():
+                queue.get_nowait()
+                self._dropped += 1
+            deferred = self._deferred[id(queue)]
+            for put in deferred:
+                put.cancel()
+                self._dropped += 1
+            deferred.clear()
+
+    def _queue(self, topic):
+        if self.ordered is True:
+            return self._queues[hash(topic) % len(self._queues)]
+        return self._queues[0]
+
+    async def put(self, topic, data):
+        """
+        Queue an event, wait for a free slot if the queue is full.
+        """
+        queue = self._queue(topic)
+        if queue.full():
+            self._blocked += 1
+            log.debug('%r full, waiting for a free slot', self)
+        await queue.put((topic, data))
+
+    def put_soon(self, topic, data):
+        """
+        Queue an event without waiting, for the in-process publications: a
+        callback of this pool publishing to its own topics would otherwise
+        wait for itself when the queue is full. The event is queued by a
+        task once a slot is free, after the events already waiting.
+        """
+        queue = self._queue(topic)
+        deferred = self._deferred[id(queue)]
+        if not deferred and not queue.full():
+            queue.put_nowait((topic, data))
+            return
+        self._blocked += 1
+        log.debug('%r full, queueing the event once a slot is free', self)
+        put = asyncio.ensure_future(
+            queue.put((topic, data)), loop=self._loop
+        )
+        deferred.add(put)
+        put.add_done_callback(deferred.discard)
+
+    async def _work(self, queue):
+        while True:
+            topic, data = await queue.get()
+            self._in_flight += 1
+            try:
+                await self._callback(topic, data)
+            except asyncio.CancelledError:
+                self._dropped += 1
+                raise
+            except Exception:
+                self._errors += 1
+                log.exception("Bus callback failed on topic '%s'", topic)
+            else:
+                self._processed += 1
+            finally:
+                self._in_flight -= 1
@@ -0,0 +1,119 @@
+"""
+Encoding of the bus events.
+Events are plain JSON by default. Binary events (MessagePack, compressed
+events, or events carrying their uid) start with a 2 bytes header, the first
+one (0xc1) being invalid both as the first byte of a JSON document and in
+MessagePack:
+    - 0xc1
+    - format (0x00 JSON, 0x01 MessagePack), | 0x80 if zlib compressed,
+      | 0x40 if the 16 bytes of the event uid follow the header
+Any nyuki decodes both, publishers choose the encoding of each topic.
+"""
+import logging
+import zlib
+from uuid import UUID
+
+from nyuki.utils import json_encode, json_loads
+from nyuki.utils.serialize import serialize_object
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+log = logging.getLogger(__name__)
+
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+MAGIC = 0xc1
+_FORMATS = {JSON: 0x00, MSGPACK: 0x01}
+_ZLIB = 0x80
+_UID = 0x40
+ZLIB_LEVEL = 1
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, int):
+        # Integers larger than 64 bits
+        raise OverflowError(obj)
+    return serialize_object(obj)
+
+
+def is_binary(payload):
+    return len(payload) > 1 and payload[0] == MAGIC
+
+
+def event_uid(payload):
+    """
+    Return the uid carried by an event, None if it has none.
+    """
+    if is_binary(payload) and payload[1] & _UID and len(payload) >= 18:
+        return str(UUID(bytes=bytes(payload[2:18])))
+    return None
+
+
+def encode_event(data, encoding=JSON, compress=None, uid=None):
+    """
+    Serialize an event into bytes, compressing it if it is at least
+    `compress` bytes long. The event `uid` is carried along if given (the
+    event is then binary).
+    """
+    if encoding == MSGPACK and msgpack is not None:
+        try:
+            payload = msgpack.packb(
+                data, default=_msgpack_default, use_bin_type=True,
+                datetime=True,
+            )
+        except OverflowError:
+            encoding, payload = JSON, json_encode(data)
+    else:
+        encoding, payload = JSON, json_encode(data)
+
+    header = _FORMATS[encoding]
+    if compress is not None and len(payload) >= compress:
+        payload = zlib.compress(payload, ZLIB_LEVEL)
+        header |= _ZLIB
+    elif encoding == JSON and uid is None:
+        # Plain JSON, readable by any subscriber
+        return payload
+    if uid is not None:
+        header |= _UID
+        return bytes((MAGIC, header)) + UUID(uid).bytes + payload
+    return bytes((MAGIC, header)) + payload
+
+
+def decode_event(payload):
+    """
+    Deserialize an event (JSON, or binary with a header).
+    Raise ValueError if it can't be decoded.
+    """
+    if not is_binary(payload):
+        return json_loads(payload)
+
+    header = payload[1]
+    body = memoryview(payload)[2:]
+    if header & _UID:
+        body = body[16:]
+        header &= ~_UID
+    if header & _ZLIB:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error as exc:
+            raise ValueError(exc) from exc
+    header &= ~_ZLIB
+
+    if header == _FORMATS[JSON]:
+        return json_loads(body)
+    if header != _FORMATS[MSGPACK]:
+        raise ValueError('unknown event format {:#x}'.format(header))
+    if msgpack is None:
+        raise ValueError('msgpack is required to decode this event')
+    try:
+        return msgpack.unpackb(
+            body, raw=False, timestamp=3, strict_map_key=False
+        )
+    except Exception as exc:
+        raise ValueError(exc) from exc
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+
+from .topics import TopicTree
+
+
+log = logging.getLogger(__name__)
+
+
+class LoopbackModes(object):
+
+    """
+    Loopback mode of the publications, configured by topic pattern:
+        - 'local': only the subscriptions of this nyuki receive the events,
+          which are not sent to the broker
+        - 'both': the subscriptions of this nyuki receive the events
+          in-process, and the events are also sent to the broker for the
+          other nyukis, carrying their uid to recognize them when the broker
+          sends them back (see nyuki.bus.encoding). This requires the
+          msgpack encoding, plain JSON events are left unchanged: JSON
+          topics below a 'both' pattern are only received from the broker
+    'both' wins when several patterns match the same topic.
+    """
+
+    LOCAL = 'local'
+    BOTH = 'both'
+
+    def __init__(self, patterns):
+        self._tree = TopicTree()
+        for pattern, mode in patterns.items():
+            self._tree.add(pattern, mode)
+
+    def __bool__(self):
+        return len(self._tree) > 0
+
+    def mode(self, topic):
+        """
+        Return the loopback mode of a topic, None if it is not looped back.
+        """
+        modes = set()
+        for matched in self._tree.match(topic):
+            modes.update(matched)
+        if not modes:
+            return None
+        return self.BOTH if self.BOTH in modes else self.LOCAL
+
+
+class EchoFilter(object):
+
+    """
+    Remember the uids of the events sent to the broker after being delivered
+    in-process, to ignore them when the broker sends them back (the uid is
+    carried by the event, see nyuki.bus.encoding).
+    An event not sent back within `ttl` seconds is forgotten.
+    """
+
+    def __init__(self, ttl=30, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self.ttl = ttl
+        # {uid: expiration}
+        self._expected = {}
+
+    def expect(self, uid):
+        now = self._loop.time()
+        if len(self._expected) >= 1000:
+            self._purge(now)
+        self._expected[uid] = now + self.ttl
+
+    def is_echo(self, uid):
+        """
+        Return True (only once per expected event) if this event was
+        delivered in-process already.
+        """
+        expiration = self._expected.pop(uid, None)
+        return expiration is not None and expiration >= self._loop.time()
+
+    def _purge(self, now):
+        self._expected = {
+            uid: expiration
+            for uid, expiration in self._expected.items()
+            if expiration >= now
+        }
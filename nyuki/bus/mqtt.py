@@ -1,26 +1,28 @@
-import re
-import json
 import asyncio
 import logging
 from copy import copy
 from uuid import uuid4
-from collections import namedtuple
 from hbmqtt.client import MQTTClient, ConnectException, ClientException
 from hbmqtt.errors import NoDataException
 from hbmqtt.mqtt.constants import QOS_1
 
 from nyuki.bus import reporting
 from nyuki.services import Service
-from nyuki.utils import serialize_object
+from nyuki.utils import utcnow
 from .persistence import BusPersistence, EventStatus
+from .publisher import PublishQueue, QueuedEvent
+from .dispatcher import CallbackPool
+from .encoding import (
+    MSGPACK, decode_event, encode_event, event_uid, is_binary, msgpack
+)
+from .loopback import EchoFilter, LoopbackModes
+from .policy import TopicPolicies
+from .topics import TopicTree, is_pattern
 
 
 log = logging.getLogger(__name__)
 
 
-MQTTRegex = namedtuple('MQTTRegex', ['regex', 'callbacks'])
-
-
 class MqttBus(Service):
 
     """
@@ -53,12 +55,73 @@ class MqttBus(Service):
                             ]},
                             'host': {'type': 'string'},
                             'ttl': {'type': 'number'},
+                            'flush_interval': {
+                                'type': 'number', 'minimum': 0
+                            },
+                            'flush_size': {'type': 'integer', 'minimum': 1},
+                        },
+                    },
+                    'replay': {
+                        'type': 'object',
+                        'properties': {
+                            'rate': {
+                                'type': 'number',
+                                'minimum': 0,
+                                'exclusiveMinimum': True,
+                            },
+                            'concurrency': {'type': 'integer', 'minimum': 1},
+                            'chunk_size': {'type': 'integer', 'minimum': 1},
                         },
                     },
                     'scheme': {
                         'type': 'string',
                         'enum': ['ws', 'wss', 'mqtt', 'mqtts']
                     },
+                    'publish_queue': {
+                        'type': 'object',
+                        'properties': {
+                            'size': {'type': 'integer', 'minimum': 1},
+                            'batch_size': {'type': 'integer', 'minimum': 1},
+                            'linger': {'type': 'number', 'minimum': 0},
+                        },
+                    },
+                    # QoS and persistence by topic pattern, see TopicPolicies
+                    'topics': {
+                        'type': 'object',
+                        'additionalProperties': {
+                            'type': 'object',
+                            'properties': {
+                                'qos': {'type': 'integer', 'enum': [0, 1, 2]},
+                                'persistence': {'type': 'boolean'},
+                                'encoding': {
+                                    'type': 'string',
+                                    'enum': ['json', 'msgpack'],
+                                },
+                                'compress': {'type': 'integer', 'minimum': 0},
+                            },
+                            'additionalProperties': False,
+                        },
+                    },
+                    # Topic patterns published in-process, see LoopbackModes
+                    'loopback': {
+                        'type': 'object',
+                        'description': (
+                            "'local': events only delivered in-process, "
+                            "'both': also sent to the broker, which requires "
+                            "the msgpack encoding of the topics"
+                        ),
+                        'additionalProperties': {
+                            'type': 'string', 'enum': ['local', 'both'],
+                        },
+                    },
+                    'callbacks': {
+                        'type': 'object',
+                        'properties': {
+                            'concurrency': {'type': 'integer', 'minimum': 1},
+                            'queue_size': {'type': 'integer', 'minimum': 1},
+                            'ordered': {'type': 'boolean'},
+                        },
+                    },
                     'service': {'type': 'string', 'minLength': 1},
                     'keep_alive': {'type': 'integer', 'minimum': 1},
                     'ping_delay': {'type': 'integer', 'minimum': 1}
@@ -77,7 +140,18 @@ class MqttBus(Service):
         self._pending = {}
         self.name = None
         self._subscriptions = {}
-        self._regex_subscriptions = {}
+        self._regex_subscriptions = TopicTree()
+        self._persistence = None
+        self._publish_queue = None
+        self._draining = None
+        self._callbacks_config = None
+        # Worker pool of each callback, if enabled
+        self._pools = {}
+        self._policies = TopicPolicies({})
+        self._loopback = LoopbackModes({})
+        self._echoes = EchoFilter(loop=self._loop)
+        self._replay_config = {}
+        self._replay_stats = None
 
         # Coroutines
         self.connect_future = None
@@ -87,14 +161,46 @@ class MqttBus(Service):
     def topics(self):
         return list(self._subscriptions.keys())
 
+    @property
+    def publish_stats(self):
+        if self._publish_queue is None:
+            return None
+        return self._publish_queue.stats
+
+    @property
+    def replay_stats(self):
+        return self._replay_stats
+
+    @property
+    def callback_stats(self):
+        if self._callbacks_config is None:
+            return None
+        return {
+            '{}.{}'.format(callback.__module__, callback.__qualname__):
+                pool.stats
+            for callback, pool in self._pools.items()
+        }
+
     def configure(self, name, scheme='mqtt', host='localhost', port=1883,
                   cafile=None, certfile=None, keyfile=None, persistence={},
-                  service=None, keep_alive=60, ping_delay=5):
+                  service=None, keep_alive=60, ping_delay=5,
+                  publish_queue=None, replay=None, callbacks=None,
+                  loopback=None, topics=None):
         if scheme in ['mqtts', 'wss']:
             if not cafile or not certfile or not keyfile:
                 raise ValueError(
                     "secured scheme requires 'cafile', 'certfile' and 'keyfile'"
                 )
+        policies = TopicPolicies(topics or {})
+        for pattern, mode in (loopback or {}).items():
+            # The echoes are recognized by the uid carried in the binary
+            # envelope, plain JSON events are left unchanged
+            if mode == LoopbackModes.BOTH and \
+                    policies.get(pattern).encoding != MSGPACK:
+                raise ValueError(
+                    "loopback 'both' requires the msgpack encoding on "
+                    "'{}'".format(pattern)
+                )
 
         self._host = '{}://{}:{}'.format(scheme, host, port)
         self.name = name
@@ -116,10 +222,46 @@ class MqttBus(Service):
             log.info('Bus persistence set to %s', self._persistence.backend)
         else:
             self._persistence = None
+        self._replay_config = replay or {}
+
+        # Batched publications, the previous queue sends its remaining events
+        # before the service starts again
+        if self._publish_queue is not None:
+            self._draining = asyncio.ensure_future(
+                self._publish_queue.stop(), loop=self._loop
+            )
+        if publish_queue is not None:
+            self._publish_queue = PublishQueue(
+                self._publish_batch, loop=self._loop, **publish_queue
+            )
+            log.info('Bus publications queued with %s', self._publish_queue)
+        else:
+            self._publish_queue = None
+
+        # Bounded concurrency of the subscription callbacks
+        for pool in self._pools.values():
+            pool.stop()
+        self._pools = {}
+        self._callbacks_config = callbacks
+
+        # In-process publications
+        self._loopback = LoopbackModes(loopback or {})
+        # QoS and persistence of the topics
+        self._policies = policies
+        if msgpack is None and any(
+            policy.get('encoding') == MSGPACK
+            for policy in (topics or {}).values()
+        ):
+            log.warning('msgpack is not installed, events encoded in JSON')
 
     async def start(self):
         if self._persistence:
             await self._persistence.init()
+        if self._draining is not None:
+            await self._draining
+            self._draining = None
+        if self._publish_queue:
+            self._publish_queue.start()
 
         def cancelled(future):
             try:
@@ -130,6 +272,18 @@ class MqttBus(Service):
         self.connect_future.add_done_callback(cancelled)
 
     async def stop(self):
+        # Send the queued events before disconnecting
+        if self._draining is not None:
+            await self._draining
+            self._draining = None
+        if self._publish_queue:
+            await self._publish_queue.stop()
+        # Write the buffered persistence operations
+        if self._persistence:
+            await self._persistence.close()
+        for pool in self._pools.values():
+            pool.stop()
+        self._pools = {}
         # Clean client
         if self.client is not None:
             for task in self.client.client_tasks:
@@ -153,20 +307,22 @@ class MqttBus(Service):
         """
         reporting.init(self.name, self)
 
-    def _regex_topic(self, topic):
+    async def replay(self, since=None, status=None, rate=None,
+                     concurrency=None):
         """
-        Transform the MQTT pattern into a regex object.
-        """
-        return re.compile(r'^{}$'.format(
-            topic.replace('+', '[^\/]+').replace('#', '.+')
-        ))
-
-    async def replay(self, since=None, status=None):
-        """
-        Replay events since the given datetime (or all if None)
+        Replay events since the given datetime (or all if None).
+        Events are streamed from the persistence backend by chunks and
+        published with a bounded concurrency, at most `rate` events/sec.
         """
         if not self._persistence:
             return
+        if self._replay_stats and self._replay_stats['running']:
+            log.warning('Replay already in progress, ignoring')
+            return
+
+        rate = rate or self._replay_config.get('rate')
+        concurrency = concurrency or self._replay_config.get('concurrency', 1)
+        chunk_size = self._replay_config.get('chunk_size', 500)
 
         msg = 'Replaying events'
         if since:
@@ -175,36 +331,105 @@ class MqttBus(Service):
             msg += ' with status {}'.format(status)
         log.info(msg)
 
-        events = await self._persistence.retrieve(since, status)
-        for event in events:
-            # Publish events one by one in the right publish time order
-            await self.publish(json.loads(
-                event['message']),
-                event['topic'],
-                event['id']
+        stats = {
+            'running': True,
+            'start': utcnow(),
+            'end': None,
+            'rate_limit': rate,
+            'concurrency': concurrency,
+            'total': 0,
+            'replayed': 0,
+            'failed': 0,
+            'remaining': 0,
+            'rate': 0.0,
+            'error': None,
+        }
+        self._replay_stats = stats
+        start = self._loop.time()
+        semaphore = asyncio.Semaphore(concurrency, loop=self._loop)
+        pending = set()
+
+        async def republish(event):
+            # Failures are counted here, these futures are only waited for
+            try:
+                await self.publish(
+                    decode_event(event['message']),
+                    event['topic'],
+                    event['id']
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                stats['failed'] += 1
+                log.error('Could not replay event %s: %s', event['id'], exc)
+            else:
+                stats['replayed'] += 1
+            finally:
+                semaphore.release()
+                done = stats['replayed'] + stats['failed']
+                stats['remaining'] = max(stats['total'] - done, 0)
+                elapsed = self._loop.time() - start
+                if elapsed > 0:
+                    stats['rate'] = round(stats['replayed'] / elapsed, 3)
+
+        try:
+            stats['total'] = stats['remaining'] = await self._persistence.count(
+                since, status
             )
+            scheduled = 0
+            async for chunk in self._persistence.stream(
+                    since, status, chunk_size):
+                for event in chunk:
+                    # Wait for the time slot of this event
+                    if rate:
+                        delay = start + scheduled / rate - self._loop.time()
+                        if delay > 0:
+                            await asyncio.sleep(delay, loop=self._loop)
+                    # Events are published in the right publish time order
+                    await semaphore.acquire()
+                    future = asyncio.ensure_future(
+                        republish(event), loop=self._loop
+                    )
+                    pending.add(future)
+                    future.add_done_callback(pending.discard)
+                    scheduled += 1
+            if pending:
+                await asyncio.wait(pending, loop=self._loop)
+        finally:
+            stats['running'] = False
+            stats['end'] = utcnow()
+            log.info(
+                '%d events replayed, %d failed',
+                stats['replayed'], stats['failed'],
+            )
+
+    def replay_done(self, future):
+        """
+        Done-callback of the replays running in the background, recording
+        their failure in the replay stats.
+        """
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc is None:
+            return
+        error = '{}: {}'.format(type(exc).__name__, exc)
+        log.error('Replay failed: %s', error)
+        if self._replay_stats is not None:
+            self._replay_stats['error'] = error
 
     async def subscribe(self, topic, callback):
         """
         Subscribe to a topic and setup the callback.
-        This will pre-compile the regex used for this topic.
+        Wildcard topics are stored in a topic tree.
         """
         if not asyncio.iscoroutinefunction(callback):
             raise ValueError('event callback must be a coroutine')
 
         sub = False
         log.debug('MQTT subscription to %s -> %s', topic, callback.__name__)
-        # Regexes are about topics like 'word/+/word' or 'word/#'
-        is_regex = '+' in topic or topic.endswith('#')
-        if is_regex is True:
-            try:
-                self._regex_subscriptions[topic].callbacks.add(callback)
-            except KeyError:
-                self._regex_subscriptions[topic] = MQTTRegex(
-                    regex=self._regex_topic(topic),
-                    callbacks={callback},
-                )
-                sub = True
+        if is_pattern(topic):
+            sub = self._regex_subscriptions.add(topic, callback)
         # Standard topics are a simple dict/set pair.
         else:
             try:
@@ -215,23 +440,22 @@ class MqttBus(Service):
 
         # Send the subscription packet only if we were not subscribed yet
         if sub is True:
-            await self.client.subscribe([(topic, QOS_1)])
+            qos = self._subscription_qos(topic)
+            await self.client.subscribe([(topic, qos)])
             log.info('Subscribed to %s', topic)
 
     async def _unsub_regex(self, topic, callback):
         """
-        Unsubscribe from a regex topic.
+        Unsubscribe from a wildcard topic.
         """
         if topic not in self._regex_subscriptions:
             return
-        if callback in self._regex_subscriptions[topic].callbacks:
+        if callback in self._regex_subscriptions.get(topic):
             log.debug(
                 'MQTT unsubscription from %s -> %s',
                 topic, callback.__name__,
             )
-            self._regex_subscriptions[topic].callbacks.remove(callback)
-        if callback is None or not self._regex_subscriptions[topic].callbacks:
-            del self._regex_subscriptions[topic]
+        if self._regex_subscriptions.discard(topic, callback):
             await self.client.unsubscribe([topic])
             log.info('Unsubscribed from %s', topic)
 
@@ -256,10 +480,39 @@ class MqttBus(Service):
         """
         Unsubscribe from a topic, remove callback if set.
         """
-        if '+' in topic or topic.endswith('#'):
+        if is_pattern(topic):
             await self._unsub_regex(topic, callback)
         else:
             await self._unsub(topic, callback)
+        if self._pools:
+            self._clean_pools()
+
+    def _pool(self, callback):
+        """
+        Return the worker pool of a callback, created on its first event.
+        """
+        try:
+            return self._pools[callback]
+        except KeyError:
+            pass
+        pool = CallbackPool(callback, loop=self._loop, **self._callbacks_config)
+        pool.start()
+        self._pools[callback] = pool
+        log.info('Bus callback workers: %s', pool)
+        return pool
+
+    def _clean_pools(self):
+        """
+        Stop the worker pools of the callbacks no longer subscribed.
+        """
+        subscribed = set()
+        for callbacks in self._subscriptions.values():
+            subscribed.update(callbacks)
+        for pattern in self._regex_subscriptions:
+            subscribed.update(self._regex_subscriptions.get(pattern))
+        for callback in list(self._pools):
+            if callback not in subscribed:
+                self._pools.pop(callback).stop()
 
     async def _resubscribe(self):
         """
@@ -269,7 +522,12 @@ class MqttBus(Service):
             list(self._regex_subscriptions.keys())
         for topic in subs:
             log.debug('Resubscribing to %s', topic)
-            await self.client.subscribe([(topic, QOS_1)])
+            qos = self._subscription_qos(topic)
+            await self.client.subscribe([(topic, qos)])
+
+    def _subscription_qos(self, topic):
+        qos = self._policies.get(topic).qos
+        return QOS_1 if qos is None else qos
 
     async def publish(self, data, topic=None, previous_uid=None):
         """
@@ -278,11 +536,51 @@ class MqttBus(Service):
         uid = previous_uid or str(uuid4())
         topic = topic or self.name
         log.debug("Publishing event to '%s': %s", topic, data)
-        data = json.dumps(data, default=serialize_object)
+        policy = self._policies.get(topic)
+
+        # Replayed events were already delivered in-process
+        mode = None
+        if self._loopback and previous_uid is None:
+            mode = self._loopback.mode(topic)
+            if mode == LoopbackModes.BOTH and policy.encoding != MSGPACK:
+                # JSON topic below a 'both' pattern, received from the broker
+                mode = None
+        # Events sent back by the broker are recognized by their uid
+        payload = encode_event(
+            data, policy.encoding, policy.compress,
+            uid=uid if mode == LoopbackModes.BOTH else None,
+        )
+        if mode is not None:
+            delivered = await self._dispatch(topic, payload, block=False)
+            if mode == LoopbackModes.LOCAL:
+                return
+            if delivered:
+                self._echoes.expect(uid)
+
+        if self._publish_queue:
+            await self._publish_queue.put(QueuedEvent(
+                uid, topic, payload, previous_uid is not None
+            ))
+            return
 
+        status = await self._send(topic, payload, policy.qos)
+        if self._persistence and policy.persistence:
+            if previous_uid is None:
+                # This event was not previously sent
+                await self._persistence.store(
+                    self._persistence_event(uid, status, topic, payload)
+                )
+            else:
+                await self._persistence.update(uid, status)
+
+    async def _send(self, topic, payload, qos=None):
+        """
+        Send an encoded event and return its new status
+        (hbmqtt uses its default QoS, 0, if `qos` is None or 0)
+        """
         if self.client._connected_state.is_set():
             try:
-                await self.client.publish(topic, data.encode())
+                await self.client.publish(topic, payload, qos=qos)
             except Exception as exc:
                 status = EventStatus.PENDING
                 log.error('Error while publishing: %s', exc)
@@ -292,18 +590,47 @@ class MqttBus(Service):
         else:
             status = EventStatus.FAILED
             log.error('Failed to send event to topic %s', topic)
+        return status
+
+    def _persistence_event(self, uid, status, topic, payload):
+        # JSON events are stored as readable strings
+        if not is_binary(payload):
+            payload = payload.decode()
+        return {
+            'id': uid,
+            'status': status.value,
+            'topic': topic,
+            'message': payload,
+        }
 
-        if self._persistence:
-            if previous_uid is None:
-                # This event was not previously sent
-                await self._persistence.store({
-                    'id': uid,
-                    'status': status.value,
-                    'topic': topic,
-                    'message': data,
-                })
+    async def _publish_batch(self, events):
+        """
+        Send a batch of queued events concurrently, then store the new events
+        and the status of the replayed ones using one bulk write each.
+        """
+        policies = [self._policies.get(event.topic) for event in events]
+        statuses = await asyncio.gather(*[
+            self._send(event.topic, event.message, policy.qos)
+            for event, policy in zip(events, policies)
+        ])
+        if not self._persistence:
+            return
+
+        new_events = []
+        updates = []
+        for event, policy, status in zip(events, policies, statuses):
+            if policy.persistence is False:
+                continue
+            if event.stored is False:
+                new_events.append(self._persistence_event(
+                    event.uid, status, event.topic, event.message
+                ))
             else:
-                await self._persistence.update(uid, status)
+                updates.append((event.uid, status))
+        if new_events:
+            await self._persistence.store_many(new_events)
+        if updates:
+            await self._persistence.update_many(updates)
 
     async def _run(self):
         """
@@ -322,9 +649,10 @@ class MqttBus(Service):
             # Replaying events
             log.info('Connection made with MQTT')
             if self._persistence:
-                asyncio.ensure_future(self.replay(
+                replay = asyncio.ensure_future(self.replay(
                     status=EventStatus.not_sent()
                 ))
+                replay.add_done_callback(self.replay_done)
 
             # Start listening
             await self._resubscribe()
@@ -351,18 +679,50 @@ class MqttBus(Service):
                 break
 
             topic = message.topic
-            data = json.loads(message.data.decode())
-
-            # Iterate and call all regex topics callbacks
-            for mqttregex in self._regex_subscriptions.values():
-                if mqttregex.regex.match(topic):
-                    log.debug("Event from topic '%s': %s", topic, data)
-                    for callback in mqttregex.callbacks:
-                        asyncio.ensure_future(callback(topic, data.copy()))
-
-            try:
-                # Iterate and call all single topic callbacks
-                for callback in self._subscriptions[topic]:
-                    asyncio.ensure_future(callback(topic, data.copy()))
-            except KeyError:
-                pass
+            # Events published by this nyuki and already delivered
+            if self._loopback:
+                uid = event_uid(message.data)
+                if uid is not None and self._echoes.is_echo(uid):
+                    log.debug("Ignoring looped back event from '%s'", topic)
+                    continue
+            await self._dispatch(topic, message.data)
+
+    async def _dispatch(self, topic, payload, block=True):
+        """
+        Call the callbacks subscribed to this topic with the decoded event.
+        Return True if the event had callbacks.
+        In-process publications don't `block` on the full worker pools, the
+        publisher may be one of their callbacks.
+        """
+        # Callbacks of the matching wildcard topics, then of the topic
+        callbacks = [
+            callback
+            for matched in self._regex_subscriptions.match(topic)
+            for callback in matched
+        ]
+        callbacks.extend(self._subscriptions.get(topic, ()))
+        # Only decode the events someone is waiting for
+        if not callbacks:
+            log.debug("No callback for event from topic '%s'", topic)
+            return False
+
+        try:
+            data = decode_event(payload)
+        except ValueError as exc:
+            log.error("Invalid event from topic '%s': %s", topic, exc)
+            return False
+        log.debug("Event from topic '%s': %s", topic, data)
+
+        # Every callback gets its own (shallow) copy of the event, except
+        # the last one which gets the decoded event itself
+        last = len(callbacks) - 1
+        for index, callback in enumerate(callbacks):
+            event = data if index == last else data.copy()
+            if self._callbacks_config is None:
+                asyncio.ensure_future(callback(topic, event))
+            elif block is False:
+                self._pool(callback).put_soon(topic, event)
+            else:
+                # Stops reading messages while the queue is full
+                await self._pool(callback).put(topic, event)
+        return True
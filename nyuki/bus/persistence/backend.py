@@ -1,3 +1,24 @@
+class EventChunks(object):
+
+    """
+    Asynchronous iterator over chunks of stored events.
+    `fetch` is a coroutine function returning the next list of events, an
+    empty list meaning the end of the iteration.
+    """
+
+    def __init__(self, fetch):
+        self._fetch = fetch
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self._fetch()
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
+
 class PersistenceBackend(object):
 
     """
@@ -11,8 +32,40 @@ class PersistenceBackend(object):
     async def store(self, event):
         raise NotImplementedError
 
+    async def store_many(self, events):
+        for event in events:
+            await self.store(event)
+
     async def update(self, uid, status):
         raise NotImplementedError
 
+    async def update_many(self, updates):
+        for uid, status in updates:
+            await self.update(uid, status)
+
     async def retrieve(self, since, status):
         raise NotImplementedError
+
+    async def count(self, since, status):
+        return len(await self.retrieve(since, status))
+
+    def stream(self, since, status, chunk_size):
+        """
+        Iterate over the retrieved events by chunks, backends able to use a
+        cursor should override this method.
+        """
+        events = None
+        offset = 0
+
+        async def fetch():
+            nonlocal events, offset
+            if events is None:
+                events = await self.retrieve(since, status) or []
+            chunk = events[offset:offset + chunk_size]
+            offset += chunk_size
+            return chunk
+
+        return EventChunks(fetch)
+
+    async def close(self):
+        pass
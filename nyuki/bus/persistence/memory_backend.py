@@ -1,6 +1,6 @@
 import logging
+from collections import defaultdict
 
-from nyuki.bus.persistence.events import EventStatus
 from nyuki.bus.persistence.backend import PersistenceBackend
 
 
@@ -9,66 +9,162 @@ log = logging.getLogger(__name__)
 
 class FIFOSizedQueue(object):
 
+    """
+    Fixed-size ring buffer, the oldest item is overwritten when putting an
+    item in a full queue.
+    Items are addressed by their sequence number (the count of items put in
+    the queue before them), which never changes while they are stored.
+    """
+
     def __init__(self, size):
-        self._list = list()
+        self._items = [None] * size
         self._size = size
+        self._count = 0
 
     def __len__(self):
-        return len(self._list)
+        return min(self._count, self._size)
 
     @property
     def size(self):
         return self._size
 
+    @property
+    def first(self):
+        """
+        Sequence number of the oldest item
+        """
+        return self._count - len(self)
+
+    @property
+    def next(self):
+        """
+        Sequence number of the next item
+        """
+        return self._count
+
     @property
     def list(self):
-        return self._list
+        return self.range(self.first, self._count)
 
     @property
     def is_full(self):
-        return len(self._list) >= self._size
+        return self._count >= self._size
+
+    def get(self, seq):
+        if not self.first <= seq < self._count:
+            raise IndexError('sequence {} not in queue'.format(seq))
+        return self._items[seq % self._size]
+
+    def range(self, start, stop):
+        """
+        Return the list of items from sequence `start` to `stop` (excluded)
+        """
+        start = max(start, self.first)
+        stop = min(stop, self._count)
+        if start >= stop:
+            return []
+        first, last = start % self._size, stop % self._size
+        if first < last:
+            return self._items[first:last]
+        return self._items[first:] + self._items[:last]
 
     def put(self, item):
-        while self.is_full:
-            log.debug('queue full (%d), poping first item', len(self._list))
-            self._list.pop(0)
-        self._list.append(item)
+        """
+        Add an item and return its sequence number
+        """
+        if self.is_full:
+            log.debug('queue full (%d), overwriting first item', self._size)
+        seq = self._count
+        self._items[seq % self._size] = item
+        self._count += 1
+        return seq
 
     def empty(self):
-        while self._list:
-            yield self._list.pop(0)
+        items = self.list
+        self._items = [None] * self._size
+        self._count = 0
+        yield from items
 
 
 class MemoryBackend(PersistenceBackend):
 
+    """
+    Events are kept in a ring buffer, indexed by uid and by status.
+    """
+
     def __init__(self, max_size=10000, **kwargs):
         self._last_events = FIFOSizedQueue(max_size)
+        self._uids = {}
+        self._statuses = defaultdict(set)
 
     def __repr__(self):
         return '<MemoryBackend max_size={}>'.format(self._last_events.size)
 
+    def _forget(self, seq):
+        """
+        Remove the indexes of the event about to be overwritten
+        """
+        event = self._last_events.get(seq)
+        if self._uids.get(event['id']) == seq:
+            del self._uids[event['id']]
+        self._statuses[event['status']].discard(seq)
+
     async def store(self, event):
-        self._last_events.put(event)
+        queue = self._last_events
+        if queue.is_full:
+            self._forget(queue.first)
+        seq = queue.put(event)
+        self._uids[event['id']] = seq
+        self._statuses[event['status']].add(seq)
 
     async def update(self, uid, status):
-        for event in self._last_events.list:
-            if event['id'] == uid:
-                event['status'] = status.value
-                return
+        try:
+            seq = self._uids[uid]
+        except KeyError:
+            return
+        event = self._last_events.get(seq)
+        self._statuses[event['status']].discard(seq)
+        event['status'] = status.value
+        self._statuses[event['status']].add(seq)
+
+    def _bisect(self, since):
+        """
+        Return the sequence number of the first event created at or after
+        `since` (events are stored in their creation order).
+        """
+        queue = self._last_events
+        low, high = queue.first, queue.next
+        while low < high:
+            middle = (low + high) // 2
+            if queue.get(middle)['created_at'] < since:
+                low = middle + 1
+            else:
+                high = middle
+        return low
 
     async def retrieve(self, since, status):
-        def check_params(item):
-            since_check = True
-            status_check = True
-
-            if since:
-                since_check = item['created_at'] >= since
-
-            if status:
-                if isinstance(status, list):
-                    status_check = EventStatus[item['status']] in status
-                else:
-                    status_check = item['status'] == status.value
-
-            return since_check and status_check
-        return list(filter(check_params, self._last_events.list))
+        queue = self._last_events
+        start = self._bisect(since) if since else queue.first
+
+        if not status:
+            return queue.range(start, queue.next)
+
+        if not isinstance(status, list):
+            status = [status]
+        values = {es.value for es in status}
+        indexed = sum(len(self._statuses[value]) for value in values)
+
+        # Scan whichever is smaller, the time range or the status indexes
+        if queue.next - start <= indexed:
+            return [
+                event for event in queue.range(start, queue.next)
+                if event['status'] in values
+            ]
+
+        sequences = sorted(
+            seq
+            for value in values
+            for seq in self._statuses[value]
+            if seq >= start
+        )
+        return [queue.get(seq) for seq in sequences]
@@ -1,10 +1,14 @@
+import asyncio
 import logging
+from collections import OrderedDict
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import InsertOne, UpdateOne
 from pymongo.errors import (
-    AutoReconnect, OperationFailure, ServerSelectionTimeoutError
+    AutoReconnect, BulkWriteError, OperationFailure,
+    ServerSelectionTimeoutError
 )
 
-from nyuki.bus.persistence.backend import PersistenceBackend
+from nyuki.bus.persistence.backend import EventChunks, PersistenceBackend
 
 
 log = logging.getLogger(__name__)
@@ -16,13 +20,29 @@ class MongoNotConnectedError(Exception):
 
 class MongoBackend(PersistenceBackend):
 
-    def __init__(self, name, host='localhost', ttl=3600, **kwargs):
+    """
+    Events and status updates are buffered in memory (write-behind) and
+    written using one `bulk_write` every `flush_interval` seconds, or as soon
+    as `flush_size` operations are waiting. A status update of a buffered
+    event is merged into it. A `flush_interval` of 0 writes immediately.
+    """
+
+    def __init__(self, name, host='localhost', ttl=3600, flush_interval=1.0,
+                 flush_size=500, **kwargs):
         self.name = name
         self.client = None
         self.db = None
         self.host = host
         self.ttl = ttl
         self._collection = None
+        # Write-behind buffer
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._loop = asyncio.get_event_loop()
+        self._inserts = OrderedDict()
+        self._updates = OrderedDict()
+        self._flush_handle = None
+        self._flush_lock = asyncio.Lock(loop=self._loop)
         # Options
         self._options = kwargs
 
@@ -55,22 +75,83 @@ class MongoBackend(PersistenceBackend):
             log.error('Could not index mongo fields')
             raise
 
+    @property
+    def buffered(self):
+        return len(self._inserts) + len(self._updates)
+
     async def store(self, event):
-        try:
-            await self._collection.insert(event)
-        except AutoReconnect:
-            log.error('Backend not available: %r', self)
+        self._inserts[event['id']] = event
+        await self._buffered_write()
+
+    async def store_many(self, events):
+        for event in events:
+            self._inserts[event['id']] = event
+        await self._buffered_write()
 
     async def update(self, uid, status):
+        self._buffer_update(uid, status)
+        await self._buffered_write()
+
+    async def update_many(self, updates):
+        for uid, status in updates:
+            self._buffer_update(uid, status)
+        await self._buffered_write()
+
+    def _buffer_update(self, uid, status):
         try:
-            await self._collection.update(
-                {'id': uid},
-                {'$set': {'status': status.value}}
+            # Event not written yet, no need for a second write
+            self._inserts[uid]['status'] = status.value
+        except KeyError:
+            self._updates[uid] = status.value
+
+    async def _buffered_write(self):
+        """
+        Flush the buffer if it is full, else make sure a flush is scheduled.
+        """
+        if not self.flush_interval or self.buffered >= self.flush_size:
+            await self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = self._loop.call_later(
+                self.flush_interval,
+                lambda: asyncio.ensure_future(self.flush(), loop=self._loop)
             )
-        except AutoReconnect:
-            log.error('Backend not available: %r', self)
 
-    async def retrieve(self, since=None, status=None):
+    async def flush(self):
+        """
+        Write all the buffered events and status updates in one bulk.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self.buffered:
+            return
+
+        requests = [InsertOne(event) for event in self._inserts.values()]
+        requests.extend(
+            UpdateOne({'id': uid}, {'$set': {'status': status}})
+            for uid, status in self._updates.items()
+        )
+        self._inserts = OrderedDict()
+        self._updates = OrderedDict()
+
+        # Ensure updates are never written before a previous insert
+        with await self._flush_lock:
+            try:
+                await self._collection.bulk_write(requests, ordered=False)
+            except AutoReconnect:
+                log.error(
+                    'Backend not available: %r (%d operations lost)',
+                    self, len(requests),
+                )
+            except BulkWriteError as exc:
+                log.error('Bulk write errors: %s', exc.details['writeErrors'])
+            else:
+                log.debug('%d operations written to %r', len(requests), self)
+
+    async def close(self):
+        await self.flush()
+
+    def _query(self, since, status):
         query = {}
         if since:
             query['created_at'] = {'$gte': since}
@@ -79,11 +160,48 @@ class MongoBackend(PersistenceBackend):
                 query['status'] = {'$in': [es.value for es in status]}
             else:
                 query['status'] = status.value
+        return query
 
-        cursor = self._collection.find(query)
+    async def retrieve(self, since=None, status=None):
+        await self.flush()
+        cursor = self._collection.find(self._query(since, status))
         cursor.sort('created_at')
 
         try:
             return await cursor.to_list(None)
         except AutoReconnect:
             log.error('Backend not available: %r', self)
+
+    async def count(self, since=None, status=None):
+        await self.flush()
+        try:
+            return await self._collection.count(self._query(since, status))
+        except AutoReconnect:
+            log.error('Backend not available: %r', self)
+            return 0
+
+    def stream(self, since, status, chunk_size):
+        """
+        Iterate over the events using a cursor, holding in memory only one
+        chunk of events at a time.
+        """
+        cursor = None
+
+        async def fetch():
+            nonlocal cursor
+            if cursor is None:
+                await self.flush()
+                cursor = self._collection.find(self._query(since, status))
+                cursor.sort('created_at').batch_size(chunk_size)
+
+            chunk = []
+            try:
+                while len(chunk) < chunk_size and (await cursor.fetch_next):
+                    chunk.append(cursor.next_object())
+            except AutoReconnect:
+                # A partial chunk would end the iteration as if complete
+                log.error('Backend not available: %r', self)
+                raise
+            return chunk
+
+        return EventChunks(fetch)
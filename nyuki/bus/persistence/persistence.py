@@ -56,6 +56,16 @@ class BusPersistence:
         event['created_at'] = utcnow()
         await self.backend.store(event)
 
+    async def store_many(self, events):
+        """
+        Store a list of bus events at once (see `store`)
+        """
+        log.debug('Storing %d new events', len(events))
+        now = utcnow()
+        for event in events:
+            event['created_at'] = now
+        await self.backend.store_many(events)
+
     async def update(self, uid, status):
         """
         Update the status of a stored event
@@ -63,9 +73,40 @@ class BusPersistence:
         log.debug("Updating status of event '%s' to '%s'", uid, status)
         await self.backend.update(uid, status)
 
+    async def update_many(self, updates):
+        """
+        Update the status of a list of stored events at once, from
+        (uid, status) pairs
+        """
+        log.debug('Updating status of %d events', len(updates))
+        await self.backend.update_many(updates)
+
     async def retrieve(self, since=None, status=None):
         """
         Return the list of events stored since the given datetime
         """
         log.debug('Retrieving events since %s, with status %s', since, status)
         return await self.backend.retrieve(since, status)
+
+    async def count(self, since=None, status=None):
+        """
+        Return the number of events stored since the given datetime
+        """
+        return await self.backend.count(since, status)
+
+    def stream(self, since=None, status=None, chunk_size=500):
+        """
+        Return an asynchronous iterator over the events stored since the
+        given datetime, by chunks of `chunk_size` events
+        """
+        log.debug(
+            'Streaming events since %s, with status %s (chunks of %d)',
+            since, status, chunk_size,
+        )
+        return self.backend.stream(since, status, chunk_size)
+
+    async def close(self):
+        """
+        Write anything the backend still holds in memory
+        """
+        await self.backend.close()
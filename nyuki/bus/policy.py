@@ -0,0 +1,70 @@
+import logging
+from collections import namedtuple
+
+from .encoding import JSON
+from .topics import TopicTree
+
+
+log = logging.getLogger(__name__)
+
+
+# A None QoS keeps the bus defaults (QoS 1 for the subscriptions, the client
+# default for the publications). Events of at least `compress` bytes are
+# compressed, see nyuki.bus.encoding
+TopicPolicy = namedtuple(
+    'TopicPolicy', ['qos', 'persistence', 'encoding', 'compress']
+)
+TopicPolicy.__new__.__defaults__ = (None, True, JSON, None)
+DEFAULT_POLICY = TopicPolicy()
+
+
+def specificity(pattern):
+    """
+    Sort key of the patterns, the most specific being the greatest:
+    more literal levels first, then '+' over '#', then the deepest.
+    """
+    levels = pattern.split('/')
+    literals = sum(1 for level in levels if level not in ('+', '#'))
+    return (literals, levels[-1] != '#', len(levels))
+
+
+class TopicPolicies(object):
+
+    """
+    QoS, persistence and encoding policy of the topics, configured by topic
+    pattern, e.g. to publish disposable telemetry events with QoS 0 and no
+    persistence. The most specific pattern wins when several of them match
+    the same topic, topics not matching any pattern get `DEFAULT_POLICY`.
+    The subscribers get different types depending on the encoding: datetimes
+    are decoded as datetimes from MessagePack but as ISO 8601 strings from
+    JSON, and non-string keys are kept from MessagePack but become strings
+    in JSON.
+    """
+
+    def __init__(self, patterns):
+        self._tree = TopicTree()
+        for pattern, policy in patterns.items():
+            self._tree.add(pattern, (specificity(pattern), TopicPolicy(
+                qos=policy.get('qos'),
+                persistence=policy.get('persistence', True),
+                encoding=policy.get('encoding', JSON),
+                compress=policy.get('compress'),
+            )))
+
+    def __bool__(self):
+        return len(self._tree) > 0
+
+    def get(self, topic):
+        """
+        Return the policy of a topic, or of a subscription pattern.
+        """
+        if topic in self._tree:
+            return next(iter(self._tree.get(topic)))[1]
+        policies = [
+            policy
+            for matched in self._tree.match(topic)
+            for policy in matched
+        ]
+        if not policies:
+            return DEFAULT_POLICY
+        return max(policies, key=lambda policy: policy[0])[1]
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+from collections import namedtuple
+
+
+log = logging.getLogger(__name__)
+
+
+QueuedEvent = namedtuple('QueuedEvent', ['uid', 'topic', 'message', 'stored'])
+
+
+class PublishQueue(object):
+
+    """
+    Opt-in outgoing queue of the bus, sending events by batches.
+    A batch is flushed as soon as it holds `batch_size` events, or once its
+    first event waited for `linger` seconds. Putting an event in a full queue
+    blocks the publisher until a batch is flushed (backpressure).
+    `label` names the queued items in the logs.
+    """
+
+    def __init__(self, flush, size=1000, batch_size=100, linger=0.05,
+                 label='bus events', loop=None):
+        self._flush_batch = flush
+        self.label = label
+        self._loop = loop or asyncio.get_event_loop()
+        self._queue = asyncio.Queue(maxsize=size, loop=self._loop)
+        self.batch_size = batch_size
+        self.linger = linger
+        self._run_future = None
+        # Batch being gathered and batch being flushed
+        self._batch = []
+        self._flushing = None
+
+        # Metrics
+        self._flushes = 0
+        self._flushed_events = 0
+        self._last_latency = None
+        self._max_latency = 0.0
+
+    def __repr__(self):
+        return '<PublishQueue size={} batch_size={} linger={}>'.format(
+            self._queue.maxsize, self.batch_size, self.linger
+        )
+
+    @property
+    def stats(self):
+        return {
+            'depth': self._queue.qsize(),
+            'size': self._queue.maxsize,
+            'batch_size': self.batch_size,
+            'linger': self.linger,
+            'flushes': self._flushes,
+            'flushed_events': self._flushed_events,
+            'last_flush_latency': self._last_latency,
+            'max_flush_latency': self._max_latency,
+        }
+
+    def start(self):
+        if self._run_future is None:
+            self._run_future = asyncio.ensure_future(
+                self._run(), loop=self._loop
+            )
+
+    async def stop(self):
+        """
+        Stop the flushing loop and send what remains in the queue.
+        """
+        if self._run_future is not None:
+            self._run_future.cancel()
+            self._run_future = None
+        if self._flushing is not None:
+            await self._flushing
+
+        while self._batch or not self._queue.empty():
+            while not self._queue.empty() and len(self._batch) < self.batch_size:
+                self._batch.append(self._queue.get_nowait())
+            batch, self._batch = self._batch, []
+            await self._flush(batch)
+
+    async def put(self, event):
+        """
+        Queue an event, wait for a free slot if the queue is full.
+        """
+        await self._queue.put(event)
+
+    async def _next_batch(self):
+        """
+        Wait for the first event, then gather events until the batch is full
+        or the linger time is elapsed.
+        """
+        self._batch.append(await self._queue.get())
+        deadline = self._loop.time() + self.linger
+        while len(self._batch) < self.batch_size:
+            if not self._queue.empty():
+                self._batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - self._loop.time()
+            if timeout <= 0:
+                break
+            try:
+                self._batch.append(await asyncio.wait_for(
+                    self._queue.get(), timeout, loop=self._loop
+                ))
+            except asyncio.TimeoutError:
+                break
+        batch, self._batch = self._batch, []
+        return batch
+
+    async def _flush(self, batch):
+        start = self._loop.time()
+        try:
+            await self._flush_batch(batch)
+        except Exception as exc:
+            log.error(
+                'Could not flush %d %s: %s', len(batch), self.label, exc
+            )
+            return
+
+        latency = self._loop.time() - start
+        self._flushes += 1
+        self._flushed_events += len(batch)
+        self._last_latency = latency
+        self._max_latency = max(self._max_latency, latency)
+        log.debug(
+            'Flushed %d %s in %.3fs', len(batch), self.label, latency
+        )
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            # Shielded so that stopping the queue never drops a batch
+            self._flushing = asyncio.ensure_future(
+                self._flush(batch), loop=self._loop
+            )
+            await asyncio.shield(self._flushing, loop=self._loop)
+            self._flushing = None
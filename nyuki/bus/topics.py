@@ -0,0 +1,133 @@
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+def is_pattern(topic):
+    """
+    Patterns are about topics like 'word/+/word' or 'word/#'
+    """
+    return '+' in topic or topic.endswith('#')
+
+
+class _TopicNode(object):
+
+    __slots__ = ('children', 'callbacks')
+
+    def __init__(self):
+        self.children = {}
+        self.callbacks = None
+
+
+class TopicTree(object):
+
+    """
+    Segment-based trie of MQTT topic patterns (using '+' and '#' wildcards).
+    Matching a topic costs O(topic depth), whatever the number of
+    patterns stored in the tree.
+        - '+' matches exactly one non-empty level
+        - '#' matches any non-empty remainder of the topic
+    """
+
+    def __init__(self):
+        self._root = _TopicNode()
+        # Direct access to the callbacks set of each pattern
+        self._patterns = {}
+
+    def __contains__(self, pattern):
+        return pattern in self._patterns
+
+    def __iter__(self):
+        return iter(self._patterns)
+
+    def __len__(self):
+        return len(self._patterns)
+
+    def keys(self):
+        return self._patterns.keys()
+
+    def get(self, pattern):
+        """
+        Return the set of callbacks registered for this pattern.
+        """
+        return self._patterns[pattern]
+
+    def add(self, pattern, callback):
+        """
+        Register a callback for a pattern.
+        Return True if this pattern was not in the tree yet.
+        """
+        try:
+            self._patterns[pattern].add(callback)
+            return False
+        except KeyError:
+            pass
+
+        node = self._root
+        for level in pattern.split('/'):
+            try:
+                node = node.children[level]
+            except KeyError:
+                node.children[level] = node = _TopicNode()
+        node.callbacks = {callback}
+        self._patterns[pattern] = node.callbacks
+        return True
+
+    def discard(self, pattern, callback=None):
+        """
+        Remove a callback from a pattern, or the whole pattern if the callback
+        is None or if it was the last one.
+        Return True if the pattern has been removed from the tree.
+        """
+        callbacks = self._patterns.get(pattern)
+        if callbacks is None:
+            return False
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if callback is not None and callbacks:
+            return False
+
+        # Remove the pattern and prune the now empty branches
+        del self._patterns[pattern]
+        path = [self._root]
+        levels = pattern.split('/')
+        for level in levels:
+            path.append(path[-1].children[level])
+        path[-1].callbacks = None
+        for index in range(len(levels), 0, -1):
+            node = path[index]
+            if node.children or node.callbacks is not None:
+                break
+            del path[index - 1].children[levels[index - 1]]
+        return True
+
+    def match(self, topic):
+        """
+        Return the list of callbacks sets whose pattern matches the topic.
+        """
+        levels = topic.split('/')
+        depth = len(levels)
+        matches = []
+        stack = [(self._root, 0)]
+        while stack:
+            node, index = stack.pop()
+            # '#' requires a non-empty remainder
+            multi = node.children.get('#')
+            if multi is not None and multi.callbacks is not None:
+                if index < depth and (index < depth - 1 or levels[index]):
+                    matches.append(multi.callbacks)
+            if index == depth:
+                if node.callbacks is not None and node is not self._root:
+                    matches.append(node.callbacks)
+                continue
+
+            level = levels[index]
+            child = node.children.get(level)
+            if child is not None:
+                stack.append((child, index + 1))
+            if level:
+                single = node.children.get('+')
+                if single is not None:
+                    stack.append((single, index + 1))
+        return matches
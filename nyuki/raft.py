@@ -1,4 +1,3 @@
-import json
 import math
 import socket
 import logging
@@ -9,6 +8,7 @@ from random import uniform
 
 from nyuki.services import Service
 from nyuki.api import Response, resource
+from nyuki.utils import json_dumps
 
 
 log = logging.getLogger(__name__)
@@ -130,7 +130,7 @@ class RaftProtocol(Service):
         request = {
             'url': 'http://{host}:5558/v1/raft'.format(host=ipv4),
             'headers': {'Content-Type': 'application/json'},
-            'data': json.dumps(data or {})
+            'data': json_dumps(data or {})
         }
         try:
             async with aiohttp.ClientSession() as session:
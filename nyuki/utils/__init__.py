@@ -1,3 +1,4 @@
+from .codec import json_encode, json_dumps, json_loads
 from .dtutils import from_isoformat, utcnow
 from .evaluate import safe_eval, ConditionBlock
 from .serialize import serialize_object
@@ -0,0 +1,110 @@
+"""
+JSON codec of the bus, the API and the persistence.
+orjson is used when it is installed, with the standard json module as a
+fallback (and for the few objects orjson refuses, e.g. integers larger than
+64 bits). Unknown objects are converted using `serialize_object` either way.
+
+The backends differ on non-finite floats: orjson encodes NaN and infinities
+as null, the json module as the non-standard NaN/Infinity literals. These
+literals are decoded into floats whatever the backend (orjson rejects them,
+such documents are decoded again by the json module).
+"""
+import json
+import logging
+
+from .serialize import serialize_object
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+log = logging.getLogger(__name__)
+
+
+# orjson decodes the integers out of the 64 bits range as floats (losing
+# precision), documents with such a literal (at least 19 digits, the shortest
+# out of range being -2**63 - 1) are decoded by the json module. They are
+# spotted by translating the digits to '0' and anything else to ' ', which
+# is several times faster than a regular expression.
+_DIGITS = bytes(
+    ord('0') if ord('0') <= byte <= ord('9') else ord(' ')
+    for byte in range(256)
+)
+_BIG_INT = b'0' * 19
+
+
+def _has_big_int(data):
+    if isinstance(data, str):
+        data = data.encode()
+    elif isinstance(data, memoryview):
+        data = bytes(data)
+    return _BIG_INT in data.translate(_DIGITS)
+
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def json_encode(obj):
+        """
+        Serialize an object into UTF-8 encoded JSON.
+        """
+        try:
+            return orjson.dumps(
+                obj, default=serialize_object, option=_ORJSON_OPTIONS
+            )
+        except TypeError:
+            return _json_dumps(obj).encode()
+
+    def json_dumps(obj):
+        """
+        Serialize an object into a JSON string.
+        """
+        return json_encode(obj).decode()
+
+    def json_loads(data):
+        """
+        Deserialize JSON from bytes or str.
+        """
+        if _has_big_int(data):
+            return _json_loads(data)
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # NaN/Infinity literals, raises again if the JSON is invalid
+            return _json_loads(data)
+
+else:
+
+    def json_encode(obj):
+        """
+        Serialize an object into UTF-8 encoded JSON.
+        """
+        return _json_dumps(obj).encode()
+
+    def json_dumps(obj):
+        """
+        Serialize an object into a JSON string.
+        """
+        return _json_dumps(obj)
+
+    def json_loads(data):
+        """
+        Deserialize JSON from bytes or str.
+        """
+        return _json_loads(data)
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, default=serialize_object, separators=(',', ':'))
+
+
+def _json_loads(data):
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data).decode()
+    return json.loads(data)
+
+
+JSON_BACKEND = 'orjson' if orjson is not None else 'json'
+log.debug('JSON codec backend: %s', JSON_BACKEND)
@@ -1,6 +1,7 @@
 import re
 import ast
 from collections import defaultdict
+from functools import lru_cache
 import logging
 
 
@@ -41,6 +42,14 @@ CONTEXTS = [ast.Load]
 AUTHORIZED_TYPES = EXPRESSIONS + OPERATORS + CONTEXTS
 
 
+# /!\ This regex forbids the use of ' and " in a string
+# See https://regex101.com/r/hUueag/7
+CONDITION_REGEX = re.compile(
+    r' *(and|or)? *\( *(@\S*|None|True|False|[\"\'\[][^\'\"]*[\'\"\]]|\d+) +([=<>!]=?|not in|in|not) +(@\S*|None|True|False|[\"\'\[][^\'\"]*[\'\"\]]|\d+) *\) *'
+)
+VARIABLE_REGEX = re.compile(r'^@(?P<var_name>\w+)$')
+
+
 def safe_eval(expr):
     """
     Ensures an expression only defines authorized operations (no call to
@@ -53,6 +62,87 @@ def safe_eval(expr):
     return bool(eval(expr))
 
 
+class CompiledCondition:
+
+    """
+    Condition string compiled once into a function of its `@variables`.
+    Variables are read from the data dict at evaluation, with no parsing
+    nor formatting of the condition.
+    Invalid conditions only raise when evaluated.
+    """
+
+    __slots__ = ('condition', 'expression', 'variables', '_func', '_error')
+
+    def __init__(self, condition):
+        self.condition = condition
+        self.variables = []
+        self._func = None
+        self._error = None
+        self.expression = self._clean(condition)
+        try:
+            self._func = self._compile()
+        except (SyntaxError, TypeError) as exc:
+            # Type and arguments only, raising the same exception instance
+            # again would chain the frames (and data) of every evaluation
+            self._error = (type(exc), exc.args)
+
+    def _clean(self, condition):
+        """
+        Format the condition string (as eval-compliant code), replacing the
+        `@variable_name` operands by the arguments of the compiled function.
+        """
+        match = CONDITION_REGEX.findall(condition)
+        if not match:
+            return condition
+
+        def operand(value):
+            var = VARIABLE_REGEX.match(value)
+            if var is None:
+                return value
+            self.variables.append(var.group('var_name'))
+            return '_{}'.format(len(self.variables) - 1)
+
+        # Reconstruct a cleaned string from the operation parts.
+        cleaned = ''
+        for andor, left, operator, right in match:
+            cleaned += '{}({} {} {})'.format(
+                andor, operand(left), operator, operand(right)
+            )
+        return cleaned
+
+    def _compile(self):
+        args = ['_{}'.format(i) for i in range(len(self.variables))]
+        tree = ast.parse(self.expression, mode='eval').body
+        for node in ast.walk(tree):
+            if type(node) in AUTHORIZED_TYPES:
+                continue
+            # Function arguments are the only names allowed
+            if isinstance(node, ast.Name) and node.id in args:
+                continue
+            raise TypeError("forbidden type {} found in {}".format(
+                node, self.expression
+            ))
+        return eval(
+            'lambda {}: {}'.format(', '.join(args), self.expression),
+            {'__builtins__': {}}
+        )
+
+    def __call__(self, data):
+        if self._error is not None:
+            error, args = self._error
+            raise error(*args)
+        return bool(self._func(*[data.get(var) for var in self.variables]))
+
+
+@lru_cache(maxsize=1024)
+def compile_condition(condition):
+    """
+    Blocks are created on each execution, the same conditions are compiled
+    only once.
+    """
+    return CompiledCondition(condition)
+
+
 class ConditionBlock:
 
     def __init__(self, conditions):
@@ -74,39 +164,11 @@ class ConditionBlock:
                 raise TypeError("last condition must be 'elif' or 'else',"
                                 " got '{}'".format(conditions[-1]))
         self._conditions = conditions
-
-    def _clean_condition(self, condition, data):
-        """
-        Format the condition string (as eval-compliant code).
-        nb: variable replacement should be `@variable_name` formatted.
-        """
-        # /!\ This regex forbids the use of ' and " in a string
-        # See https://regex101.com/r/hUueag/7
-        match = re.findall(
-            r' *(and|or)? *\( *(@\S*|None|True|False|[\"\'\[][^\'\"]*[\'\"\]]|\d+) +([=<>!]=?|not in|in|not) +(@\S*|None|True|False|[\"\'\[][^\'\"]*[\'\"\]]|\d+) *\) *',
-            condition
-        )
-        if not match:
-            return condition
-
-        def replace(match):
-            key = match.group('var_name')
-            value = data.get(key)
-            placeholder = '{!r}' if isinstance(value, str) else '{}'
-            return placeholder.format(value)
-
-        # Reconstruct a cleaned string from the operation parts.
-        cleaned = ''
-        for operation in match:
-            # Get 'and' or 'or' operation
-            andor = operation[0]
-            # Restructure condition string, striping any trailing space
-            ops = []
-            ops.append(re.sub(r'^@(?P<var_name>\w+)$', replace, operation[1]))
-            ops.append(operation[2])
-            ops.append(re.sub(r'^@(?P<var_name>\w+)$', replace, operation[3]))
-            cleaned += '{}({})'.format(andor, ' '.join(ops))
-        return cleaned
+        self._compiled = [
+            compile_condition(condition['condition'])
+            if condition['type'] != 'else' else None
+            for condition in conditions
+        ]
 
     def condition_validated(self, condition, data):
         """
@@ -119,18 +181,17 @@ class ConditionBlock:
         """
         Iterate through the conditions and stop at first validated condition.
         """
-        for condition in self._conditions:
+        for condition, compiled in zip(self._conditions, self._compiled):
             # If type 'else', set given next tasks and leave
             if condition['type'] == 'else':
                 self.condition_validated(condition['rules'], data)
                 return
-            # Else find the condition and evaluate it
-            cleaned = self._clean_condition(condition['condition'], data)
-            log.debug('arithmetics: trying %s', cleaned)
-            if safe_eval(cleaned):
+            # Else evaluate the compiled condition
+            log.debug('arithmetics: trying %s', compiled.expression)
+            if compiled(data):
                 log.debug(
                     'arithmetics: validated condition "%s" as "%s"',
-                    condition, cleaned
+                    condition, compiled.expression
                 )
                 self.condition_validated(condition['rules'], data)
                 return
@@ -1,6 +1,7 @@
 import logging
 import operator
 import re
+from collections.abc import MutableMapping
 from copy import deepcopy
 
 from .evaluate import ConditionBlock
@@ -70,6 +71,88 @@ class TraceableDict(dict):
         return self._changes
 
 
+class ChangeTracker(MutableMapping):
+
+    """
+    Dict proxy applying changes in place on the wrapped dict while tracking
+    them, with the same format as `TraceableDict`.
+    Unlike `TraceableDict`, the input dict is never copied: only the values of
+    the modified keys are, and the replaced values are kept aside to roll the
+    dict back if the rule fails.
+    With `record=False`, only the rollback information is kept.
+    """
+
+    def __init__(self, data, record=True):
+        self._data = data
+        self._record = record
+        self._changes = []
+        self._undo = []
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __setitem__(self, key, value):
+        data = self._data
+        if not self._record:
+            if key in data:
+                self._undo.append((key, True, data[key]))
+            else:
+                self._undo.append((key, False, None))
+        elif key not in data:
+            self._changes.append({
+                'action': 'add',
+                'key': key,
+                'value': deepcopy(value)
+            })
+            self._undo.append((key, False, None))
+        else:
+            old_value = data[key]
+            if old_value != value:
+                self._changes.append({
+                    'action': 'update',
+                    'key': key,
+                    'old_value': deepcopy(old_value),
+                    'new_value': deepcopy(value)
+                })
+            self._undo.append((key, True, old_value))
+        data[key] = value
+
+    def __delitem__(self, key):
+        old_value = self._data[key]
+        if self._record:
+            self._changes.append({
+                'action': 'remove',
+                'key': key,
+                'value': deepcopy(old_value)
+            })
+        self._undo.append((key, True, old_value))
+        del self._data[key]
+
+    def rollback(self):
+        """
+        Restore the wrapped dict as it was before any change.
+        """
+        for key, existed, old_value in reversed(self._undo):
+            if existed:
+                self._data[key] = old_value
+            else:
+                self._data.pop(key, None)
+        self._undo = []
+
+    @property
+    def changes(self):
+        return self._changes
+
+
 # Inspired from https://github.com/faif/python-patterns/blob/master/registry.py
 class _RegisteredRule(type):
     """
@@ -126,12 +209,19 @@ class Converter(object):
             rules.append(rule_cls(**params))
         return cls(rules=rules)
 
-    def apply(self, data):
+    def apply(self, data, track=True):
+        """
+        Apply the rules on `data` and return the diff of their changes.
+        If `track` is False, changes are not recorded and the diff only
+        reports the rules in error.
+        """
         diff = {'rules': []}
         for rule in self.rules:
-            rule_diff = rule.apply(data)
+            rule_diff = rule.apply(data, track=track)
+            if rule_diff is None:
+                continue
             diff['rules'].append(rule_diff)
-            if rule_diff is not None and 'error' in rule_diff:
+            if 'error' in rule_diff:
                 diff['error'] = True
         return diff
 
@@ -143,16 +233,23 @@ class FactoryConditionBlock(ConditionBlock, metaclass=_RegisteredRule):
     def __init__(self, conditions):
         super().__init__(conditions)
         self._changes = {'type': self.TYPENAME, 'conditions': []}
+        self._track = True
 
     def condition_validated(self, rules, data):
         """
         Apply rules on data upon validating a condition.
         """
-        diff = Converter.from_dict({'rules': rules}).apply(data)
+        diff = Converter.from_dict({'rules': rules}).apply(
+            data, track=self._track
+        )
         self._changes['conditions'] = diff['rules']
 
-    def apply(self, data):
+    def apply(self, data, track=True):
+        self._track = track
+        self._changes['conditions'] = []
         super().apply(data)
+        if not track and not self._changes['conditions']:
+            return None
         return self._changes
 
 
@@ -184,35 +281,37 @@ class _Rule(metaclass=_RegisteredRule):
         """
         Decorator for `Rule.apply(<data>)` methods that return a JSON-formatted
         diff of the changes made by the method itself.
+        If `track` is False, nothing is returned unless the rule failed.
         """
-        def wrapper(self, data):
-            # Handle data through a traceable dict
-            tracker = TraceableDict(data)
+        def wrapper(self, data, track=True):
+            # Changes are applied in place and tracked
+            tracker = ChangeTracker(data, record=track)
             try:
                 func(self, tracker)
             except RegexpRuleError as exc:
-                return {
-                    'type': self.TYPENAME, 'changes': tracker.changes,
-                    'error': 'regexp_rule_error', 'error_details': str(exc)
-                }
+                error, details = 'regexp_rule_error', str(exc)
             except ArithmeticRuleError as exc:
-                return {
-                    'type': self.TYPENAME, 'changes': tracker.changes,
-                    'error': 'arithmetic_rule_error', 'error_details': str(exc)
-                }
+                error, details = 'arithmetic_rule_error', str(exc)
             except UnionRuleError as exc:
-                return {
-                    'type': self.TYPENAME, 'changes': tracker.changes,
-                    'error': 'union_rule_error', 'error_details': str(exc)
-                }
-            # We want to keep the object reference
-            data.clear()
-            data.update(tracker)
-            return {'type': self.TYPENAME, 'changes': tracker.changes}
+                error, details = 'union_rule_error', str(exc)
+            except Exception:
+                tracker.rollback()
+                raise
+            else:
+                if not track:
+                    return None
+                return {'type': self.TYPENAME, 'changes': tracker.changes}
+
+            # A failing rule leaves the data untouched
+            tracker.rollback()
+            return {
+                'type': self.TYPENAME, 'changes': tracker.changes,
+                'error': error, 'error_details': details
+            }
 
         return wrapper
 
-    def apply(self, data):
+    def apply(self, data, track=True):
         """
         Execute an operation on one field of the dict `data` and returns an
         diff.
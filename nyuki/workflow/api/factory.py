@@ -358,3 +358,24 @@ class ApiFactoryLookupCSV:
                     'error': str(exc),
                     'code': 'UNICODE_ENCODING_ERROR'
                 })
+
+
+@resource('/workflow/cache', versions=['v1'])
+class ApiFactoryCache:
+
+    async def get(self, request):
+        """
+        Return the statistics of the regexes and lookup tables caches
+        """
+        return Response({
+            'regexes': self.nyuki.storage.regexes.cache_stats,
+            'lookups': self.nyuki.storage.lookups.cache_stats,
+        })
+
+    async def delete(self, request):
+        """
+        Empty the caches, the rules are read again from the database
+        """
+        self.nyuki.storage.regexes.clear_cache()
+        self.nyuki.storage.lookups.clear_cache()
+        return Response(status=204)
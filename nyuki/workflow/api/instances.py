@@ -8,7 +8,9 @@ from tukio.workflow import (
 )
 from pymongo.errors import AutoReconnect
 
-from nyuki.api import Response, resource, content_type, HTTPBreak
+from nyuki.api import (
+    Response, StreamResponse, resource, content_type, HTTPBreak
+)
 from nyuki.utils import from_isoformat
 from nyuki.workflow.tasks.utils.uri import URI, InvalidWorkflowUri
 from nyuki.workflow.db.workflow_instances import Ordering
@@ -90,7 +92,19 @@ class ApiWorkflows(_WorkflowResource):
         if exec:
             # Suspended/crashed instance
             # The request's payload is the last known execution report
-            templates = [request]
+            template = {
+                **{
+                    key: value
+                    for key, value in request.items()
+                    if key != 'exec'
+                },
+                'tasks': [
+                    {key: value for key, value in task.items() if key != 'exec'}
+                    for task in request['tasks']
+                ]
+            }
+            requester = requester or exec.get('requester')
+            exec_track = exec_track or ','.join(exec.get('track') or [])
             if exec['id'] in self.nyuki.running_workflows:
                 return Response(status=400, body={
                     'error': 'This workflow is already being rescued'
@@ -122,6 +136,13 @@ class ApiWorkflows(_WorkflowResource):
         elif draft:
             wflow = await self.nyuki.engine.run_once(wf_tmpl, data)
         else:
+            selector = self.nyuki.engine.selector
+            if selector.get(wf_tmpl.uid) is None:
+                # Published by another nyuki since the last selector sync
+                try:
+                    await selector.refresh(wf_tmpl.uid)
+                except AutoReconnect:
+                    return Response(status=503)
             wflow = await self.nyuki.engine.trigger(wf_tmpl.uid, data)
 
         if wflow is None:
@@ -287,8 +308,13 @@ class ApiWorkflowsHistory:
             * `state` return the workflows on this FutureState
             * `offset` return the worflows from this offset
             * `limit` return this amount of workflows
+            * `after` return the workflows following this cursor, as
+              returned in `next` when `limit` workflows were returned
             * `order` order results following the Ordering enum values
-            * `search` search templates with specific title
+            * `search` return the workflows whose title has words starting
+              with each word of the search (case and accents ignored), no
+              workflow if the search has no word (e.g. only punctuation)
+            * `count` 0 to skip counting the total of workflows
         """
         # Filter on start date
         since = request.GET.get('since')
@@ -335,18 +361,37 @@ class ApiWorkflowsHistory:
                     'error': 'Ordering must be in {}'.format(Ordering.keys())
                 })
 
+        kwargs = {
+            'root': request.GET.get('root') == '1',
+            'full': request.GET.get('full') == '1',
+            'search': request.GET.get('search'),
+            'order': order,
+            'offset': offset,
+            'limit': limit,
+            'since': since,
+            'state': state,
+            'after': request.GET.get('after'),
+            'count': request.GET.get('count') != '0',
+        }
         try:
-            count, history = await self.nyuki.storage.get_history(
-                root=(request.GET.get('root') == '1'),
-                full=(request.GET.get('full') == '1'),
-                search=request.GET.get('search'),
-                order=order,
-                offset=offset, limit=limit, since=since, state=state,
+            # Unlimited listings are streamed (no next page)
+            if not limit:
+                count, history = await self.nyuki.storage.stream_history(
+                    **kwargs
+                )
+                await history.prefetch()
+                return StreamResponse(
+                    history, head={'count': count, 'next': None}, key='data'
+                )
+            count, history, cursor = await self.nyuki.storage.get_history(
+                **kwargs
             )
+        except ValueError as exc:
+            return Response(status=400, body={'error': str(exc)})
         except AutoReconnect:
             return Response(status=503)
 
-        data = {'count': count, 'data': history}
+        data = {'count': count, 'data': history, 'next': cursor}
         return Response(data)
 
 
@@ -393,6 +438,18 @@ class ApiWorkflowHistoryTaskData:
         return Response(task)
 
 
+@resource('/workflow/archive', versions=['v1'])
+class ApiWorkflowArchive:
+
+    async def get(self, request):
+        """
+        Return the metrics of the queue of workflows to store in the history
+        """
+        if self.nyuki.archiver is None:
+            return Response(status=404)
+        return Response(self.nyuki.archiver.stats)
+
+
 @resource('/workflow/triggers', versions=['v1'])
 class ApiWorkflowTriggers:
 
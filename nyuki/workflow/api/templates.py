@@ -2,7 +2,7 @@ import logging
 from pymongo.errors import AutoReconnect, DuplicateKeyError
 from tukio.workflow import TemplateGraphError, WorkflowTemplate
 
-from nyuki.api import Response, resource
+from nyuki.api import Response, StreamResponse, resource
 from nyuki.workflow.validation import validate, TemplateError
 from nyuki.workflow.db.workflow_templates import TemplateState
 
@@ -68,13 +68,14 @@ class ApiTemplates(_TemplateResource):
         """
         Return available workflows' DAGs
         """
+        templates = self.nyuki.storage.stream_templates(
+            full=(request.GET.get('full') == '1'),
+        )
         try:
-            templates = await self.nyuki.storage.get_templates(
-                full=(request.GET.get('full') == '1'),
-            )
+            await templates.prefetch()
         except AutoReconnect:
             return Response(status=503)
-        return Response(templates)
+        return StreamResponse(templates)
 
     async def put(self, request):
         """
@@ -180,6 +181,10 @@ class ApiTemplate(_TemplateResource):
             'title': request.get('title'),
             'tags': request.get('tags', []),
         })
+        try:
+            await self.nyuki.engine.selector.refresh(tid)
+        except AutoReconnect:
+            return Response(status=503)
 
         return Response(metadata)
 
@@ -197,6 +202,10 @@ class ApiTemplate(_TemplateResource):
             return Response(status=404)
 
         await self.nyuki.storage.delete_template(tid)
+        try:
+            await self.nyuki.engine.selector.refresh(tid)
+        except AutoReconnect:
+            return Response(status=503)
         return Response(templates)
 
 
@@ -258,6 +267,10 @@ class ApiTemplateDraft(_TemplateResource):
 
         # Update draft into a new template
         await self.nyuki.storage.publish_draft(tid)
+        try:
+            await self.nyuki.engine.selector.refresh(tid)
+        except AutoReconnect:
+            return Response(status=503)
         tmpl_dict['state'] = TemplateState.ACTIVE.value
         return Response(tmpl_dict)
 
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+from datetime import datetime
+from itertools import islice
+from collections.abc import Mapping
+from pymongo.errors import AutoReconnect
+
+from nyuki.bus.publisher import PublishQueue
+
+
+log = logging.getLogger(__name__)
+SCALAR_TYPES = (str, int, float, bool, type(None), datetime)
+# Exact types, checked first as most of the values are plain scalars
+_SCALARS = frozenset(SCALAR_TYPES)
+
+
+def sanitize_workflow_exec(obj):
+    """
+    Return a version of a workflow report that can be stored in Mongo: any
+    unknown object is replaced by an 'internal data' string and mapping keys
+    are turned into strings.
+    The report is never modified (its template is shared with the running
+    workflows), containers are only copied when one of their items changed.
+    """
+    if type(obj) in _SCALARS or isinstance(obj, SCALAR_TYPES):
+        return obj
+
+    if isinstance(obj, Mapping):
+        copy = None
+        index = 0
+        for key, value in obj.items():
+            if type(value) not in _SCALARS or type(key) is not str:
+                new_key = key if isinstance(key, str) else str(key)
+                new_value = sanitize_workflow_exec(value)
+                if copy is None and (new_key is not key or
+                                     new_value is not value):
+                    # First change, copy the items seen so far
+                    copy = dict(islice(obj.items(), index))
+                key, value = new_key, new_value
+            if copy is not None:
+                copy[key] = value
+            index += 1
+        if copy is None and type(obj) is not dict:
+            return dict(obj)
+        return obj if copy is None else copy
+
+    if isinstance(obj, (list, tuple)):
+        copy = None
+        index = 0
+        for item in obj:
+            if type(item) not in _SCALARS:
+                new_item = sanitize_workflow_exec(item)
+                if copy is None and new_item is not item:
+                    copy = list(obj[:index])
+                item = new_item
+            if copy is not None:
+                copy.append(item)
+            index += 1
+        return obj if copy is None else copy
+
+    return 'Internal server data: {}'.format(type(obj))
+
+
+def _sanitize_batch(batch):
+    return [sanitize_workflow_exec(instance) for _, instance in batch]
+
+
+class HistoryArchiver(object):
+
+    """
+    Bounded queue of the finished workflow instances waiting to be stored in
+    the history, written with one bulk per collection for a whole batch of
+    instances (see `PublishQueue`). Reports are sanitized in a worker thread
+    before being written.
+    A batch failing because Mongo is not reachable is retried `retries` times,
+    waiting `retry_delay` seconds the first time and twice longer each time.
+    """
+
+    def __init__(self, storage, size=1000, batch_size=100, linger=0.5,
+                 retries=5, retry_delay=0.5, loop=None):
+        self._storage = storage
+        self._loop = loop or asyncio.get_event_loop()
+        self._queue = PublishQueue(
+            self._archive, size=size, batch_size=batch_size, linger=linger,
+            label='workflow instances', loop=self._loop
+        )
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        # Metrics
+        self._archived = 0
+        self._lost = 0
+        self._retried = 0
+        self._last_lag = None
+        self._max_lag = 0.0
+
+    def __repr__(self):
+        return '<HistoryArchiver size={} batch_size={} retries={}>'.format(
+            self._queue.stats['size'], self._queue.batch_size, self.retries
+        )
+
+    @property
+    def stats(self):
+        """
+        The archive lag is the time between the queueing of an instance and
+        the end of its insert.
+        """
+        queue = self._queue.stats
+        return {
+            'depth': queue['depth'],
+            'size': queue['size'],
+            'batch_size': queue['batch_size'],
+            'linger': queue['linger'],
+            'archived': self._archived,
+            'lost': self._lost,
+            'retried': self._retried,
+            'last_archive_lag': self._last_lag,
+            'max_archive_lag': self._max_lag,
+        }
+
+    def start(self):
+        self._queue.start()
+
+    async def stop(self):
+        """
+        Stop archiving after writing what remains in the queue.
+        """
+        await self._queue.stop()
+
+    async def put(self, instance):
+        """
+        Queue the report of a finished workflow, wait for a free slot if the
+        queue is full.
+        """
+        await self._queue.put((self._loop.time(), instance))
+
+    async def _insert(self, instances):
+        """
+        Insert instances, retrying while Mongo is not reachable.
+        """
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                await self._storage.insert_instances(instances)
+                return
+            except AutoReconnect:
+                if attempt == self.retries:
+                    raise
+                log.warning(
+                    'Mongo not reachable, retrying to archive %d workflow '
+                    'instances in %.1fs', len(instances), delay,
+                )
+                self._retried += 1
+                await asyncio.sleep(delay, loop=self._loop)
+                delay *= 2
+
+    async def _archive(self, batch):
+        """
+        Archive a batch, every failure is logged and counted as lost here.
+        """
+        try:
+            instances = await self._loop.run_in_executor(
+                None, _sanitize_batch, batch
+            )
+        except Exception:
+            log.exception(
+                'Could not sanitize %d workflow instances', len(batch)
+            )
+            self._lost += len(batch)
+            return
+
+        archived = len(instances)
+        try:
+            await self._insert(instances)
+        except AutoReconnect as exc:
+            log.error(
+                'Could not archive %d workflow instances: %s',
+                len(instances), exc,
+            )
+            self._lost += len(instances)
+            return
+        except Exception as exc:
+            # A single report Mongo refuses (too large, integer out of
+            # range...) must not lose the whole batch. Documents already
+            # inserted by the bulk are ignored.
+            log.warning(
+                'Could not archive %d workflow instances at once (%s), '
+                'archiving them one by one', len(instances), exc,
+            )
+            archived = 0
+            for instance in instances:
+                try:
+                    await self._insert([instance])
+                except Exception:
+                    log.exception(
+                        'Could not archive workflow instance %s',
+                        instance.get('id'),
+                    )
+                    self._lost += 1
+                else:
+                    archived += 1
+
+        now = self._loop.time()
+        self._archived += archived
+        self._last_lag = now - batch[-1][0]
+        self._max_lag = max(self._max_lag, now - batch[0][0])
+        log.debug('Archived %d workflow instances', archived)
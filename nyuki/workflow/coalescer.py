@@ -0,0 +1,57 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+
+class ProgressCoalescer(object):
+
+    """
+    Hold the progress events of each workflow instance for `window` seconds,
+    keeping only the latest event of each key (e.g. its topic).
+    The events held for an instance are sent, in the order of their last
+    update, once the window is elapsed or as soon as `flush()` is called for
+    that instance (before sending any other event, to keep them ordered).
+    """
+
+    def __init__(self, send, window=0.1, loop=None):
+        self._send = send
+        self.window = window
+        self._loop = loop or asyncio.get_event_loop()
+        # {instance id: OrderedDict({key: event})}
+        self._pending = {}
+        self._handles = {}
+
+    def add(self, instance_id, key, event):
+        """
+        Hold an event, replacing the previous one with the same key.
+        """
+        events = self._pending.setdefault(instance_id, OrderedDict())
+        events.pop(key, None)
+        events[key] = event
+        if instance_id not in self._handles:
+            self._handles[instance_id] = self._loop.call_later(
+                self.window, self.flush, instance_id
+            )
+
+    def flush(self, instance_id):
+        """
+        Send the events held for an instance.
+        """
+        handle = self._handles.pop(instance_id, None)
+        if handle is not None:
+            handle.cancel()
+        events = self._pending.pop(instance_id, None)
+        if not events:
+            return
+
+        try:
+            self._send(instance_id, list(events.values()))
+        except Exception as exc:
+            log.error('Could not send %d progress events: %s', len(events), exc)
+
+    def flush_all(self):
+        for instance_id in list(self._pending):
+            self.flush(instance_id)
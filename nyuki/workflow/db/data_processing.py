@@ -1,4 +1,6 @@
 import logging
+import time
+from copy import deepcopy
 
 
 log = logging.getLogger(__name__)
@@ -6,8 +8,38 @@ log = logging.getLogger(__name__)
 
 class DataProcessingCollection:
 
-    def __init__(self, db, collection_name):
+    """
+    Rules are cached by id once read, and the cache is updated on each write.
+    Writes from other nyukis sharing the database are only seen once the
+    cached rule expires, after `cache_ttl` seconds (never if None).
+    Callers always get their own copy of a cached rule.
+    """
+
+    def __init__(self, db, collection_name, cache_ttl=30):
         self._rules = db[collection_name]
+        self._cache_ttl = cache_ttl
+        # {rule_id: (expiration time or None, rule)}
+        self._cache = {}
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def cache_stats(self):
+        return {
+            'size': len(self._cache),
+            'ttl': self._cache_ttl,
+            'hits': self._hits,
+            'misses': self._misses,
+        }
+
+    def _cache_rule(self, rule):
+        expires = None
+        if self._cache_ttl is not None:
+            expires = time.monotonic() + self._cache_ttl
+        self._cache[rule['id']] = (expires, deepcopy(rule))
+
+    def clear_cache(self):
+        self._cache.clear()
 
     async def index(self):
         await self._rules.create_index('id', unique=True)
@@ -23,7 +55,21 @@ class DataProcessingCollection:
         """
         Return the rule for given id or None
         """
-        return await self._rules.find_one({'id': rule_id}, {'_id': 0})
+        try:
+            expires, rule = self._cache[rule_id]
+        except KeyError:
+            pass
+        else:
+            if expires is None or expires > time.monotonic():
+                self._hits += 1
+                return deepcopy(rule)
+            del self._cache[rule_id]
+
+        self._misses += 1
+        rule = await self._rules.find_one({'id': rule_id}, {'_id': 0})
+        if rule is not None:
+            self._cache_rule(rule)
+        return rule
 
     async def insert(self, data):
         """
@@ -43,6 +89,7 @@ class DataProcessingCollection:
         )
         log.debug('upserting data: %s', data)
         await self._rules.replace_one(query, data, upsert=True)
+        self._cache_rule(data)
 
     async def delete(self, rule_id=None):
         """
@@ -52,3 +99,7 @@ class DataProcessingCollection:
         log.info("Removing rule(s) from collection '%s'", self._rules.name)
         log.debug('delete query: %s', query)
         await self._rules.delete_one(query)
+        if rule_id is None:
+            self.clear_cache()
+        else:
+            self._cache.pop(rule_id, None)
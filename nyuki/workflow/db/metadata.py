@@ -31,6 +31,21 @@ class MetadataCollection:
             {'_id': 0, 'workflow_template_id': 0},
         )
 
+    async def get_many(self, tids):
+        """
+        Return metadata for several templates as {tid: metadata}.
+        """
+        if not tids:
+            return {}
+        cursor = self._metadata.find(
+            {'workflow_template_id': {'$in': list(tids)}},
+            {'_id': 0},
+        )
+        return {
+            metadata.pop('workflow_template_id'): metadata
+            for metadata in await cursor.to_list(None)
+        }
+
     async def insert(self, metadata):
         """
         Insert new metadata for a template.
@@ -0,0 +1,46 @@
+import logging
+from pymongo import UpdateOne
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from nyuki.workflow.db.workflow_instances import title_tokens
+
+
+log = logging.getLogger(__name__)
+
+
+class Migration:
+
+    """
+    Store the title tokens of the instances archived before the indexed
+    title search. The lookup of instances without tokens uses their index.
+    """
+
+    BATCH_SIZE = 500
+
+    def __init__(self, host, database, validate_on_start=None, **kwargs):
+        client = AsyncIOMotorClient(host, **kwargs)
+        self.db = client[database]
+
+    async def run(self):
+        collection = self.db['workflow_instances']
+        cursor = collection.find(
+            {'title_tokens': None}, {'_id': 1, 'template.title': 1}
+        )
+        count = 0
+        requests = []
+        async for instance in cursor:
+            requests.append(UpdateOne(
+                {'_id': instance['_id']},
+                {'$set': {'title_tokens': title_tokens(
+                    instance.get('template', {}).get('title')
+                )}},
+            ))
+            if len(requests) == self.BATCH_SIZE:
+                await collection.bulk_write(requests, ordered=False)
+                count += len(requests)
+                requests = []
+        if requests:
+            await collection.bulk_write(requests, ordered=False)
+            count += len(requests)
+        if count:
+            log.info('Title tokens stored for %d workflow instances', count)
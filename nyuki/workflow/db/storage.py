@@ -1,5 +1,6 @@
 import logging
 from copy import deepcopy
+from collections import deque
 
 from motor.motor_asyncio import AsyncIOMotorClient
 from pymongo.errors import ServerSelectionTimeoutError
@@ -9,13 +10,50 @@ from .data_processing import DataProcessingCollection
 from .metadata import MetadataCollection
 from .workflow_templates import WorkflowTemplatesCollection, TemplateState
 from .task_templates import TaskTemplatesCollection
-from .workflow_instances import WorkflowInstancesCollection
+from .workflow_instances import WorkflowInstancesCollection, title_tokens
 from .task_instances import TaskInstancesCollection
 
 
 log = logging.getLogger(__name__)
 
 
+class BatchCursor:
+
+    """
+    Async iterator over the documents of a cursor, fetched and completed
+    (e.g. joined with other collections) `batch_size` documents at a time.
+    """
+
+    def __init__(self, cursor, process=None, batch_size=100):
+        self._cursor = cursor
+        self._process = process
+        self._batch_size = batch_size
+        self._batch = deque()
+        self._exhausted = False
+
+    def __aiter__(self):
+        return self
+
+    async def prefetch(self):
+        """
+        Fetch the next batch, if needed, so that the query errors are raised
+        before the iteration.
+        """
+        while not self._batch and not self._exhausted:
+            batch = await self._cursor.to_list(self._batch_size)
+            if len(batch) < self._batch_size:
+                self._exhausted = True
+            if batch and self._process is not None:
+                batch = await self._process(batch)
+            self._batch.extend(batch)
+
+    async def __anext__(self):
+        await self.prefetch()
+        if not self._batch:
+            raise StopAsyncIteration
+        return self._batch.popleft()
+
+
 class MongoStorage:
 
     def __init__(self):
@@ -33,7 +71,8 @@ class MongoStorage:
         self.lookups = None
         self.triggers = None
 
-    def configure(self, host, database, validate_on_start=True, **kwargs):
+    def configure(self, host, database, validate_on_start=True,
+                  cache_ttl=30, **kwargs):
         log.info(
             "Setting up mongo storage with host '%s' and database '%s'",
             host, database,
@@ -48,8 +87,8 @@ class MongoStorage:
         self._workflow_metadata = MetadataCollection(self._db)
         self._workflow_instances = WorkflowInstancesCollection(self._db)
         self._task_instances = TaskInstancesCollection(self._db)
-        self.regexes = DataProcessingCollection(self._db, 'regexes')
-        self.lookups = DataProcessingCollection(self._db, 'lookups')
+        self.regexes = DataProcessingCollection(self._db, 'regexes', cache_ttl)
+        self.lookups = DataProcessingCollection(self._db, 'lookups', cache_ttl)
         self.triggers = TriggerCollection(self._db)
 
     async def index(self):
@@ -124,6 +163,25 @@ class MongoStorage:
         await self._workflow_templates.publish_draft(template_id)
         log.info('Draft for template %s published', template_id[:8])
 
+    async def _join_templates(self, templates, metadata=True, tasks=True):
+        """
+        Append the metadata and/or the tasks to a list of templates, with one
+        query per collection.
+        """
+        if metadata is True:
+            metadatas = await self._workflow_metadata.get_many(
+                {template['id'] for template in templates}
+            )
+            for template in templates:
+                template.update(metadatas.get(template['id'], {}))
+        if tasks is True:
+            task_templates = await self._task_templates.get_many(templates)
+            for template in templates:
+                template['tasks'] = task_templates[
+                    (template['id'], template['version'])
+                ]
+        return templates
+
     async def get_for_topic(self, topic):
         """
         Return all the templates listening on a particular topic.
@@ -135,11 +193,21 @@ class MongoStorage:
                 'Fetched %s templates for event from "%s"',
                 len(templates), topic,
             )
-        for template in templates:
-            template['tasks'] = await self._task_templates.get(
-                template['id'], template['version']
-            )
-        return templates
+        return await self._join_templates(templates, metadata=False)
+
+    async def get_active_versions(self):
+        """
+        Return the version of each active template.
+        """
+        return await self._workflow_templates.get_active_versions()
+
+    async def get_active_templates(self, template_ids=None):
+        """
+        Return the active version of all or some templates, with their
+        metadata and tasks.
+        """
+        templates = await self._workflow_templates.get_active(template_ids)
+        return await self._join_templates(templates)
 
     async def get_templates(self, template_id=None, full=False):
         """
@@ -148,14 +216,17 @@ class MongoStorage:
         TODO: Pagination.
         """
         templates = await self._workflow_templates.get(template_id, full)
-        for template in templates:
-            metadata = await self._workflow_metadata.get_one(template['id'])
-            template.update(metadata)
-            if full is True:
-                template['tasks'] = await self._task_templates.get(
-                    template['id'], template['version']
-                )
-        return templates
+        return await self._join_templates(templates, tasks=full)
+
+    def stream_templates(self, full=False):
+        """
+        Iterate over all active/draft templates (see `get_templates`),
+        completed by batches.
+        """
+        async def join(templates):
+            return await self._join_templates(templates, tasks=full)
+
+        return BatchCursor(self._workflow_templates.find(full=full), join)
 
     async def get_template(self, tid, draft=False, version=None):
         """
@@ -192,26 +263,64 @@ class MongoStorage:
         """
         Insert a static workflow instance and all its tasks.
         """
+        await self.insert_instances([instance])
+
+    async def insert_instances(self, instances):
+        """
+        Insert static workflow instances and all their tasks, with one bulk
+        per collection. The given instances are left untouched so that a
+        failed insert can be retried, already inserted documents are ignored.
+        """
+        workflow_instances = []
         task_instances = []
-        for task in instance['template'].pop('tasks'):
-            task['workflow_instance_id'] = instance['id']
-            task_instances.append(task)
-        await self._task_instances.insert_many(task_instances)
-        await self._workflow_instances.insert(instance)
+        for instance in instances:
+            template = instance['template'].copy()
+            for task in template.pop('tasks'):
+                task_instances.append(
+                    {**task, 'workflow_instance_id': instance['id']}
+                )
+            workflow_instances.append({
+                **instance,
+                'template': template,
+                'title_tokens': title_tokens(template.get('title')),
+            })
+        if task_instances:
+            await self._task_instances.insert_many(task_instances)
+        await self._workflow_instances.insert_many(workflow_instances)
 
     # History
 
+    async def _join_instances(self, workflows):
+        """
+        Append their tasks to a list of workflow instances, in one query.
+        """
+        tasks = await self._task_instances.get_many(
+            [workflow['id'] for workflow in workflows], True
+        )
+        for workflow in workflows:
+            workflow['template']['tasks'] = tasks[workflow['id']]
+        return workflows
+
     async def get_history(self, **kwargs):
         """
-        Return paginated workflow history.
+        Return paginated workflow history, with the cursor of the next page.
+        """
+        count, workflows, cursor = await self._workflow_instances.get(
+            **kwargs
+        )
+        if kwargs.get('full') is True:
+            await self._join_instances(workflows)
+        return count, workflows, cursor
+
+    async def stream_history(self, **kwargs):
         """
-        count, workflows = await self._workflow_instances.get(**kwargs)
+        Return the total count of the workflow history (see `get_history`)
+        and an iterator over its instances, completed by batches.
+        """
+        count, _, cursor = await self._workflow_instances.find(**kwargs)
         if kwargs.get('full') is True:
-            for workflow in workflows:
-                workflow['template']['tasks'] = await self._task_instances.get(
-                    workflow['id'], True
-                )
-        return count, workflows
+            return count, BatchCursor(cursor, self._join_instances)
+        return count, BatchCursor(cursor)
 
     async def get_instance(self, instance_id, full=False):
         workflow = await self._workflow_instances.get_one(instance_id, full)
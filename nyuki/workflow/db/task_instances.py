@@ -1,6 +1,9 @@
 import logging
 from datetime import timezone
 from bson.codec_options import CodecOptions
+from pymongo.errors import BulkWriteError
+
+from .workflow_instances import ignore_duplicates
 
 
 log = logging.getLogger(__name__)
@@ -49,6 +52,28 @@ class TaskInstancesCollection:
         cursor = self._instances.find({'workflow_instance_id': wid}, filters)
         return await cursor.to_list(None)
 
+    async def get_many(self, wids, full=False):
+        """
+        Return the task instances of several workflows as {wid: [tasks]}.
+        """
+        if not wids:
+            return {}
+        if full is False:
+            filters = {**self.TASK_HISTORY_FILTERS, 'workflow_instance_id': 1}
+        else:
+            filters = {'_id': 0}
+        cursor = self._instances.find(
+            {'workflow_instance_id': {'$in': list(wids)}}, filters
+        )
+        tasks = {wid: [] for wid in wids}
+        for task in await cursor.to_list(None):
+            tasks[task['workflow_instance_id']].append({
+                key: value
+                for key, value in task.items()
+                if key != 'workflow_instance_id'
+            })
+        return tasks
+
     async def get_one(self, tid, full=False):
         """
         Return one task instance.
@@ -69,6 +94,10 @@ class TaskInstancesCollection:
 
     async def insert_many(self, tasks):
         """
-        Insert all the tasks of a finished workflow.
+        Insert the tasks of one or several finished workflows.
+        Tasks already inserted (e.g. by a retried bulk) are ignored.
         """
-        await self._instances.insert_many(tasks)
+        try:
+            await self._instances.insert_many(tasks, ordered=False)
+        except BulkWriteError as exc:
+            ignore_duplicates(exc)
@@ -32,6 +32,11 @@ class TaskTemplatesCollection:
             ('workflow_template.id', ASCENDING),
             ('workflow_template.version', DESCENDING),
         ], unique=True)
+        # Tasks of a template version, see get_many()
+        await self._templates.create_index([
+            ('workflow_template.id', ASCENDING),
+            ('workflow_template.version', ASCENDING),
+        ])
 
     async def get(self, workflow_id, version):
         """
@@ -49,6 +54,36 @@ class TaskTemplatesCollection:
         )
         return await cursor.to_list(None)
 
+    async def get_many(self, templates):
+        """
+        Return the task templates of several workflow templates as
+        {(workflow_id, version): [tasks]}.
+        """
+        if not templates:
+            return {}
+        cursor = self._templates.find(
+            {'$or': [
+                {
+                    'workflow_template.id': template['id'],
+                    'workflow_template.version': template['version'],
+                }
+                for template in templates
+            ]},
+            {'_id': 0},
+        )
+        tasks = {
+            (template['id'], template['version']): []
+            for template in templates
+        }
+        for task in await cursor.to_list(None):
+            workflow = task['workflow_template']
+            tasks[(workflow['id'], workflow['version'])].append({
+                key: value
+                for key, value in task.items()
+                if key != 'workflow_template'
+            })
+        return tasks
+
     async def insert_many(self, tasks, template):
         """
         Update multiple tasks at once, remove the now unused tasks.
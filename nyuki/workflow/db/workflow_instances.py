@@ -1,13 +1,19 @@
 import re
+import json
+import time
 import asyncio
 import logging
+import unicodedata
 from enum import Enum
-from datetime import datetime, timezone
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime, timedelta, timezone
 from bson.codec_options import CodecOptions
 from pymongo import DESCENDING, ASCENDING
+from pymongo.errors import BulkWriteError
 
 
 log = logging.getLogger(__name__)
+DUPLICATE_KEY = 11000
 
 
 class Ordering(Enum):
@@ -24,9 +30,86 @@ class Ordering(Enum):
         return [key for key in cls.__members__.keys()]
 
 
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+WORD_REGEX = re.compile(r'\w+')
+# Longest indexed prefix of a title word
+MAX_PREFIX = 20
+
+
+def _words(text):
+    """
+    Split a text into lowercase words without accents.
+    """
+    text = unicodedata.normalize('NFKD', text.casefold())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return WORD_REGEX.findall(text)
+
+
+def title_tokens(title):
+    """
+    Return the prefixes of each word of a title, stored along the archived
+    instances to search them by title using an index.
+    """
+    tokens = set()
+    for word in _words(title or ''):
+        for length in range(1, min(len(word), MAX_PREFIX) + 1):
+            tokens.add(word[:length])
+    return sorted(tokens)
+
+
+def search_tokens(search):
+    """
+    Return the tokens that must all be found in the title tokens of the
+    instances matching this search, the longest (most selective) first.
+    """
+    tokens = {word[:MAX_PREFIX] for word in _words(search)}
+    return sorted(tokens, key=lambda token: (-len(token), token))
+
+
+def encode_cursor(order, workflow):
+    """
+    Opaque token pointing after this workflow, for the given sort order.
+    Dates are sent as milliseconds (mongo's precision).
+    """
+    field = order[0]
+    value = workflow
+    for key in field.split('.'):
+        value = value.get(key) if isinstance(value, dict) else None
+    cursor = {'f': field, 'id': workflow['id']}
+    if isinstance(value, datetime):
+        cursor['ms'] = (value - EPOCH) // timedelta(milliseconds=1)
+    else:
+        cursor['v'] = value
+    token = json.dumps(cursor, separators=(',', ':')).encode()
+    return urlsafe_b64encode(token).decode()
+
+
+def decode_cursor(order, token):
+    """
+    Return the (value, id) pair of a token built by `encode_cursor`.
+    Raise ValueError if the token is invalid or was built for another order.
+    """
+    try:
+        cursor = json.loads(urlsafe_b64decode(token.encode()).decode())
+        field, uid = cursor['f'], cursor['id']
+        if 'ms' in cursor:
+            value = EPOCH + timedelta(milliseconds=cursor['ms'])
+        else:
+            value = cursor['v']
+    except (TypeError, ValueError, KeyError) as exc:
+        raise ValueError('Invalid cursor') from exc
+    if field != order[0]:
+        raise ValueError('Cursor does not match the ordering')
+    return value, uid
+
+
 class WorkflowInstancesCollection:
 
     REQUESTER_REGEX = re.compile(r'^nyuki://.*')
+    # Fields used for the queries only
+    PROJECTION = {'_id': 0, 'title_tokens': 0}
+    # Seconds during which the total count of a query is reused
+    COUNT_TTL = 10
 
     def __init__(self, db):
         # Handle timezones in mongo collections.
@@ -34,27 +117,92 @@ class WorkflowInstancesCollection:
         self._instances = db['workflow_instances'].with_options(
             codec_options=CodecOptions(tz_aware=True, tzinfo=timezone.utc)
         )
+        # {query: (expiration, count)}
+        self._counts = {}
 
     async def index(self):
         # Workflow
         await self._instances.create_index('id', unique=True)
         await self._instances.create_index('state')
         await self._instances.create_index('requester')
-        # Search and sorting indexes
-        await self._instances.create_index('template.title')
-        await self._instances.create_index([('start', DESCENDING)])
-        await self._instances.create_index([('end', DESCENDING)])
+        # Search and sorting indexes, the id breaks ties for the pagination
+        await self._instances.create_index('title_tokens')
+        await self._instances.create_index(
+            [('template.title', ASCENDING), ('id', ASCENDING)]
+        )
+        await self._instances.create_index(
+            [('start', DESCENDING), ('id', DESCENDING)]
+        )
+        await self._instances.create_index(
+            [('end', DESCENDING), ('id', DESCENDING)]
+        )
 
     async def get_one(self, instance_id, full=False):
         """
         Return the instance with `instance_id` from workflow history.
         """
-        return await self._instances.find_one({'id': instance_id}, {'_id': 0})
+        return await self._instances.find_one(
+            {'id': instance_id}, self.PROJECTION
+        )
+
+    async def _count(self, query):
+        """
+        Count the results of a query, reusing the counts of the last
+        `COUNT_TTL` seconds.
+        """
+        key = repr(query)
+        now = time.monotonic()
+        try:
+            expiration, count = self._counts[key]
+        except KeyError:
+            pass
+        else:
+            if expiration > now:
+                return count
+
+        count = await self._instances.count(query)
+        if len(self._counts) >= 100:
+            self._counts = {
+                key: value
+                for key, value in self._counts.items()
+                if value[0] > now
+            }
+        self._counts[key] = (now + self.COUNT_TTL, count)
+        return count
 
-    async def get(self, root=False, full=False, offset=None, limit=None,
-                  since=None, state=None, search=None, order=None):
+    @staticmethod
+    def _after(order, token):
         """
-        Return all instances from history from `since` with state `state`.
+        Query part selecting the workflows following the cursor.
+        """
+        field, direction = order
+        value, uid = decode_cursor(order, token)
+        operator = '$gt' if direction == ASCENDING else '$lt'
+        # Null (or missing) values are sorted first
+        if value is None:
+            after = [{field: None, 'id': {operator: uid}}]
+            if direction == ASCENDING:
+                after.append({field: {'$ne': None}})
+            return after
+        after = [
+            {field: {operator: value}},
+            {field: value, 'id': {operator: uid}},
+        ]
+        if direction == DESCENDING:
+            after.append({field: None})
+        return after
+
+    async def find(self, root=False, full=False, offset=None, limit=None,
+                   since=None, state=None, search=None, order=None,
+                   after=None, count=True):
+        """
+        Return the total count of the instances from history from `since`
+        with state `state` (None if `count` is False), the sort order and the
+        cursor of the requested page.
+        Pages can be requested either with `offset` or with the `after`
+        cursor returned along the previous page, which does not need to skip
+        the previous results.
+        A `search` without any word matches no instance.
         """
         query = {}
         # Prepare query
@@ -65,30 +213,66 @@ class WorkflowInstancesCollection:
         if root is True:
             query['requester'] = {'$not': self.REQUESTER_REGEX}
         if search:
-            query['template.title'] = {'$regex': '.*{}.*'.format(search)}
+            # Every word of the search must start a word of the title, a
+            # search without any word (e.g. only punctuation) matches nothing
+            tokens = search_tokens(search)
+            query['title_tokens'] = {'$all': tokens} if tokens else {'$in': []}
 
-        cursor = self._instances.find(query, {'_id': 0})
-        # Count total results regardless of limit/offset
-        count = await cursor.count()
+        # Count total results regardless of limit/offset/cursor
+        total = await self._count(query) if count is True else None
 
-        # Sort depending on Order enum values
-        if order is not None:
-            cursor.sort(*order)
-        else:
-            # End descending by default
-            cursor.sort(*Ordering.end_desc.value)
+        # End descending by default
+        order = order or Ordering.end_desc.value
+        if after:
+            query['$or'] = self._after(order, after)
+
+        cursor = self._instances.find(query, self.PROJECTION)
+        # Sort depending on Order enum values, then by id
+        cursor.sort([order, ('id', order[1])])
 
         # Set offset and limit
         if isinstance(offset, int) and offset >= 0:
             cursor.skip(offset)
         if isinstance(limit, int) and limit > 0:
             cursor.limit(limit)
+        return total, order, cursor
 
-        # Execute query
-        return count, await cursor.to_list(None)
+    async def get(self, limit=None, **kwargs):
+        """
+        Return the total count, the instances of the requested page (see
+        `find()`) and the cursor of the next page (if any).
+        """
+        total, order, cursor = await self.find(limit=limit, **kwargs)
+        workflows = await cursor.to_list(None)
+        next_cursor = None
+        if isinstance(limit, int) and limit > 0 and len(workflows) == limit:
+            next_cursor = encode_cursor(order, workflows[-1])
+        return total, workflows, next_cursor
 
     async def insert(self, workflow):
         """
         Insert a finished workflow report into the workflow history.
         """
         await self._instances.insert_one(workflow)
+
+    async def insert_many(self, workflows):
+        """
+        Insert several finished workflow reports into the workflow history.
+        Reports already inserted (e.g. by a retried bulk) are ignored.
+        """
+        try:
+            await self._instances.insert_many(workflows, ordered=False)
+        except BulkWriteError as exc:
+            ignore_duplicates(exc)
+
+
+def ignore_duplicates(exc):
+    """
+    Raise the bulk write error again unless only duplicates were refused.
+    """
+    errors = exc.details.get('writeErrors', [])
+    if exc.details.get('writeConcernErrors') or any(
+        error['code'] != DUPLICATE_KEY for error in errors
+    ):
+        raise exc
+    log.debug('%d documents were already inserted', len(errors))
@@ -53,10 +53,9 @@ class WorkflowTemplatesCollection:
             [('id', DESCENDING), ('state', DESCENDING)]
         )
 
-    async def get(self, template_id=None, full=False):
+    def find(self, template_id=None, full=False):
         """
-        Return all active and draft templates
-        Used at nyuki's startup and GET /v1/templates
+        Return the cursor of all active and draft templates
         """
         query = {'state': {'$in': TemplateState.active_states()}}
         if template_id is not None:
@@ -66,7 +65,23 @@ class WorkflowTemplatesCollection:
             filters.update({'id': 1, 'state': 1, 'version': 1, 'topics': 1})
 
         # Retrieve only the actives and the drafts
-        cursor = self._templates.find(query, filters)
+        return self._templates.find(query, filters)
+
+    async def get(self, template_id=None, full=False):
+        """
+        Return all active and draft templates
+        Used at nyuki's startup and GET /v1/templates
+        """
+        return await self.find(template_id, full).to_list(None)
+
+    async def get_active(self, template_ids=None):
+        """
+        Return the active version of all or some templates
+        """
+        query = {'state': TemplateState.ACTIVE.value}
+        if template_ids is not None:
+            query['id'] = {'$in': list(template_ids)}
+        cursor = self._templates.find(query, {'_id': 0})
         return await cursor.to_list(None)
 
     async def get_one(self, tid, version=None, draft=False):
@@ -99,6 +114,19 @@ class WorkflowTemplatesCollection:
         cursor = self._templates.find(query, {'_id': 0})
         return await cursor.to_list(None)
 
+    async def get_active_versions(self):
+        """
+        Return the version of each active template as {id: version}
+        """
+        cursor = self._templates.find(
+            {'state': TemplateState.ACTIVE.value},
+            {'_id': 0, 'id': 1, 'version': 1}
+        )
+        return {
+            template['id']: template['version']
+            for template in await cursor.to_list(None)
+        }
+
     async def get_last_version(self, tid):
         """
         Return the highest version of a template
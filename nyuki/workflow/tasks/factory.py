@@ -1,6 +1,4 @@
-import asyncio
 import logging
-from aiohttp import ClientSession
 from copy import deepcopy
 from tukio.task import register
 from tukio.task.holder import TaskHolder
@@ -119,56 +117,50 @@ FACTORY_SCHEMAS = {
 @register('factory', 'execute')
 class FactoryTask(TaskHolder):
 
-    __slots__ = ('api_url', 'session')
-
-    SCHEMA = generate_factory_schema(**FACTORY_SCHEMAS)
-
-    def __init__(self, config):
-        super().__init__(config)
-        self.api_url = 'http://localhost:{}/v1/workflow'.format(
-            runtime.config['api']['port']
-        )
-        self.session = None
+    SCHEMA = generate_factory_schema(
+        schema={
+            'type': 'object',
+            'properties': {
+                # Record the changes made by each rule in `data['diff']`
+                'diff': {'type': 'boolean'}
+            }
+        },
+        **FACTORY_SCHEMAS
+    )
 
     async def get_regex(self, rule):
         """
-        Query the nyuki to get the actual regexes from their IDs
+        Get the actual regexes from their IDs (cached by the storage)
         """
-        url = '{}/regexes/{}'.format(self.api_url, rule['regex_id'])
-        async with self.session.get(url) as resp:
-            if resp.status != 200:
-                raise RuntimeError(
-                    'Could not find regex with id {}'.format(
-                        rule['regex_id']
-                    )
-                )
-            data = await resp.json()
-            rule['pattern'] = data['pattern']
-            del rule['regex_id']
+        regex = await runtime.storage.regexes.get_one(rule['regex_id'])
+        if regex is None:
+            raise RuntimeError(
+                'Could not find regex with id {}'.format(rule['regex_id'])
+            )
+        rule['pattern'] = regex['pattern']
+        del rule['regex_id']
 
     async def get_lookup(self, rule):
         """
-        Query the nyuki to get the actual lookup tables from their IDs
+        Get the actual lookup tables from their IDs (cached by the storage)
         """
-        url = '{}/lookups/{}'.format(self.api_url, rule['lookup_id'])
-        async with self.session.get(url) as resp:
-            if resp.status != 200:
-                raise RuntimeError(
-                    'Could not find lookup table with id {}'.format(
-                        rule['lookup_id']
-                    )
+        lookup = await runtime.storage.lookups.get_one(rule['lookup_id'])
+        if lookup is None:
+            raise RuntimeError(
+                'Could not find lookup table with id {}'.format(
+                    rule['lookup_id']
                 )
-            data = await resp.json()
-            rule['table'] = {
-                field['value']: field['replace']
-                for field in data['table']
-            }
-            del rule['lookup_id']
+            )
+        rule['table'] = {
+            field['value']: field['replace']
+            for field in lookup['table']
+        }
+        del rule['lookup_id']
 
     async def get_factory_rules(self, config):
         """
         Iterate through the task's configuration to swap from their IDs to
-        their database equivalent within the nyuki
+        their database equivalent
         """
         for rule in config['rules']:
             if rule['type'] in ['extract', 'sub']:
@@ -182,11 +174,17 @@ class FactoryTask(TaskHolder):
     async def execute(self, event):
         data = event.data
         runtime_config = deepcopy(self.config)
-        async with ClientSession() as self.session:
-            await self.get_factory_rules(runtime_config)
+        await self.get_factory_rules(runtime_config)
         log.debug('Full factory config: %s', runtime_config)
 
         converter = Converter.from_dict(runtime_config)
-        data['diff'] = converter.apply(data)
-        log.debug('Conversion diff: %s', data['diff'])
+        track = self.config.get('diff')
+        if track is None:
+            track = runtime.config.get('factory', {}).get('diff', True)
+
+        diff = converter.apply(data, track=track)
+        if track or diff.get('error'):
+            # Without tracking, the diff only holds the rules in error
+            data['diff'] = diff
+            log.debug('Conversion diff: %s', diff)
         return data
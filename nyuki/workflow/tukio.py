@@ -1,21 +1,134 @@
+import asyncio
+import logging
+from collections import defaultdict
 from tukio.task import TaskTemplate
 from tukio.workflow import WorkflowTemplate
 
 
+log = logging.getLogger(__name__)
+
+
 class WorkflowSelector:
 
-    def __init__(self, storage):
+    """
+    In-memory index of the active workflow templates by topic, so that
+    selecting the templates triggered by a bus event needs no database access.
+    The index is refreshed when a template is published, modified or deleted
+    through this nyuki. Changes from other nyukis sharing the database are
+    fetched every `refresh_interval` seconds (if set).
+    """
+
+    def __init__(self, storage, refresh_interval=None, loop=None):
         self.storage = storage
+        self._refresh_interval = refresh_interval
+        self._loop = loop or asyncio.get_event_loop()
+        self._poll_future = None
+        # {template id: (template dict, WorkflowTemplate)}
+        self._templates = {}
+        # {topic: {template ids}}, templates without topics listen to all
+        self._topics = defaultdict(set)
+        self._everything = set()
+
+    def _index(self, template, wf_template):
+        self._unindex(template['id'])
+        self._templates[template['id']] = (template, wf_template)
+        topics = template.get('topics')
+        if topics is None:
+            self._everything.add(template['id'])
+        else:
+            for topic in topics:
+                self._topics[topic].add(template['id'])
+
+    def _unindex(self, tid):
+        try:
+            template, _ = self._templates.pop(tid)
+        except KeyError:
+            return
+        topics = template.get('topics')
+        if topics is None:
+            self._everything.discard(tid)
+            return
+        for topic in topics:
+            self._topics[topic].discard(tid)
+            if not self._topics[topic]:
+                del self._topics[topic]
+
+    def _load(self, template):
+        try:
+            wf_template = WorkflowTemplate.from_dict(template)
+        except Exception as exc:
+            log.error('Could not load template %s: %s', template['id'], exc)
+            self._unindex(template['id'])
+            return
+        self._index(template, wf_template)
+
+    async def refresh(self, tid):
+        """
+        Reload the active version of a template, or forget it if there is
+        none anymore.
+        """
+        template = await self.storage.get_template(tid, draft=False)
+        if template is None:
+            self._unindex(tid)
+            log.debug('Template %s removed from the selector', tid[:8])
+            return
+        self._load(template)
+        log.debug('Template %s loaded in the selector', tid[:8])
 
-    async def get(self, tmpl_id):
-        template = await self.storage.get_template(
-            tmpl_id, draft=False
-        )
-        return WorkflowTemplate.from_dict(template)
-
-    async def select(self, topic):
-        templates = await self.storage.get_for_topic(topic)
-        return [
-            WorkflowTemplate.from_dict(template)
-            for template in templates
+    async def sync(self):
+        """
+        Reload the templates whose active version changed in the database.
+        """
+        versions = await self.storage.get_active_versions()
+        for tid in set(self._templates) - set(versions):
+            self._unindex(tid)
+        changed = [
+            tid for tid, version in versions.items()
+            if tid not in self._templates
+            or self._templates[tid][0]['version'] != version
         ]
+        if not changed:
+            return
+        for template in await self.storage.get_active_templates(changed):
+            self._load(template)
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self._refresh_interval, loop=self._loop)
+            try:
+                await self.sync()
+            except Exception as exc:
+                log.error('Could not refresh the workflow templates: %s', exc)
+
+    async def start(self):
+        """
+        Load all the active templates and start polling the database.
+        """
+        await self.sync()
+        log.info('%d templates loaded in the selector', len(self._templates))
+        if self._refresh_interval and self._poll_future is None:
+            self._poll_future = asyncio.ensure_future(
+                self._poll(), loop=self._loop
+            )
+
+    def stop(self):
+        if self._poll_future is not None:
+            self._poll_future.cancel()
+            self._poll_future = None
+
+    def template(self, tmpl_id):
+        """
+        Return the template dict (with its metadata and tasks), it must not be
+        modified.
+        """
+        return self._templates[tmpl_id][0]
+
+    def get(self, tmpl_id):
+        try:
+            return self._templates[tmpl_id][1]
+        except KeyError:
+            return None
+
+    def select(self, topic):
+        tids = self._everything | self._topics.get(topic, set())
+        return [self._templates[tid][1] for tid in tids]
@@ -1,26 +1,25 @@
-import json
 import asyncio
 import logging
 import pickle
 import aiohttp
 from uuid import uuid4
-from copy import deepcopy
 from random import shuffle
-from datetime import datetime
+from collections import OrderedDict
 from tukio import Engine, TaskRegistry, get_broker, EXEC_TOPIC
+from tukio.utils import FutureState
 from tukio.workflow import Workflow, WorkflowExecState
 from tukio.task.factory import TaskExecState
 
 from nyuki import Nyuki
 from nyuki.memory import memsafe
-from nyuki.utils import serialize_object, utcnow
+from nyuki.utils import serialize_object, json_dumps, utcnow
 from nyuki.workflow.db.storage import MongoStorage
 from nyuki.workflow.db.migrations import run_migrations
 from nyuki.workflow.db.task_instances import WS_FILTERS
 
 from .api.factory import (
     ApiFactoryRegex, ApiFactoryRegexes, ApiFactoryLookup, ApiFactoryLookups,
-    ApiFactoryLookupCSV
+    ApiFactoryLookupCSV, ApiFactoryCache
 )
 from .api.templates import (
     ApiTasks, ApiTemplates, ApiTemplate, ApiTemplateVersion, ApiTemplateDraft
@@ -29,7 +28,7 @@ from .api.instances import (
     ApiWorkflow, ApiWorkflows, ApiWorkflowsHistory, ApiWorkflowHistory,
     ApiWorkflowTriggers, ApiWorkflowTrigger, ApiWorkflowHistoryTask,
     ApiWorkflowHistoryTaskData, ApiTaskReporting, ApiTaskReportingContact,
-    ApiTaskReportingContacts,
+    ApiTaskReportingContacts, ApiWorkflowArchive,
 )
 from .api.vars import (
     ApiVars, ApiVarsVersion, ApiVarsDraft
@@ -38,9 +37,12 @@ from .api.vars import (
 from .tasks import *
 from .tasks.utils import runtime, CONTACT_PROGRESS
 from .tukio import WorkflowSelector
+from .coalescer import ProgressCoalescer
+from .archiver import HistoryArchiver
 
 
 log = logging.getLogger(__name__)
+PROGRESS_EVENTS = (TaskExecState.PROGRESS.value, CONTACT_PROGRESS)
 
 
 class BadRequestError(Exception):
@@ -55,20 +57,30 @@ def _serialize_workflow(wf):
     return wf.report()
 
 
-def sanitize_workflow_exec(obj):
+def _workflow_dates(workflow):
     """
-    Replace any object value by 'internal data' string to store in Mongo.
+    Start and end dates of a workflow, which tukio only exposes through the
+    full `Workflow.report()` (attributes of the pinned tukio version).
     """
-    types = [dict, list, tuple, str, int, float, bool, type(None), datetime]
-    if type(obj) not in types:
-        obj = 'Internal server data: {}'.format(type(obj))
-    elif isinstance(obj, dict):
-        for key, value in obj.items():
-            obj[key] = sanitize_workflow_exec(value)
-    elif isinstance(obj, list):
-        for item in obj:
-            item = sanitize_workflow_exec(item)
-    return obj
+    return workflow._start, workflow._end
+
+
+def _workflow_tasks(workflow):
+    """
+    Started tasks of a workflow by task template id. Tasks restored by
+    `fast_forward` (rescued workflows) are shadow objects only providing
+    `done()` and `as_dict()`, without `template` (pinned tukio version).
+    """
+    return workflow._tasks_by_id
+
+
+def _fail_workflow(workflow, exc):
+    """
+    End a workflow on a task reporting error, as `Workflow.report()` does
+    (no public equivalent in the pinned tukio version).
+    """
+    workflow._internal_exc = exc
+    workflow._try_mark_done()
 
 
 class WorkflowInstance:
@@ -76,9 +88,18 @@ class WorkflowInstance:
     """
     Holds a workflow pair of template/instance.
     Allows retrieving a workflow exec state at any moment.
+    The template is shared and never modified: reports reuse its parts, and
+    only the tasks that started or are still running are reported again.
+    Each report is built from new dicts and lists down to the task level, the
+    values below (task configs, inputs/outputs...) are shared with the
+    template and the running tasks, as in tukio's own reports, and must not
+    be modified.
     """
 
-    __slots__ = ('_template', '_instance', '_exec')
+    __slots__ = (
+        '_template', '_instance', '_exec', '_summary', '_tasks', '_running',
+        '_started',
+    )
 
     ALLOWED_EXEC_KEYS = ['requester', 'track']
 
@@ -90,6 +111,29 @@ class WorkflowInstance:
             for key in kwargs
             if key in self.ALLOWED_EXEC_KEYS
         }
+        self._summary = {
+            key: value
+            for key, value in template.items()
+            if key not in ('graph', 'tasks')
+        }
+        # Last report of each task, until they start tasks are reported with
+        # a dummy exec dict.
+        self._tasks = OrderedDict(
+            (task['id'], {
+                'template': task,
+                'id': str(uuid4()),
+                'start': None,
+                'end': None,
+                'state': 'not-started',
+                'inputs': None,
+                'outputs': None,
+                'reporting': None
+            })
+            for task in template['tasks']
+        )
+        # Tasks started, and {task template id: task} of those not done yet
+        self._started = set()
+        self._running = {}
 
     @property
     def template(self):
@@ -103,56 +147,126 @@ class WorkflowInstance:
     def exec(self):
         return self._exec
 
-    def report(self, tasks=True, data=True):
+    def _report_task(self, task_id, task):
+        report = task.as_dict()
+        holder = getattr(task, 'holder', None)
+        if hasattr(holder, 'report'):
+            try:
+                report['reporting'] = holder.report()
+            except Exception as exc:
+                # Same as tukio's own report
+                log.error('Exception on task reporting: %s', exc)
+                _fail_workflow(self._instance, exc)
+        self._tasks[task_id] = {
+            'template': self._tasks[task_id]['template'],
+            **report
+        }
+        return report
+
+    def _update_tasks(self):
         """
-        Merge a workflow exec instance report and its template.
+        Report again the new and running tasks, ended tasks do not change.
         """
-        template = deepcopy(self._template)
-        inst = self._instance.report()
-        inst['exec'].update(self._exec)
+        # One task per task template
+        tasks = _workflow_tasks(self._instance)
+        if len(tasks) != len(self._started):
+            for task_id, task in tasks.items():
+                if task_id in self._started:
+                    continue
+                if task_id in self._tasks:
+                    self._running[task_id] = task
+                self._started.add(task_id)
 
-        result = {
-            **inst['exec'],
-            'template': template,
-        }
+        for task_id, task in list(self._running.items()):
+            report = self._report_task(task_id, task)
+            # The end date is set once the task result has been handled
+            if task.done() and report['end'] is not None:
+                del self._running[task_id]
 
-        if tasks is False:
-            del result['template']['graph']
-            del result['template']['tasks']
-            return result
+    def exec_report(self):
+        """
+        Return the execution informations of the workflow only.
+        """
+        inst = self._instance
+        start, end = _workflow_dates(inst)
+        return {
+            'id': inst.uid,
+            'start': start,
+            'end': end,
+            'state': FutureState.get(inst).value,
+            **self._exec,
+        }
 
-        tasks = {task['id']: {'template': task} for task in template['tasks']}
-        for task_dict in inst['tasks']:
-            if not task_dict.get('exec'):
-                # Task was never started, create dummy exec dict.
-                task_dict['exec'] = {
-                    'id': str(uuid4()),
-                    'start': None,
-                    'end': None,
-                    'state': 'not-started',
-                    'inputs': None,
-                    'outputs': None,
-                    'reporting': None
-                }
+    def task_execs(self, task_ids=None):
+        """
+        Return the execution of the given tasks (all by default) by task
+        template id, None for tasks not started yet.
+        """
+        self._update_tasks()
+        if task_ids is None:
+            task_ids = self._tasks.keys()
+        execs = {}
+        for task_id in task_ids:
+            if task_id not in self._started or task_id not in self._tasks:
+                execs[task_id] = None
+                continue
+            execs[task_id] = {
+                key: value
+                for key, value in self._tasks[task_id].items()
+                if key != 'template'
+            }
+        return execs
 
-            # Filter out reporting/data if not necessary
-            if data is False:
-                del task_dict['exec']['reporting']
-                del task_dict['exec']['inputs']
-                # Leave the necessary task-end informations available
-                if task_dict['exec']['outputs']:
-                    task_dict['exec']['outputs'] = {
-                        key: task_dict['exec']['outputs'][key]
-                        for key in WS_FILTERS
-                        if key in task_dict['exec']['outputs']
-                    }
+    def report(self, tasks=True, data=True):
+        """
+        Merge a workflow exec instance report and its template.
+        """
+        result = self.exec_report()
 
-            # Add execution informations to each task.
-            tasks[task_dict['id']].update(task_dict['exec'])
+        if tasks is False:
+            result['template'] = dict(self._summary)
+            return result
 
-        result['template']['tasks'] = list(tasks.values())
+        self._update_tasks()
+        # Filter out reporting/data if not necessary
+        if data is False:
+            task_reports = [
+                self._filter_task_data(report)
+                for report in self._tasks.values()
+            ]
+        else:
+            task_reports = [
+                {**report, 'template': dict(report['template'])}
+                for report in self._tasks.values()
+            ]
+
+        result['template'] = {
+            **self._summary,
+            'graph': {
+                task_id: list(next_ids)
+                for task_id, next_ids in self._template['graph'].items()
+            },
+            'tasks': task_reports,
+        }
         return result
 
+    @staticmethod
+    def _filter_task_data(report):
+        report = {
+            key: value
+            for key, value in report.items()
+            if key not in ('reporting', 'inputs')
+        }
+        report['template'] = dict(report['template'])
+        # Leave the necessary task-end informations available
+        if report['outputs']:
+            report['outputs'] = {
+                key: report['outputs'][key]
+                for key in WS_FILTERS
+                if key in report['outputs']
+            }
+        return report
+
 
 class WorkflowNyuki(Nyuki):
 
@@ -178,6 +292,50 @@ class WorkflowNyuki(Nyuki):
             'topics': {
                 'type': 'array',
                 'items': {'type': 'string', 'minLength': 1}
+            },
+            'factory': {
+                'type': 'object',
+                'properties': {
+                    # Default of the factory tasks 'diff' option
+                    'diff': {'type': 'boolean', 'default': True},
+                    # Expiration of the cached regexes and lookup tables,
+                    # for nyukis sharing their database (seconds)
+                    'cache_ttl': {
+                        'type': 'number', 'minimum': 0, 'default': 30
+                    },
+                }
+            },
+            'exec_events': {
+                'type': 'object',
+                'properties': {
+                    # Only the latest task progress of each topic is sent
+                    # within this window (seconds), disabled if 0 (default)
+                    'progress_window': {
+                        'type': 'number', 'minimum': 0, 'default': 0
+                    },
+                }
+            },
+            'archive': {
+                'type': 'object',
+                'properties': {
+                    # Finished workflows waiting to be stored in the history
+                    'size': {'type': 'integer', 'minimum': 1},
+                    'batch_size': {'type': 'integer', 'minimum': 1},
+                    'linger': {'type': 'number', 'minimum': 0},
+                    # Retries of a batch while Mongo is not reachable
+                    'retries': {'type': 'integer', 'minimum': 0},
+                    'retry_delay': {'type': 'number', 'minimum': 0},
+                }
+            },
+            'selector': {
+                'type': 'object',
+                'properties': {
+                    # Polling of the templates modified by other nyukis,
+                    # disabled if 0
+                    'refresh_interval': {
+                        'type': 'number', 'minimum': 0, 'default': 30
+                    },
+                }
             }
         }
     }
@@ -196,11 +354,13 @@ class WorkflowNyuki(Nyuki):
         ApiWorkflowHistory,  # /v1/workflows/history/{uid}
         ApiWorkflowHistoryTask,  # /v1/workflows/history/{uid}/tasks/{task_id}
         ApiWorkflowHistoryTaskData,  # /v1/workflows/history/{uid}/tasks/{task_id}/data
+        ApiWorkflowArchive,  # /v1/workflows/archive
         ApiFactoryRegexes,  # /v1/workflows/regexes
         ApiFactoryRegex,  # /v1/workflows/regexes/{uid}
         ApiFactoryLookups,  # /v1/workflows/lookups
         ApiFactoryLookup,  # /v1/workflows/lookups/{uid}
         ApiFactoryLookupCSV,  # /v1/workflows/lookups/{uid}/csv
+        ApiFactoryCache,  # /v1/workflows/cache
         ApiWorkflowTriggers,  # /v1/workflows/triggers
         ApiWorkflowTrigger,  # /v1/workflows/triggers/{tid},
         ApiVars,  # /v1/workflows/vars/{uid}
@@ -216,6 +376,7 @@ class WorkflowNyuki(Nyuki):
         self.register_schema(self.CONF_SCHEMA)
         self.engine = None
         self.storage = MongoStorage()
+        self.archiver = None
 
         self.AVAILABLE_TASKS = {}
         for name, value in TaskRegistry.all().items():
@@ -223,26 +384,61 @@ class WorkflowNyuki(Nyuki):
 
         # Stores workflow instances with their template data
         self.running_workflows = {}
+        self._progress = ProgressCoalescer(
+            self.send_progress, window=0, loop=self.loop
+        )
 
         runtime.bus = self.bus
         runtime.config = self.config
         runtime.workflows = self.running_workflows
+        runtime.storage = self.storage
 
     @property
     def mongo_config(self):
         return self.config['mongo']
 
+    @property
+    def factory_config(self):
+        return self.config.get('factory', {})
+
+    @property
+    def selector_config(self):
+        return self.config.get('selector', {})
+
+    @property
+    def exec_events_config(self):
+        return self.config.get('exec_events', {})
+
+    @property
+    def archive_config(self):
+        return self.config.get('archive', {})
+
     @property
     def topics(self):
         return self.config.get('topics', [])
 
     async def setup(self):
-        self.storage.configure(**self.mongo_config)
+        self.storage.configure(
+            cache_ttl=self.factory_config.get('cache_ttl', 30),
+            **self.mongo_config
+        )
         # Blocks until connection to Mongo is done.
         await self.storage.index()
         await run_migrations(**self.mongo_config)
-        selector = WorkflowSelector(self.storage)
+        self.archiver = HistoryArchiver(
+            self.storage, loop=self.loop, **self.archive_config
+        )
+        self.archiver.start()
+        selector = WorkflowSelector(
+            self.storage,
+            refresh_interval=self.selector_config.get('refresh_interval', 30),
+            loop=self.loop
+        )
+        await selector.start()
         self.engine = Engine(selector=selector, loop=self.loop)
+        self._progress.window = self.exec_events_config.get(
+            'progress_window', 0
+        )
         for topic in self.topics:
             asyncio.ensure_future(self.bus.subscribe(
                 topic, self.workflow_event
@@ -254,11 +450,18 @@ class WorkflowNyuki(Nyuki):
             self.raft.register('failures', self.failure_handler)
 
     async def reload(self):
-        self.storage.configure(**self.mongo_config)
+        self.storage.configure(
+            cache_ttl=self.factory_config.get('cache_ttl', 30),
+            **self.mongo_config
+        )
 
     async def teardown(self):
+        self._progress.flush_all()
         if self.engine:
+            self.engine.selector.stop()
             await self.engine.stop()
+        if self.archiver:
+            await self.archiver.stop()
 
     def new_workflow(self, template, instance, **kwargs):
         """
@@ -267,9 +470,7 @@ class WorkflowNyuki(Nyuki):
         wflow = WorkflowInstance(template, instance, **kwargs)
         self.running_workflows[instance.uid] = wflow
         if 'memory' in self._services and self.memory.available:
-            asyncio.ensure_future(
-                self.write_report(wflow.report(), False)
-            )
+            asyncio.ensure_future(self.write_report(wflow, full=True))
         return wflow
 
     async def report_workflow(self, event):
@@ -335,6 +536,16 @@ class WorkflowNyuki(Nyuki):
             # Update topic for this event
             payload['topic'] = topic
 
+        if event.data['type'] in PROGRESS_EVENTS and self._progress.window:
+            # Only the latest progress of each topic is sent
+            self._progress.add(
+                instance_id, topic,
+                (payload, topic, source['task_template_id'])
+            )
+            return
+        # Send the progress events held for this instance first
+        self._progress.flush(instance_id)
+
         memwrite = True
         # Workflow begins, also send the full template.
         if event.data['type'] == WorkflowExecState.BEGIN.value:
@@ -345,17 +556,18 @@ class WorkflowNyuki(Nyuki):
             WorkflowExecState.ERROR.value
         ]:
             payload['data'] = event.data.get('content') or {}
-            # Sanitize objects to store the finished workflow instance
-            asyncio.ensure_future(self.storage.insert_instance(
-                sanitize_workflow_exec(wflow.report())
-            ))
+            # Stored once sanitized by the archiver
+            archive = wflow.report()
             del self.running_workflows[instance_id]
             memwrite = False
 
         # Shared memory set/del
         if 'memory' in self._services and self.memory.available:
             if memwrite:
-                memjob = self.write_report(wflow.report())
+                # Only the execution of the workflow and of the task that
+                # triggered the event are updated
+                task_ids = [source['task_template_id']] if task_exec_id else []
+                memjob = self.write_report(wflow, task_ids)
             else:
                 memjob = self.clear_report(instance_id)
             asyncio.ensure_future(memjob)
@@ -364,23 +576,44 @@ class WorkflowNyuki(Nyuki):
             payload, 'websocket/{}'.format(topic)
         ))
 
+        if not memwrite:
+            # Waits for a free slot if the archiving is late
+            await self.archiver.put(archive)
+
+    def send_progress(self, instance_id, events):
+        """
+        Send the latest progress events of a workflow instance.
+        """
+        try:
+            wflow = self.running_workflows[instance_id]
+        except KeyError:
+            return
+
+        if 'memory' in self._services and self.memory.available:
+            task_ids = {task_id for _, _, task_id in events}
+            asyncio.ensure_future(self.write_report(wflow, task_ids))
+
+        for payload, topic, _ in events:
+            asyncio.ensure_future(self.bus.publish(
+                payload, 'websocket/{}'.format(topic)
+            ))
+
     async def workflow_event(self, efrom, data):
         """
         New bus event received, trigger workflows if needed.
         """
-        templates = {}
-        # Retrieve full workflow templates
-        # TODO: Better way to fetch the full template details
-        # (this does may more requests than it should)
-        wf_templates = await self.engine.selector.select(efrom)
-        for wftmpl in wf_templates:
-            templates[wftmpl.uid] = await self.storage.get_template(
-                wftmpl.uid, draft=False
-            )
-        # Trigger workflows
+        # Trigger workflows, full templates are held by the selector
         instances = await self.engine.data_received(data, efrom)
         for instance in instances:
-            self.new_workflow(templates[instance.template.uid], instance)
+            tid = instance.template.uid
+            try:
+                template = self.engine.selector.template(tid)
+            except KeyError:
+                # Deleted or deactivated since it was selected
+                log.warning('Template %s no longer active, reporting the '
+                            'triggered workflow without its metadata', tid)
+                template = instance.template.as_dict()
+            self.new_workflow(template, instance)
 
     @memsafe
     async def failure_handler(self, instances):
@@ -416,7 +649,7 @@ class WorkflowNyuki(Nyuki):
                     break
 
                 shuffle(rescuers)
-                report = json.dumps(report, default=serialize_object)
+                report = json_dumps(report)
 
                 # Send a failover request to a valid, not failing, instance.
                 for ito in rescuers:
@@ -443,47 +676,63 @@ class WorkflowNyuki(Nyuki):
         Remove a report from the shared memory.
         """
         _iform = ifrom or self.id
-        await self.memory.store.delete(
-            key=self.memory.key(_iform, 'workflows', 'instances', uid)
-        )
-        await self.memory.store.srem(
-            key=self.memory.key(_iform, 'workflows', 'instances'),
-            member=uid
-        )
+        pipe = self.memory.store.pipeline()
+        pipe.delete(self.memory.key(_iform, 'workflows', 'instances', uid))
+        pipe.srem(self.memory.key(_iform, 'workflows', 'instances'), uid)
+        await pipe.execute()
 
     @memsafe
-    async def write_report(self, report, replace=True, ito=None):
+    async def write_report(self, wflow, task_ids=(), full=False, ito=None):
         """
         Store an instance report into shared memory.
-        A simple 'set' is used againts a 'hset' (hash storage), even though the
-        'hset' seems more appropriate, because a field in a hash can't have TTL
+        Each instance is a hash holding its template, its execution and the
+        execution of each started task in separate fields. Only the workflow
+        execution and the given tasks are written (everything if `full`),
+        in a single pipeline.
+        A field in a hash can't have TTL, the whole hash expires instead.
         """
         _ito = ito or self.id
-        uid = report['exec']['id']
-        response = await self.memory.store.set(
-            key=self.memory.key(_ito, 'workflows', 'instances', uid),
-            value=pickle.dumps(report),
-            expire=86400,
-            exist=None if replace else False
-        )
-
-        if not response:
-            log.error("Can't share workflow id %s context in memory", uid)
-            return
-
-        keyspace = self.memory.key(self.id, 'workflows', 'instances')
-        await self.memory.store.sadd(key=keyspace, member=uid)
-        await self.memory.store.expire(key=keyspace, timeout=86400)
+        uid = wflow.instance.uid
+        fields = {'exec': pickle.dumps(wflow.exec_report())}
+        if full is True:
+            fields['template'] = pickle.dumps(wflow.template)
+            task_ids = None
+        for task_id, task_exec in wflow.task_execs(task_ids).items():
+            if task_exec is not None:
+                fields['tasks.{}'.format(task_id)] = pickle.dumps(task_exec)
+
+        key = self.memory.key(_ito, 'workflows', 'instances', uid)
+        keyspace = self.memory.key(_ito, 'workflows', 'instances')
+        pipe = self.memory.store.pipeline()
+        pipe.hmset_dict(key, fields)
+        pipe.expire(key, 86400)
+        pipe.sadd(keyspace, uid)
+        pipe.expire(keyspace, 86400)
+        await pipe.execute()
 
     @memsafe
     async def read_report(self, uid, ifrom=None):
         """
-        Read and parse a report from the shared memory.
+        Read and rebuild an execution report from the shared memory, as
+        expected by tukio to rescue the workflow.
         """
         _iform = ifrom or self.id
-        report = await self.memory.store.get(
-            key=self.memory.key(_iform, 'workflows', 'instances', uid)
+        fields = await self.memory.store.hgetall(
+            self.memory.key(_iform, 'workflows', 'instances', uid)
         )
-        if not report:
+        if not fields or b'template' not in fields:
             raise KeyError("Can't find workflow id context %s in memory", uid)
-        return pickle.loads(report)
+
+        template = pickle.loads(fields[b'template'])
+        tasks = []
+        for task in template['tasks']:
+            task_exec = fields.get('tasks.{}'.format(task['id']).encode())
+            tasks.append({
+                **task,
+                'exec': pickle.loads(task_exec) if task_exec else None
+            })
+        return {
+            **template,
+            'exec': pickle.loads(fields[b'exec']),
+            'tasks': tasks,
+        }
@@ -26,6 +26,10 @@ setup(
     author_email='rand@surycat.com',
     version=version,
     install_requires=reqs,
+    extras_require={
+        'msgpack': ['msgpack>=1.0'],
+        'orjson': ['orjson>=3.0'],
+    },
     packages=find_packages(exclude=['tests']),
     license='Apache 2.0',
     classifiers=[
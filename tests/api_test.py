@@ -1,11 +1,12 @@
 from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
 from asynctest import TestCase, Mock, patch, ignore_loop
 from json import loads
 from nose.tools import (
     assert_is, assert_is_not_none, assert_raises, assert_true, eq_
 )
 
-from nyuki.api.api import Api, mw_capability, Response
+from nyuki.api.api import Api, mw_capability, Response, StreamResponse
 
 from tests import make_future
 
@@ -142,3 +143,54 @@ class TestCapabilityMiddleware(TestCase):
             await mdw(self._request)
 
         exc_mock.asser_called_once_with(exc)
+
+
+class AsyncItems:
+
+    def __init__(self, items):
+        self._items = iter(items)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._items)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class TestStreamResponse(TestCase):
+
+    async def request(self, response):
+        async def handler(request):
+            return response
+
+        app = web.Application(loop=self.loop)
+        app.router.add_get('/', handler)
+        client = TestClient(TestServer(app, loop=self.loop), loop=self.loop)
+        await client.start_server()
+        try:
+            resp = await client.get('/')
+            eq_(resp.headers['Content-Type'], 'application/json; charset=utf-8')
+            eq_(resp.headers['Transfer-Encoding'], 'chunked')
+            return loads(await resp.text())
+        finally:
+            await client.close()
+
+    async def test_001_list(self):
+        items = [{'id': index, 'data': 'x' * 50} for index in range(100)]
+        response = StreamResponse(AsyncItems(items))
+        response.CHUNK_SIZE = 256
+        eq_(await self.request(response), items)
+        eq_(await self.request(StreamResponse(AsyncItems([]))), [])
+
+    async def test_002_head(self):
+        response = StreamResponse(
+            AsyncItems([1, 2]), head={'count': 2, 'next': None}, key='data'
+        )
+        eq_(await self.request(response), {
+            'count': 2, 'next': None, 'data': [1, 2]
+        })
+        response = StreamResponse(AsyncItems([]), key='data')
+        eq_(await self.request(response), {'data': []})
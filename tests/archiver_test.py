@@ -0,0 +1,110 @@
+import asyncio
+from datetime import datetime
+from unittest import TestCase as SyncTestCase
+from asynctest import TestCase, patch
+from bson.errors import InvalidDocument
+from nose.tools import eq_
+from pymongo.errors import AutoReconnect
+
+from nyuki.workflow.archiver import HistoryArchiver, sanitize_workflow_exec
+
+
+class TestHistoryArchiver(TestCase):
+
+    async def setUp(self):
+        self.batches = []
+        self.failures = 0
+        self.archiver = HistoryArchiver(
+            self, size=10, batch_size=3, linger=0.01, retries=2,
+            retry_delay=0.01, loop=self.loop
+        )
+
+    async def tearDown(self):
+        await self.archiver.stop()
+
+    async def insert_instances(self, instances):
+        if self.failures:
+            self.failures -= 1
+            raise AutoReconnect('unreachable')
+        if any('invalid' in instance for instance in instances):
+            raise InvalidDocument('cannot encode object')
+        self.batches.append([instance['id'] for instance in instances])
+
+    async def test_001_batches(self):
+        self.archiver.start()
+        for uid in range(5):
+            await self.archiver.put({'id': uid})
+        await asyncio.sleep(0.05)
+        eq_(self.batches, [[0, 1, 2], [3, 4]])
+        stats = self.archiver.stats
+        eq_(stats['depth'], 0)
+        eq_(stats['archived'], 5)
+        eq_(stats['max_archive_lag'] >= stats['last_archive_lag'], True)
+
+    async def test_002_retries(self):
+        self.failures = 2
+        await self.archiver.put({'id': 0})
+        await self.archiver.stop()
+        eq_(self.batches, [[0]])
+        eq_(self.archiver.stats['retried'], 2)
+
+        self.failures = 3
+        await self.archiver.put({'id': 1})
+        await self.archiver.stop()
+        eq_(self.batches, [[0]])
+        eq_(self.archiver.stats['lost'], 1)
+
+    async def test_003_invalid_document(self):
+        # Only the report Mongo refuses is lost
+        for instance in ({'id': 0}, {'id': 1, 'invalid': True}, {'id': 2}):
+            await self.archiver.put(instance)
+        await self.archiver.stop()
+        eq_(self.batches, [[0], [2]])
+        eq_(self.archiver.stats['archived'], 2)
+        eq_(self.archiver.stats['lost'], 1)
+
+    async def test_004_sanitize_error(self):
+        with patch(
+            'nyuki.workflow.archiver._sanitize_batch',
+            side_effect=RecursionError('too deep'),
+        ):
+            await self.archiver.put({'id': 0})
+            await self.archiver.stop()
+        eq_(self.batches, [])
+        eq_(self.archiver.stats['lost'], 1)
+
+
+class TestSanitizeWorkflowExec(SyncTestCase):
+
+    def test_001_nested_lists(self):
+        now = datetime.now()
+        report = {
+            'id': 'wf1',
+            'start': now,
+            'tasks': [
+                {'id': 'task1', 'outputs': [object(), (1, object())]},
+                ['ok', [set()]],
+            ],
+            'inputs': {1: 'int key'},
+        }
+        sanitized = sanitize_workflow_exec(report)
+        eq_(sanitized, {
+            'id': 'wf1',
+            'start': now,
+            'tasks': [
+                {'id': 'task1', 'outputs': [
+                    "Internal server data: <class 'object'>",
+                    [1, "Internal server data: <class 'object'>"],
+                ]},
+                ['ok', ["Internal server data: <class 'set'>"]],
+            ],
+            'inputs': {'1': 'int key'},
+        })
+        # The report itself is not modified
+        eq_(isinstance(report['tasks'][1][1][0], set), True)
+        eq_(list(report['inputs']), [1])
+
+    def test_002_unchanged(self):
+        report = {'id': 'wf1', 'tasks': [{'id': 'task1', 'data': (1, 'a')}]}
+        sanitized = sanitize_workflow_exec(report)
+        eq_(sanitized is report, True)
@@ -0,0 +1,277 @@
+import asyncio
+from datetime import datetime, timezone
+from unittest import skipIf
+from asynctest import TestCase, Mock, CoroutineMock
+from nose.tools import eq_
+from pymongo.errors import AutoReconnect
+
+from nyuki.bus.encoding import decode_event, event_uid, msgpack
+from nyuki.bus.loopback import EchoFilter, LoopbackModes
+from nyuki.bus.mqtt import MqttBus
+from nyuki.bus.persistence.backend import EventChunks
+from nyuki.bus.policy import TopicPolicies
+
+
+class TestMqttBusListen(TestCase):
+
+    async def setUp(self):
+        self.bus = MqttBus(Mock(), loop=self.loop)
+        self.bus.client = Mock()
+        self.received = []
+
+    def deliver(self, *messages):
+        messages = iter(messages + (None,))
+
+        async def deliver_message():
+            return next(messages)
+
+        self.bus.client.deliver_message = deliver_message
+
+    def message(self, topic, data):
+        message = Mock()
+        message.topic = topic
+        if isinstance(data, str):
+            data = data.encode()
+        message.data = bytearray(data)
+        return message
+
+    async def callback(self, topic, data):
+        self.received.append((topic, data))
+
+    async def test_001_dispatch(self):
+        async def other(topic, data):
+            self.received.append(('other', data))
+
+        self.bus._subscriptions['a/b'] = {self.callback}
+        self.bus._regex_subscriptions.add('a/+', other)
+        self.deliver(
+            self.message('c/d', 'not json, nobody listening'),
+            self.message('a/b', '{"key": "value"}'),
+        )
+        await self.bus._listen()
+        await asyncio.sleep(0)
+        eq_(self.received, [
+            ('other', {'key': 'value'}), ('a/b', {'key': 'value'}),
+        ])
+        # Callbacks don't share the same event
+        eq_(self.received[0][1] is self.received[1][1], False)
+
+    async def test_002_invalid_event(self):
+        self.bus._subscriptions['a/b'] = {self.callback}
+        self.deliver(
+            self.message('a/b', '{invalid'),
+            self.message('a/b', '[1]'),
+        )
+        await self.bus._listen()
+        await asyncio.sleep(0)
+        eq_(self.received, [('a/b', [1])])
+
+    async def test_003_loopback(self):
+        self.bus._loopback = LoopbackModes({'local/#': 'local', 'a/+': 'both'})
+        self.bus._policies = TopicPolicies({
+            'a/+': {'encoding': 'msgpack'}, 'a/json': {'encoding': 'json'},
+        })
+        self.bus._send = CoroutineMock()
+        self.bus._subscriptions['local/x'] = {self.callback}
+        self.bus._subscriptions['a/b'] = {self.callback}
+
+        await self.bus.publish({'key': 'local'}, 'local/x')
+        await self.bus.publish({'key': 'both'}, 'a/b')
+        await asyncio.sleep(0)
+        eq_(self.received, [
+            ('local/x', {'key': 'local'}), ('a/b', {'key': 'both'}),
+        ])
+        # Only the 'both' event went to the broker
+        eq_(self.bus._send.call_count, 1)
+
+        # The broker sends it back, it is not delivered twice, while a remote
+        # event with the same content is
+        payload = self.bus._send.call_args[0][1]
+        eq_(event_uid(payload) is not None, True)
+        self.deliver(
+            self.message('a/b', '{"key":"both"}'),
+            self.message('a/b', payload),
+            self.message('a/b', payload),
+        )
+        await self.bus._listen()
+        await asyncio.sleep(0)
+        eq_(self.received[2:], [
+            ('a/b', {'key': 'both'}), ('a/b', {'key': 'both'}),
+        ])
+
+        # JSON topics are left unchanged, received from the broker only
+        self.bus._subscriptions['a/json'] = {self.callback}
+        await self.bus.publish({'key': 'json'}, 'a/json')
+        await asyncio.sleep(0)
+        eq_(self.received[4:], [])
+        eq_(self.bus._send.call_args[0][1], b'{"key":"json"}')
+
+
+    async def test_004_loopback_pool(self):
+        # A pooled callback publishing to its own topic doesn't wait for
+        # itself when its queue is full
+        self.bus._loopback = LoopbackModes({'local/#': 'local'})
+        self.bus._callbacks_config = {'concurrency': 1, 'queue_size': 1}
+
+        async def callback(topic, data):
+            self.received.append(data)
+            if data < 3:
+                await self.bus.publish(data + 1, topic)
+                await self.bus.publish(data + 1, topic)
+
+        self.bus._subscriptions['local/x'] = {callback}
+        await self.bus.publish(0, 'local/x')
+        await asyncio.sleep(0.05)
+        eq_(sorted(self.received), [0] + [1] * 2 + [2] * 4 + [3] * 8)
+        for pool in self.bus._pools.values():
+            pool.stop()
+
+
+class TestEchoFilter(TestCase):
+
+    async def test_001_expiration(self):
+        echoes = EchoFilter(ttl=0.01, loop=self.loop)
+        echoes.expect('uid1')
+        echoes.expect('uid2')
+        eq_(echoes.is_echo('uid1'), True)
+        eq_(echoes.is_echo('uid1'), False)
+        eq_(echoes.is_echo('uid3'), False)
+        await asyncio.sleep(0.02)
+        eq_(echoes.is_echo('uid2'), False)
+        eq_(echoes._expected, {})
+
+
+class TestMqttBusPolicies(TestCase):
+
+    async def setUp(self):
+        self.bus = MqttBus(Mock(), loop=self.loop)
+        self.bus.client = Mock()
+        self.bus.client._connected_state.is_set.return_value = True
+        self.bus.client.publish = CoroutineMock()
+        self.bus.client.subscribe = CoroutineMock()
+        self.bus._persistence = Mock()
+        self.bus._persistence.store = CoroutineMock()
+        self.bus._policies = TopicPolicies({
+            'telemetry/#': {'qos': 0, 'persistence': False},
+        })
+
+    async def callback(self, topic, data):
+        pass
+
+    async def test_001_publish(self):
+        await self.bus.publish({}, 'telemetry/a')
+        self.bus.client.publish.assert_called_once_with(
+            'telemetry/a', b'{}', qos=0
+        )
+        eq_(self.bus._persistence.store.call_count, 0)
+
+        await self.bus.publish({}, 'commands/a')
+        self.bus.client.publish.assert_called_with(
+            'commands/a', b'{}', qos=None
+        )
+        eq_(self.bus._persistence.store.call_count, 1)
+
+    async def test_002_subscribe(self):
+        await self.bus.subscribe('telemetry/#', self.callback)
+        await self.bus.subscribe('commands/a', self.callback)
+        eq_(self.bus.client.subscribe.call_args_list[0][0], ([
+            ('telemetry/#', 0)
+        ],))
+        eq_(self.bus.client.subscribe.call_args_list[1][0], ([
+            ('commands/a', 1)
+        ],))
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    async def test_003_msgpack(self):
+        self.bus._policies = TopicPolicies({'binary/#': {
+            'encoding': 'msgpack', 'compress': 1024
+        }})
+        event = {'date': datetime(2026, 1, 1, tzinfo=timezone.utc)}
+        await self.bus.publish(event, 'binary/a')
+        payload = self.bus.client.publish.call_args[0][1]
+        stored = self.bus._persistence.store.call_args[0][0]
+        eq_(stored['message'], payload)
+        eq_(decode_event(payload), event)
+
+        # JSON subscribers and binary subscribers share the same callbacks
+        received = []
+
+        async def callback(topic, data):
+            received.append(data)
+
+        self.bus._subscriptions['binary/a'] = {callback}
+        await self.bus._dispatch('binary/a', bytearray(payload))
+        await self.bus._dispatch('binary/a', b'{"json":true}')
+        await asyncio.sleep(0)
+        eq_(received, [event, {'json': True}])
+
+
+class TestMqttBusConfigure(TestCase):
+
+    async def test_001_reconfigure_publish_queue(self):
+        bus = MqttBus(Mock(), loop=self.loop)
+        bus.configure('test', publish_queue={'linger': 10})
+        bus._send = CoroutineMock()
+        queue = bus._publish_queue
+        await bus.publish({}, 'a')
+        eq_(queue.stats['depth'], 1)
+
+        # The previous queue sends its events before the bus starts again
+        bus.configure('test', publish_queue={'linger': 10})
+        eq_(bus._publish_queue is queue, False)
+        await bus._draining
+        eq_(queue.stats['depth'], 0)
+        eq_(bus._send.call_count, 1)
+        await bus._publish_queue.stop()
+
+
+    async def test_002_loopback_json(self):
+        bus = MqttBus(Mock(), loop=self.loop)
+        with self.assertRaises(ValueError):
+            bus.configure('test', loopback={'a/#': 'both'})
+        bus.configure('test', loopback={'a/#': 'local'})
+        bus.configure(
+            'test', loopback={'a/#': 'both'},
+            topics={'a/#': {'encoding': 'msgpack'}},
+        )
+
+
+class TestMqttBusReplay(TestCase):
+
+    async def test_001_failed_replay(self):
+        bus = MqttBus(Mock(), loop=self.loop)
+
+        async def fetch():
+            raise AutoReconnect('connection lost')
+
+        bus._persistence = Mock()
+        bus._persistence.count = CoroutineMock(return_value=10)
+        bus._persistence.stream.return_value = EventChunks(fetch)
+        replay = asyncio.ensure_future(bus.replay())
+        replay.add_done_callback(bus.replay_done)
+        await asyncio.wait([replay])
+        await asyncio.sleep(0)
+        eq_(bus.replay_stats['running'], False)
+        eq_(bus.replay_stats['error'], 'AutoReconnect: connection lost')
+
+    async def test_002_failed_events(self):
+        bus = MqttBus(Mock(), loop=self.loop)
+        bus.publish = CoroutineMock()
+        chunks = [[
+            {'id': '1', 'topic': 'a', 'message': '{"key": "value"}'},
+            {'id': '2', 'topic': 'a', 'message': '{invalid'},
+            {'id': '3', 'topic': 'a', 'message': '[1]'},
+        ], []]
+
+        async def fetch():
+            return chunks.pop(0)
+
+        bus._persistence = Mock()
+        bus._persistence.count = CoroutineMock(return_value=3)
+        bus._persistence.stream.return_value = EventChunks(fetch)
+        await bus.replay(concurrency=2)
+        stats = bus.replay_stats
+        eq_((stats['replayed'], stats['failed']), (2, 1))
+        eq_(stats['remaining'], 0)
+        eq_(stats['error'], None)
+        eq_(bus.publish.call_count, 2)
@@ -20,7 +20,7 @@ class TestResponse(TestCase):
 
     def test_001_dict_body(self):
         response = Response({'test': 'test'})
-        eq_(response.body, b'{"test": "test"}')
+        eq_(response.body, b'{"test":"test"}')
         eq_(response.content_type, 'application/json')
 
     def test_002_other_body(self):
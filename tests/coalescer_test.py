@@ -0,0 +1,35 @@
+import asyncio
+from asynctest import TestCase
+from nose.tools import eq_
+
+from nyuki.workflow.coalescer import ProgressCoalescer
+
+
+class TestProgressCoalescer(TestCase):
+
+    async def setUp(self):
+        self.sent = []
+        self.coalescer = ProgressCoalescer(
+            self.send, window=0.01, loop=self.loop
+        )
+
+    def send(self, instance_id, events):
+        self.sent.append((instance_id, events))
+
+    async def test_001_latest_event_by_key(self):
+        for step in range(5):
+            self.coalescer.add('wf1', 'task1', step)
+        self.coalescer.add('wf1', 'task2', 'a')
+        self.coalescer.add('wf1', 'task1', 5)
+        self.coalescer.add('wf2', 'task1', 'b')
+        eq_(self.sent, [])
+        await asyncio.sleep(0.05)
+        eq_(sorted(self.sent), [('wf1', ['a', 5]), ('wf2', ['b'])])
+
+    async def test_002_flush(self):
+        self.coalescer.add('wf1', 'task1', 1)
+        self.coalescer.flush('wf1')
+        eq_(self.sent, [('wf1', [1])])
+        # Nothing left to send once the window is elapsed
+        await asyncio.sleep(0.05)
+        eq_(self.sent, [('wf1', [1])])
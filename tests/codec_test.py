@@ -0,0 +1,87 @@
+import importlib.util
+import math
+import sys
+from datetime import datetime, timezone
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+from nose.tools import eq_, assert_raises
+
+from nyuki.utils import codec
+
+
+def import_codec(orjson):
+    """
+    Import a fresh codec module, with or without orjson.
+    """
+    modules = {} if orjson else {'orjson': None}
+    with patch.dict(sys.modules, modules):
+        spec = importlib.util.find_spec('nyuki.utils.codec')
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    return module
+
+
+class JsonCodecTests:
+
+    BACKEND = None
+    codec = None
+
+    def test_001_roundtrip(self):
+        eq_(self.codec.JSON_BACKEND, self.BACKEND)
+        date = datetime(2026, 1, 1, 12, 30, tzinfo=timezone.utc)
+        data = {
+            'str': 'é', 'int': 1, 'float': 1.5, 'list': [None, True],
+            'date': date, 1: 'int key', 'big': 2 ** 70 + 1,
+            'u64': 2 ** 64 - 1, 'i64': -2 ** 63,
+            'small': -2 ** 63 - 1, 'digits': '12345678901234567890',
+        }
+        expected = {
+            'str': 'é', 'int': 1, 'float': 1.5, 'list': [None, True],
+            'date': date.isoformat(), '1': 'int key', 'big': 2 ** 70 + 1,
+            'u64': 2 ** 64 - 1, 'i64': -2 ** 63,
+            'small': -2 ** 63 - 1, 'digits': '12345678901234567890',
+        }
+        for payload in (
+            self.codec.json_encode(data),
+            self.codec.json_dumps(data),
+            bytearray(self.codec.json_encode(data)),
+            memoryview(self.codec.json_encode(data)),
+        ):
+            decoded = self.codec.json_loads(payload)
+            eq_(decoded, expected)
+            for key in ('big', 'u64', 'i64', 'small'):
+                eq_(type(decoded[key]), int)
+
+    def test_002_unknown_object(self):
+        eq_(
+            self.codec.json_loads(self.codec.json_encode({'obj': object()})),
+            {'obj': "Internal server data: <class 'object'>"},
+        )
+
+    def test_003_non_finite(self):
+        # Decoded whatever the backend that encoded them
+        decoded = self.codec.json_loads('[NaN, Infinity, -Infinity]')
+        eq_(math.isnan(decoded[0]), True)
+        eq_(decoded[1:], [math.inf, -math.inf])
+        with assert_raises(ValueError):
+            self.codec.json_loads(b'{"invalid": }')
+
+
+class TestJsonCodec(JsonCodecTests, TestCase):
+
+    BACKEND = 'json'
+    codec = import_codec(orjson=False)
+
+    def test_004_nan(self):
+        eq_(self.codec.json_encode([math.nan, math.inf]), b'[NaN,Infinity]')
+
+
+@skipIf(codec.orjson is None, 'orjson is not installed')
+class TestOrjsonCodec(JsonCodecTests, TestCase):
+
+    BACKEND = 'orjson'
+    codec = codec
+
+    def test_004_nan(self):
+        # orjson encodes the non-finite floats as null
+        eq_(self.codec.json_encode([math.nan, math.inf]), b'[null,null]')
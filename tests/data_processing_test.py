@@ -0,0 +1,63 @@
+import asyncio
+from asynctest import TestCase, MagicMock, CoroutineMock
+from nose.tools import eq_
+
+from nyuki.workflow.db.data_processing import DataProcessingCollection
+
+
+class TestDataProcessingCache(TestCase):
+
+    async def setUp(self):
+        self.collection = MagicMock()
+        self.collection.find_one = CoroutineMock(side_effect=self.find_one)
+        self.collection.replace_one = CoroutineMock()
+        self.collection.delete_one = CoroutineMock()
+        self.rules = {'1': {'id': '1', 'config': {'rules': ['a']}}}
+        db = {'rules': self.collection}
+        self.storage = DataProcessingCollection(db, 'rules', cache_ttl=0.05)
+
+    async def find_one(self, query, projection):
+        return self.rules.get(query['id'])
+
+    async def test_001_hits_and_ttl(self):
+        eq_(await self.storage.get_one('1'), self.rules['1'])
+        eq_(await self.storage.get_one('1'), self.rules['1'])
+        eq_(self.storage.cache_stats['hits'], 1)
+        eq_(self.storage.cache_stats['misses'], 1)
+
+        # Expired, read again
+        await asyncio.sleep(0.06)
+        await self.storage.get_one('1')
+        eq_(self.storage.cache_stats['misses'], 2)
+        eq_(self.collection.find_one.call_count, 2)
+
+    async def test_002_copies(self):
+        rule = await self.storage.get_one('1')
+        rule['config']['rules'].append('b')
+        eq_(await self.storage.get_one('1'), {
+            'id': '1', 'config': {'rules': ['a']}
+        })
+
+        new = {'id': '2', 'config': {}}
+        await self.storage.insert(new)
+        new['config']['key'] = 'value'
+        eq_(await self.storage.get_one('2'), {'id': '2', 'config': {}})
+
+    async def test_003_invalidation(self):
+        await self.storage.insert({'id': '1', 'config': {'rules': ['c']}})
+        eq_(await self.storage.get_one('1'), {
+            'id': '1', 'config': {'rules': ['c']}
+        })
+        eq_(self.collection.find_one.call_count, 0)
+
+        await self.storage.delete('1')
+        await self.storage.get_one('1')
+        eq_(self.collection.find_one.call_count, 1)
+
+        await self.storage.delete()
+        eq_(self.storage.cache_stats['size'], 0)
+
+    async def test_004_default_ttl(self):
+        # Rules written by other nyukis are eventually read again
+        storage = DataProcessingCollection({'rules': self.collection}, 'rules')
+        eq_(storage.cache_stats['ttl'], 30)
@@ -0,0 +1,98 @@
+import asyncio
+from asynctest import TestCase
+from nose.tools import eq_
+
+from nyuki.bus.dispatcher import CallbackPool
+
+
+class TestCallbackPool(TestCase):
+
+    async def setUp(self):
+        self.running = 0
+        self.max_running = 0
+        self.received = []
+        self.release = asyncio.Event(loop=self.loop)
+
+    async def callback(self, topic, data):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await self.release.wait()
+        self.running -= 1
+        if data == 'fail':
+            raise ValueError(data)
+        self.received.append((topic, data))
+
+    async def test_001_concurrency(self):
+        pool = CallbackPool(
+            self.callback, concurrency=2, queue_size=10, loop=self.loop
+        )
+        pool.start()
+        for index in range(5):
+            await pool.put('topic', index)
+        await pool.put('topic', 'fail')
+        await asyncio.sleep(0.01)
+        eq_(self.max_running, 2)
+        eq_(pool.stats['in_flight'], 2)
+        eq_(pool.stats['depth'], 4)
+
+        self.release.set()
+        await asyncio.sleep(0.01)
+        eq_(sorted(data for _, data in self.received), [0, 1, 2, 3, 4])
+        eq_(pool.stats['processed'], 5)
+        eq_(pool.stats['errors'], 1)
+        pool.stop()
+
+    async def test_002_backpressure(self):
+        pool = CallbackPool(
+            self.callback, concurrency=1, queue_size=2, loop=self.loop
+        )
+        pool.start()
+        for index in range(3):
+            await pool.put('topic', index)
+        await asyncio.sleep(0.01)
+        blocked = pool.stats['blocked']
+        put = asyncio.ensure_future(pool.put('topic', 3))
+        await asyncio.sleep(0.01)
+        eq_(put.done(), False)
+        eq_(pool.stats['blocked'], blocked + 1)
+
+        pool.stop()
+        eq_(pool.stats['dropped'], 2)
+        await asyncio.wait_for(put, 1)
+
+    async def test_003_ordered(self):
+        self.release.set()
+        pool = CallbackPool(
+            self.callback, concurrency=4, queue_size=100, ordered=True,
+            loop=self.loop
+        )
+        pool.start()
+        for index in range(20):
+            await pool.put('topic{}'.format(index % 3), index)
+        await asyncio.sleep(0.01)
+        for topic in ('topic0', 'topic1', 'topic2'):
+            indexes = [data for name, data in self.received if name == topic]
+            eq_(indexes, sorted(indexes))
+        eq_(len(self.received), 20)
+        pool.stop()
+
+    async def test_004_put_soon(self):
+        pool = CallbackPool(
+            self.callback, concurrency=1, queue_size=1, loop=self.loop
+        )
+        pool.start()
+        # Never blocks, the events are queued in order once slots are free
+        for index in range(5):
+            pool.put_soon('topic', index)
+        await asyncio.sleep(0.01)
+        eq_(pool.stats['blocked'], 4)
+        self.release.set()
+        await asyncio.sleep(0.01)
+        eq_(self.received, [('topic', index) for index in range(5)])
+
+        self.release.clear()
+        for index in range(4):
+            pool.put_soon('topic', index)
+        await asyncio.sleep(0.01)
+        pool.stop()
+        eq_(pool.stats['dropped'], 3)
@@ -0,0 +1,63 @@
+from datetime import datetime, timezone
+from unittest import TestCase, skipIf
+from uuid import uuid4
+from nose.tools import eq_, assert_raises
+
+from nyuki.bus.encoding import (
+    decode_event, encode_event, event_uid, is_binary, msgpack
+)
+
+
+class TestEventEncoding(TestCase):
+
+    def setUp(self):
+        self.date = datetime(2026, 1, 1, 12, 30, tzinfo=timezone.utc)
+        self.event = {'date': self.date, 'output': ['x' * 100] * 10, 'n': 1}
+
+    def test_001_json(self):
+        payload = encode_event(self.event)
+        eq_(is_binary(payload), False)
+        eq_(decode_event(payload)['date'], self.date.isoformat())
+        # Compressed JSON
+        payload = encode_event(self.event, compress=100)
+        eq_(is_binary(payload), True)
+        eq_(decode_event(bytearray(payload)), decode_event(
+            encode_event(self.event)
+        ))
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_002_msgpack(self):
+        payload = encode_event(self.event, 'msgpack')
+        eq_(is_binary(payload), True)
+        eq_(decode_event(payload), self.event)
+        compressed = encode_event(self.event, 'msgpack', compress=0)
+        eq_(len(compressed) < len(payload), True)
+        eq_(decode_event(compressed), self.event)
+        # Integers larger than 64 bits fall back to JSON
+        eq_(decode_event(encode_event({'big': 2 ** 70}, 'msgpack')), {
+            'big': 2 ** 70
+        })
+
+    def test_003_invalid(self):
+        for payload in (b'\xc1\x05{}', b'\xc1\x80{}', b'\xc1\x01\xc1'):
+            assert_raises(ValueError, decode_event, payload)
+
+    def test_004_uid(self):
+        uid = str(uuid4())
+        eq_(event_uid(encode_event(self.event)), None)
+        for kwargs in ({}, {'compress': 100}, {'encoding': 'msgpack'}):
+            payload = encode_event(self.event, uid=uid, **kwargs)
+            eq_(is_binary(payload), True)
+            eq_(event_uid(bytearray(payload)), uid)
+            eq_(decode_event(payload), decode_event(
+                encode_event(self.event, **kwargs)
+            ))
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_005_decoded_types(self):
+        # Documented in the README and in TopicPolicies
+        event = {'date': self.date, 1: 'int key'}
+        eq_(decode_event(encode_event(event)), {
+            'date': self.date.isoformat(), '1': 'int key',
+        })
+        eq_(decode_event(encode_event(event, 'msgpack')), event)
@@ -0,0 +1,73 @@
+from datetime import datetime, timezone
+from unittest import TestCase
+from asynctest import TestCase as AsyncTestCase, MagicMock, CoroutineMock
+from nose.tools import eq_, assert_raises
+
+from nyuki.workflow.db.workflow_instances import (
+    Ordering, WorkflowInstancesCollection, decode_cursor, encode_cursor,
+    search_tokens, title_tokens
+)
+
+
+class TestHistoryCursor(TestCase):
+
+    def test_001_roundtrip(self):
+        end = datetime(2026, 1, 1, 12, 30, 15, 123000, tzinfo=timezone.utc)
+        token = encode_cursor(Ordering.end_desc.value, {'id': 'wf1', 'end': end})
+        eq_(decode_cursor(Ordering.end_asc.value, token), (end, 'wf1'))
+
+        workflow = {'id': 'wf2', 'template': {'title': 'title'}}
+        token = encode_cursor(Ordering.title_asc.value, workflow)
+        eq_(decode_cursor(Ordering.title_asc.value, token), ('title', 'wf2'))
+
+    def test_002_invalid(self):
+        token = encode_cursor(Ordering.start_desc.value, {'id': 'wf1'})
+        with assert_raises(ValueError):
+            decode_cursor(Ordering.end_desc.value, token)
+        with assert_raises(ValueError):
+            decode_cursor(Ordering.end_desc.value, 'garbage')
+
+    def test_003_after(self):
+        token = encode_cursor(Ordering.title_desc.value, {
+            'id': 'wf1', 'template': {'title': 'title'}
+        })
+        eq_(WorkflowInstancesCollection._after(Ordering.title_desc.value, token), [
+            {'template.title': {'$lt': 'title'}},
+            {'template.title': 'title', 'id': {'$lt': 'wf1'}},
+            {'template.title': None},
+        ])
+
+
+class TestTitleSearch(TestCase):
+
+    def test_001_tokens(self):
+        eq_(title_tokens('Évac. B2'), ['b', 'b2', 'e', 'ev', 'eva', 'evac'])
+        eq_(title_tokens(None), [])
+        eq_(search_tokens('evac  .*B'), ['evac', 'b'])
+        tokens = set(title_tokens('Alert for the Sites'))
+        for token in search_tokens('sit ALER'):
+            eq_(token in tokens, True)
+
+
+class TestHistoryFind(AsyncTestCase):
+
+    def setUp(self):
+        self.instances = MagicMock()
+        self.instances.with_options.return_value = self.instances
+        self.instances.count = CoroutineMock(return_value=0)
+        self.collection = WorkflowInstancesCollection(
+            {'workflow_instances': self.instances}
+        )
+
+    def query(self):
+        return self.instances.find.call_args[0][0]
+
+    async def test_001_search(self):
+        await self.collection.find(search='Evac B')
+        eq_(self.query(), {'title_tokens': {'$all': ['evac', 'b']}})
+
+    async def test_002_search_without_tokens(self):
+        # Not a filter-less query returning the whole history
+        await self.collection.find(search='.* !')
+        eq_(self.query(), {'title_tokens': {'$in': []}})
+        self.instances.count.assert_called_once_with(self.query())
@@ -0,0 +1,116 @@
+import asyncio
+from datetime import datetime, timedelta
+from asynctest import TestCase, Mock, CoroutineMock
+from nose.tools import eq_
+from pymongo import InsertOne, UpdateOne
+
+from nyuki.bus.persistence import EventStatus
+from nyuki.bus.persistence.memory_backend import MemoryBackend
+from nyuki.bus.persistence.mongo_backend import MongoBackend
+
+
+class TestMemoryBackend(TestCase):
+
+    async def setUp(self):
+        self.backend = MemoryBackend(max_size=5)
+        self.start = datetime(2017, 1, 1)
+        for uid in range(7):
+            await self.backend.store({
+                'id': str(uid),
+                'status': EventStatus.SENT.value,
+                'created_at': self.start + timedelta(seconds=uid),
+            })
+
+    def uids(self, events):
+        return [event['id'] for event in events]
+
+    async def test_001_ring_buffer(self):
+        events = await self.backend.retrieve(None, None)
+        eq_(self.uids(events), ['2', '3', '4', '5', '6'])
+        # Dropped events are not indexed anymore
+        await self.backend.update('0', EventStatus.FAILED)
+        eq_(await self.backend.retrieve(None, EventStatus.FAILED), [])
+
+    async def test_002_update_status(self):
+        await self.backend.update('5', EventStatus.FAILED)
+        await self.backend.update('3', EventStatus.PENDING)
+        events = await self.backend.retrieve(None, EventStatus.not_sent())
+        eq_(self.uids(events), ['3', '5'])
+        events = await self.backend.retrieve(None, EventStatus.SENT)
+        eq_(self.uids(events), ['2', '4', '6'])
+
+    async def test_003_since(self):
+        since = self.start + timedelta(seconds=4)
+        events = await self.backend.retrieve(since, None)
+        eq_(self.uids(events), ['4', '5', '6'])
+        await self.backend.update('6', EventStatus.FAILED)
+        events = await self.backend.retrieve(since, [EventStatus.FAILED])
+        eq_(self.uids(events), ['6'])
+        since = self.start + timedelta(seconds=10)
+        eq_(await self.backend.retrieve(since, None), [])
+
+
+class TestMongoBackend(TestCase):
+
+    async def setUp(self):
+        self.backend = MongoBackend('test', flush_interval=0.01, flush_size=3)
+        self.backend._collection = Mock()
+        self.backend._collection.bulk_write = CoroutineMock()
+
+    def written(self):
+        return [
+            call[0][0]
+            for call in self.backend._collection.bulk_write.call_args_list
+        ]
+
+    async def test_001_merge_update(self):
+        await self.backend.store({'id': '1', 'status': 'PENDING'})
+        await self.backend.update('1', EventStatus.SENT)
+        await self.backend.update('2', EventStatus.FAILED)
+        eq_(self.backend.buffered, 2)
+        eq_(self.written(), [])
+
+        await asyncio.sleep(0.02)
+        eq_(self.written(), [[
+            InsertOne({'id': '1', 'status': 'SENT'}),
+            UpdateOne({'id': '2'}, {'$set': {'status': 'FAILED'}}),
+        ]])
+        eq_(self.backend.buffered, 0)
+
+    async def test_002_flush_size(self):
+        await self.backend.store_many([
+            {'id': str(uid), 'status': 'SENT'} for uid in range(3)
+        ])
+        eq_(len(self.written()), 1)
+        eq_(len(self.written()[0]), 3)
+
+    async def test_003_update_many(self):
+        await self.backend.store({'id': '1', 'status': 'PENDING'})
+        await self.backend.update_many([
+            ('1', EventStatus.SENT), ('2', EventStatus.FAILED),
+        ])
+        await self.backend.flush()
+        eq_(self.written(), [[
+            InsertOne({'id': '1', 'status': 'SENT'}),
+            UpdateOne({'id': '2'}, {'$set': {'status': 'FAILED'}}),
+        ]])
+
+    async def test_004_close(self):
+        await self.backend.store({'id': '1', 'status': 'SENT'})
+        await self.backend.close()
+        eq_(len(self.written()), 1)
+        await self.backend.close()
+        eq_(len(self.written()), 1)
+
+
+class TestEventChunks(TestCase):
+
+    async def test_001_memory_stream(self):
+        backend = MemoryBackend()
+        for uid in range(5):
+            await backend.store({'id': str(uid), 'status': 'SENT'})
+        chunks = []
+        async for chunk in backend.stream(None, None, 2):
+            chunks.append([event['id'] for event in chunk])
+        eq_(chunks, [['0', '1'], ['2', '3'], ['4']])
+        eq_(await backend.count(None, EventStatus.SENT), 5)
@@ -0,0 +1,52 @@
+import asyncio
+from asynctest import TestCase
+from nose.tools import eq_
+
+from nyuki.bus.publisher import PublishQueue, QueuedEvent
+
+
+class TestPublishQueue(TestCase):
+
+    async def setUp(self):
+        self.batches = []
+        self.queue = PublishQueue(
+            self.flush, size=10, batch_size=3, linger=0.01, loop=self.loop
+        )
+
+    async def tearDown(self):
+        await self.queue.stop()
+
+    async def flush(self, batch):
+        self.batches.append([event.uid for event in batch])
+
+    def event(self, uid):
+        return QueuedEvent(uid, 'topic', '{}', False)
+
+    async def test_001_batch_size(self):
+        self.queue.start()
+        for uid in range(7):
+            await self.queue.put(self.event(uid))
+        await asyncio.sleep(0.05)
+        eq_(self.batches, [[0, 1, 2], [3, 4, 5], [6]])
+        stats = self.queue.stats
+        eq_(stats['depth'], 0)
+        eq_(stats['flushes'], 3)
+        eq_(stats['flushed_events'], 7)
+
+    async def test_002_stop_flushes(self):
+        for uid in range(4):
+            await self.queue.put(self.event(uid))
+        eq_(self.queue.stats['depth'], 4)
+        await self.queue.stop()
+        eq_(self.batches, [[0, 1, 2], [3]])
+
+    async def test_003_backpressure(self):
+        for uid in range(10):
+            await self.queue.put(self.event(uid))
+        put = asyncio.ensure_future(self.queue.put(self.event(10)))
+        await asyncio.sleep(0)
+        eq_(put.done(), False)
+        self.queue.start()
+        await asyncio.wait_for(put, 1)
+        await asyncio.sleep(0.05)
+        eq_(sum(len(batch) for batch in self.batches), 11)
@@ -0,0 +1,71 @@
+from asynctest import TestCase, Mock, CoroutineMock
+from nose.tools import eq_
+
+from nyuki.workflow.tukio import WorkflowSelector
+
+
+def template(tid, version=1, topics=None):
+    return {
+        'id': tid, 'version': version, 'topics': topics,
+        'tasks': [{'id': 't1', 'name': 'join', 'config': {}}],
+        'graph': {'t1': []},
+    }
+
+
+class TestWorkflowSelector(TestCase):
+
+    async def setUp(self):
+        self.templates = {
+            'a': template('a', topics=['topic']),
+            'b': template('b'),
+        }
+        self.storage = Mock()
+        self.storage.get_active_versions = CoroutineMock(
+            side_effect=self.versions
+        )
+        self.storage.get_active_templates = CoroutineMock(
+            side_effect=self.active
+        )
+        self.storage.get_template = CoroutineMock(side_effect=self.get)
+        self.selector = WorkflowSelector(self.storage, loop=self.loop)
+        await self.selector.start()
+
+    async def versions(self):
+        return {tid: tmpl['version'] for tid, tmpl in self.templates.items()}
+
+    async def active(self, tids):
+        return [self.templates[tid] for tid in tids]
+
+    async def get(self, tid, draft=False):
+        return self.templates.get(tid)
+
+    def selected(self, topic):
+        return sorted(tmpl.uid for tmpl in self.selector.select(topic))
+
+    async def test_001_select(self):
+        eq_(self.selected('topic'), ['a', 'b'])
+        eq_(self.selected('other'), ['b'])
+        eq_(self.selector.get('a').uid, 'a')
+        eq_(self.selector.get('unknown'), None)
+        eq_(self.selector.template('b'), self.templates['b'])
+
+    async def test_002_refresh(self):
+        self.templates['a'] = template('a', version=2, topics=['new'])
+        self.templates['c'] = template('c', topics=['topic'])
+        await self.selector.refresh('a')
+        await self.selector.refresh('c')
+        eq_(self.selected('topic'), ['b', 'c'])
+        eq_(self.selected('new'), ['a', 'b'])
+
+        del self.templates['b']
+        await self.selector.refresh('b')
+        eq_(self.selected('other'), [])
+
+    async def test_003_sync(self):
+        self.templates['a'] = template('a', version=2, topics=['new'])
+        del self.templates['b']
+        await self.selector.sync()
+        eq_(self.selected('new'), ['a'])
+        eq_(self.selected('topic'), [])
+        # Only the changed template is read again
+        eq_(self.storage.get_active_templates.call_args[0][0], ['a'])
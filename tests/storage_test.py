@@ -0,0 +1,76 @@
+from asynctest import TestCase, MagicMock, Mock, CoroutineMock
+from nose.tools import eq_
+
+from nyuki.workflow.db.storage import MongoStorage
+from nyuki.workflow.db.task_instances import TaskInstancesCollection
+from nyuki.workflow.db.task_templates import TaskTemplatesCollection
+
+
+def collection(documents):
+    """
+    Motor collection mock returning `documents` from any query.
+    """
+    cursor = Mock()
+    cursor.to_list = CoroutineMock(return_value=documents)
+    mock = MagicMock()
+    mock.find.return_value = cursor
+    mock.with_options.return_value = mock
+    return mock
+
+
+class TestStorageJoins(TestCase):
+
+    async def test_001_join_templates(self):
+        tasks = collection([
+            {'id': 't1', 'workflow_template': {'id': 'a', 'version': 2}},
+            {'id': 't2', 'workflow_template': {'id': 'a', 'version': 2}},
+            {'id': 't1', 'workflow_template': {'id': 'b', 'version': 1}},
+        ])
+        storage = MongoStorage()
+        storage._task_templates = TaskTemplatesCollection(
+            {'task_templates': tasks}
+        )
+        templates = await storage._join_templates([
+            {'id': 'a', 'version': 2},
+            {'id': 'b', 'version': 1},
+            {'id': 'c', 'version': 1},
+        ], metadata=False)
+        eq_(templates, [
+            {'id': 'a', 'version': 2, 'tasks': [{'id': 't1'}, {'id': 't2'}]},
+            {'id': 'b', 'version': 1, 'tasks': [{'id': 't1'}]},
+            {'id': 'c', 'version': 1, 'tasks': []},
+        ])
+        # One query for all the templates
+        eq_(tasks.find.call_count, 1)
+        eq_(tasks.find.call_args[0][0], {'$or': [
+            {'workflow_template.id': tid, 'workflow_template.version': v}
+            for tid, v in (('a', 2), ('b', 1), ('c', 1))
+        ]})
+
+    async def test_002_join_instances(self):
+        documents = [
+            {'id': 't1', 'workflow_instance_id': 'w1', 'outputs': {}},
+            {'id': 't2', 'workflow_instance_id': 'w2', 'outputs': {}},
+        ]
+        tasks = collection(documents)
+        storage = MongoStorage()
+        storage._task_instances = TaskInstancesCollection(
+            {'task_instances': tasks}
+        )
+        workflows = await storage._join_instances([
+            {'id': 'w1', 'template': {}}, {'id': 'w2', 'template': {}},
+        ])
+        # Same tasks as TaskInstancesCollection.get(wid, full=True)
+        eq_(workflows, [
+            {'id': 'w1', 'template': {'tasks': [
+                {'id': 't1', 'outputs': {}}
+            ]}},
+            {'id': 'w2', 'template': {'tasks': [
+                {'id': 't2', 'outputs': {}}
+            ]}},
+        ])
+        eq_(tasks.find.call_args[0][0], {
+            'workflow_instance_id': {'$in': ['w1', 'w2']}
+        })
+        # The fetched documents are left untouched
+        eq_(documents[0]['workflow_instance_id'], 'w1')
@@ -0,0 +1,102 @@
+from unittest import TestCase
+from nose.tools import eq_
+
+from nyuki.bus.policy import DEFAULT_POLICY, TopicPolicies, TopicPolicy
+from nyuki.bus.topics import TopicTree, is_pattern
+
+
+def callback_a(topic, data):
+    pass
+
+
+def callback_b(topic, data):
+    pass
+
+
+class TestTopicTree(TestCase):
+
+    def setUp(self):
+        self.tree = TopicTree()
+
+    def matches(self, topic):
+        matched = set()
+        for callbacks in self.tree.match(topic):
+            matched.update(callbacks)
+        return matched
+
+    def test_001_is_pattern(self):
+        self.assertTrue(is_pattern('a/+/c'))
+        self.assertTrue(is_pattern('a/#'))
+        self.assertFalse(is_pattern('a/b/c'))
+
+    def test_002_single_level(self):
+        self.assertTrue(self.tree.add('a/+/c', callback_a))
+        self.assertEqual(self.matches('a/b/c'), {callback_a})
+        self.assertEqual(self.matches('a/bb/c'), {callback_a})
+        self.assertEqual(self.matches('a//c'), set())
+        self.assertEqual(self.matches('a/b/c/d'), set())
+        self.assertEqual(self.matches('a/b'), set())
+
+    def test_003_multi_level(self):
+        self.tree.add('a/#', callback_a)
+        self.assertEqual(self.matches('a/b'), {callback_a})
+        self.assertEqual(self.matches('a/b/c'), {callback_a})
+        self.assertEqual(self.matches('a'), set())
+        self.assertEqual(self.matches('a/'), set())
+        self.assertEqual(self.matches('b/c'), set())
+
+        self.tree.add('#', callback_b)
+        self.assertEqual(self.matches('b/c'), {callback_b})
+        self.assertEqual(self.matches('a/b'), {callback_a, callback_b})
+
+    def test_004_multiple_patterns(self):
+        self.tree.add('+/monitoring', callback_a)
+        self.tree.add('nyuki/+', callback_b)
+        self.assertFalse(self.tree.add('nyuki/+', callback_a))
+        self.assertEqual(
+            self.matches('nyuki/monitoring'), {callback_a, callback_b}
+        )
+        self.assertEqual(len(self.tree.match('nyuki/monitoring')), 2)
+        self.assertEqual(self.matches('other/monitoring'), {callback_a})
+
+    def test_005_discard(self):
+        self.tree.add('a/+/c', callback_a)
+        self.tree.add('a/+/c', callback_b)
+        self.tree.add('a/+', callback_b)
+
+        self.assertFalse(self.tree.discard('a/+/c', callback_a))
+        self.assertEqual(self.matches('a/b/c'), {callback_b})
+        self.assertTrue(self.tree.discard('a/+/c', callback_b))
+        self.assertEqual(self.matches('a/b/c'), set())
+        self.assertNotIn('a/+/c', self.tree)
+        self.assertEqual(self.matches('a/b'), {callback_b})
+
+        self.assertTrue(self.tree.discard('a/+'))
+        self.assertEqual(len(self.tree), 0)
+        self.assertEqual(self.tree._root.children, {})
+        self.assertFalse(self.tree.discard('unknown/#'))
+
+
+class TestTopicPolicies(TestCase):
+
+    def test_001_most_specific(self):
+        policies = TopicPolicies({
+            '#': {'qos': 1},
+            'websocket/#': {'qos': 0, 'persistence': False},
+            'websocket/+/commands': {'qos': 2},
+            'websocket/workflow/commands': {'persistence': False},
+        })
+        eq_(policies.get('other/topic'), TopicPolicy(1, True))
+        eq_(policies.get('websocket/workflow/exec/1'), TopicPolicy(0, False))
+        eq_(policies.get('websocket/nyuki/commands'), TopicPolicy(2, True))
+        eq_(
+            policies.get('websocket/workflow/commands'),
+            TopicPolicy(None, False),
+        )
+        # Subscription patterns get their own policy
+        eq_(policies.get('websocket/#'), TopicPolicy(0, False))
+
+    def test_002_default(self):
+        policies = TopicPolicies({})
+        eq_(bool(policies), False)
+        eq_(policies.get('a/b'), DEFAULT_POLICY)
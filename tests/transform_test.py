@@ -1,8 +1,10 @@
+import traceback
 from unittest import TestCase
 
+from nyuki.utils.evaluate import compile_condition
 from nyuki.utils.transform import (
     Upper, Lower, Lookup, Unset, Set, Sub, Extract, Converter,
-    FactoryConditionBlock, Arithmetic, Union
+    FactoryConditionBlock, Arithmetic, Union, ChangeTracker
 )
 
 
@@ -224,3 +226,73 @@ class TestTransformCases(TestCase):
         self.assertEqual(data['result']['a'], 10)
         self.assertEqual(data['result']['b'], 2)
         self.assertEqual(data['result']['c'], 3)
+
+    def test_013_change_tracker(self):
+        nested = {'a': [1, 2]}
+        data = {'keep': nested, 'update': 1, 'remove': 'x'}
+        tracker = ChangeTracker(data)
+        tracker['update'] = 2
+        tracker['add'] = {'b': 1}
+        del tracker['remove']
+        # Changes are applied in place, untouched values are not copied
+        self.assertIs(data['keep'], nested)
+        self.assertEqual(data['update'], 2)
+        self.assertNotIn('remove', data)
+        self.assertEqual(tracker.changes, [
+            {'action': 'update', 'key': 'update', 'old_value': 1, 'new_value': 2},
+            {'action': 'add', 'key': 'add', 'value': {'b': 1}},
+            {'action': 'remove', 'key': 'remove', 'value': 'x'},
+        ])
+
+        tracker.rollback()
+        self.assertEqual(data, {'keep': nested, 'update': 1, 'remove': 'x'})
+
+    def test_014_converter_untracked(self):
+        converter = Converter.from_dict({'rules': [
+            {'type': 'upper', 'fieldname': 'to_upper'},
+            {
+                'type': 'arithmetic', 'fieldname': 'result',
+                'operator': '+', 'operand1': '@normal', 'operand2': 1
+            },
+            {'type': 'condition-block', 'conditions': [
+                {
+                    'type': 'if', 'condition': "(@normal == 'message')",
+                    'rules': [{'type': 'set', 'fieldname': 'set', 'value': 1}]
+                },
+            ]},
+        ]})
+        diff = converter.apply(self.data, track=False)
+        self.assertEqual(self.data['to_upper'], 'UPPERCASE')
+        self.assertEqual(self.data['set'], 1)
+        self.assertNotIn('result', self.data)
+        # Only the rules in error are reported
+        self.assertTrue(diff['error'])
+        self.assertEqual(len(diff['rules']), 1)
+        self.assertEqual(diff['rules'][0]['type'], 'arithmetic')
+        self.assertEqual(diff['rules'][0]['error'], 'arithmetic_rule_error')
+
+    def test_015_compiled_condition(self):
+        condition = compile_condition("(@test == 'ok') and (@list == [1])")
+        self.assertIs(condition, compile_condition(
+            "(@test == 'ok') and (@list == [1])"
+        ))
+        self.assertEqual(condition.variables, ['test', 'list'])
+        self.assertTrue(condition({'test': 'ok', 'list': [1]}))
+        self.assertFalse(condition({'test': 'ok'}))
+
+        # Invalid conditions only raise when evaluated
+        condition = compile_condition("len([])")
+        with self.assertRaises(TypeError):
+            condition({'test': 'ok'})
+        # Each evaluation raises a new exception, keeping no previous frame
+        with self.assertRaises(TypeError) as first:
+            condition({'test': 'ok'})
+        with self.assertRaises(TypeError) as second:
+            condition({'test': 'ok'})
+        self.assertIsNot(first.exception, second.exception)
+        self.assertEqual(
+            len(traceback.extract_tb(first.exception.__traceback__)),
+            len(traceback.extract_tb(second.exception.__traceback__)),
+        )
+        with self.assertRaises(SyntaxError):
+            compile_condition("(@test == ")({})
@@ -0,0 +1,316 @@
+import asyncio
+from asynctest import TestCase, CoroutineMock, Mock
+from nose.tools import eq_
+from tukio.task import register, tukio_factory
+from tukio.task.holder import TaskHolder
+from tukio.workflow import Workflow, WorkflowTemplate
+
+from nyuki.workflow.workflow import WorkflowInstance, WorkflowNyuki
+
+
+@register('test_report_step', 'execute')
+class StepTask(TaskHolder):
+
+    async def execute(self, event):
+        return event.data
+
+
+@register('test_report_wait', 'execute')
+class WaitTask(TaskHolder):
+
+    release = None
+
+    def report(self):
+        return {'waiting': not self.release.is_set()}
+
+    async def execute(self, event):
+        await self.release.wait()
+        return event.data
+
+
+TEMPLATE = {
+    'id': 'template', 'version': 1, 'title': 'report', 'tags': ['tag'],
+    'topics': None, 'policy': None,
+    'tasks': [
+        {'id': '1', 'name': 'test_report_step', 'config': {}},
+        {'id': '2', 'name': 'test_report_wait', 'config': {}},
+        {'id': '3', 'name': 'test_report_step', 'config': {'key': 'value'}},
+    ],
+    'graph': {'1': ['2'], '2': ['3'], '3': []},
+}
+
+
+def tukio_report(template, workflow, exec):
+    """
+    Template merged with tukio's workflow report (previous implementation).
+    """
+    report = workflow.report()
+    tasks = {task['id']: {'template': task} for task in template['tasks']}
+    for task in report['tasks']:
+        tasks[task['id']].update(task['exec'] or {
+            'id': None, 'start': None, 'end': None, 'state': 'not-started',
+            'inputs': None, 'outputs': None, 'reporting': None,
+        })
+    return {
+        **report['exec'], **exec,
+        'template': {**template, 'tasks': list(tasks.values())},
+    }
+
+
+def not_started_ids(report):
+    """
+    Tasks not started yet get a random exec id.
+    """
+    for task in report['template']['tasks']:
+        if task['state'] == 'not-started':
+            task['id'] = None
+    return report
+
+
+class TestWorkflowInstance(TestCase):
+
+    async def setUp(self):
+        self.loop.set_task_factory(tukio_factory)
+        WaitTask.release = asyncio.Event(loop=self.loop)
+        self.workflow = Workflow(
+            WorkflowTemplate.from_dict(TEMPLATE), loop=self.loop
+        )
+        self.instance = WorkflowInstance(
+            TEMPLATE, self.workflow, requester='test', track=['a']
+        )
+        self.workflow.run({'key': 'value'})
+        await asyncio.sleep(0.01)
+
+    async def tearDown(self):
+        WaitTask.release.set()
+        await asyncio.wait_for(self.workflow, 1)
+
+    def check(self):
+        exec = {'requester': 'test', 'track': ['a']}
+        expected = tukio_report(TEMPLATE, self.workflow, exec)
+        eq_(
+            not_started_ids(self.instance.report()),
+            not_started_ids(expected),
+        )
+        eq_(self.instance.exec_report(), {
+            key: value
+            for key, value in expected.items()
+            if key != 'template'
+        })
+
+    async def test_001_running(self):
+        self.check()
+        report = self.instance.report()
+        eq_(
+            [task['state'] for task in report['template']['tasks']],
+            ['finished', 'pending', 'not-started'],
+        )
+        eq_(report['template']['tasks'][1]['reporting'], {'waiting': True})
+
+    async def test_002_finished(self):
+        self.instance.report()
+        WaitTask.release.set()
+        await asyncio.wait_for(self.workflow, 1)
+        await asyncio.sleep(0.01)
+        self.check()
+        eq_(self.instance.report()['state'], 'finished')
+
+    async def test_003_copies(self):
+        report = self.instance.report()
+        report['template']['title'] = 'changed'
+        report['template']['graph']['1'].append('3')
+        report['template']['tasks'][0]['state'] = 'changed'
+        report['template']['tasks'][0]['template']['name'] = 'changed'
+        report['template']['tasks'].pop()
+        del self.instance.report(data=False)['template']['tasks'][1]['end']
+
+        report = self.instance.report()
+        eq_(report['template']['title'], 'report')
+        eq_(report['template']['graph']['1'], ['2'])
+        eq_(len(report['template']['tasks']), 3)
+        eq_(report['template']['tasks'][0]['state'], 'finished')
+        eq_(report['template']['tasks'][0]['template']['name'],
+            'test_report_step')
+        eq_('end' in report['template']['tasks'][1], True)
+        eq_(TEMPLATE['tasks'][0]['name'], 'test_report_step')
+        self.check()
+
+
+    async def test_004_rescued(self):
+        # A workflow rescued from a report by another nyuki, the first task
+        # is restored by tukio as a shadow task without template
+        rescued = Workflow(
+            WorkflowTemplate.from_dict(TEMPLATE), loop=self.loop
+        )
+        tukio = self.workflow.report()
+        rescued.fast_forward(tukio)
+        instance = WorkflowInstance(TEMPLATE, rescued, requester='test')
+        await asyncio.sleep(0.01)
+        report = instance.report()
+        eq_(report['id'], self.workflow.uid)
+        eq_(
+            [task['state'] for task in report['template']['tasks']],
+            ['finished', 'pending', 'not-started'],
+        )
+        # tukio's own report fails on shadow tasks (no holder)
+        done = dict(report['template']['tasks'][0])
+        eq_(done.pop('template'), TEMPLATE['tasks'][0])
+        eq_(done, tukio['tasks'][0]['exec'])
+        eq_(instance.task_execs(['1'])['1'], tukio['tasks'][0]['exec'])
+
+        WaitTask.release.set()
+        await asyncio.sleep(0.01)
+        eq_(
+            [task['state'] for task in instance.report()['template']['tasks']],
+            ['finished', 'finished', 'not-started'],
+        )
+        rescued.cancel()
+        await asyncio.wait_for(rescued, 1)
+
+
+class FakePipeline:
+
+    def __init__(self, store):
+        self._store = store
+        self._hashes = []
+
+    def hmset_dict(self, key, fields):
+        self._hashes.append((key, fields))
+
+    def expire(self, key, timeout):
+        pass
+
+    def sadd(self, key, member):
+        self._store.sets.setdefault(key, set()).add(member)
+
+    async def execute(self):
+        for key, fields in self._hashes:
+            self._store.hashes.setdefault(key, {}).update({
+                field.encode(): value for field, value in fields.items()
+            })
+
+
+class FakeStore:
+
+    def __init__(self):
+        self.hashes = {}
+        self.sets = {}
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    async def hgetall(self, key):
+        return self.hashes.get(key, {})
+
+
+class TestSharedReport(TestCase):
+
+    """
+    Reports written in the shared memory, read back by another nyuki to
+    rescue a workflow.
+    """
+
+    async def setUp(self):
+        self.loop.set_task_factory(tukio_factory)
+        WaitTask.release = asyncio.Event(loop=self.loop)
+        self.workflow = Workflow(
+            WorkflowTemplate.from_dict(TEMPLATE), loop=self.loop
+        )
+        self.instance = WorkflowInstance(
+            TEMPLATE, self.workflow, requester='test', track=['a']
+        )
+        self.nyuki = Mock()
+        self.nyuki.id = 'nyuki'
+        self.nyuki.memory.key = lambda *args: ':'.join(args)
+        self.nyuki.memory.store = FakeStore()
+
+    async def tearDown(self):
+        WaitTask.release.set()
+        if self.workflow.tasks:
+            await asyncio.wait_for(self.workflow, 1)
+
+    async def write(self, **kwargs):
+        await WorkflowNyuki.write_report(self.nyuki, self.instance, **kwargs)
+
+    async def read(self):
+        return await WorkflowNyuki.read_report(
+            self.nyuki, self.workflow.uid
+        )
+
+    def expected(self):
+        """
+        Report format used by the rescue endpoint and tukio's fast_forward
+        """
+        tukio = self.workflow.report()
+        execs = {task['id']: task['exec'] for task in tukio['tasks']}
+        return {
+            **TEMPLATE,
+            'exec': {**tukio['exec'], 'requester': 'test', 'track': ['a']},
+            'tasks': [
+                {**task, 'exec': execs[task['id']]}
+                for task in TEMPLATE['tasks']
+            ],
+        }
+
+    async def test_001_full(self):
+        # Written as soon as the workflow is created
+        await self.write(full=True)
+        eq_(await self.read(), self.expected())
+
+        self.workflow.run({'key': 'value'})
+        await asyncio.sleep(0.01)
+        await self.write(full=True)
+        eq_(await self.read(), self.expected())
+        eq_(self.nyuki.memory.store.sets, {
+            'nyuki:workflows:instances': {self.workflow.uid}
+        })
+
+    async def test_002_incremental(self):
+        await self.write(full=True)
+        self.workflow.run({'key': 'value'})
+        await asyncio.sleep(0.01)
+        # Only the tasks that changed are written again
+        await self.write(task_ids=['1', '2'])
+        report = await self.read()
+        eq_(report, self.expected())
+        eq_(report['tasks'][2]['exec'], None)
+
+        WaitTask.release.set()
+        await asyncio.wait_for(self.workflow, 1)
+        await asyncio.sleep(0.01)
+        await self.write(task_ids=['2', '3'])
+        report = await self.read()
+        eq_(report, self.expected())
+        eq_(report['exec']['state'], 'finished')
+
+        # The rescue endpoint rebuilds the template from the report
+        template = WorkflowTemplate.from_dict({
+            **report,
+            'tasks': [
+                {key: value for key, value in task.items() if key != 'exec'}
+                for task in report['tasks']
+            ],
+        })
+        eq_(template.uid, TEMPLATE['id'])
+
+    async def test_003_missing(self):
+        await self.write()
+        with self.assertRaises(KeyError):
+            await self.read()
+
+
+class TestWorkflowEvent(TestCase):
+
+    async def test_001_unindexed_template(self):
+        workflow = Workflow(
+            WorkflowTemplate.from_dict(TEMPLATE), loop=self.loop
+        )
+        nyuki = Mock()
+        nyuki.engine.data_received = CoroutineMock(return_value=[workflow])
+        nyuki.engine.selector.template.side_effect = KeyError('template')
+        await WorkflowNyuki.workflow_event(nyuki, 'topic', {})
+        template, instance = nyuki.new_workflow.call_args[0]
+        eq_(instance, workflow)
+        eq_(template['id'], TEMPLATE['id'])
+        eq_([task['id'] for task in template['tasks']], ['1', '2', '3'])
+        WorkflowInstance(template, workflow).report()